@@ -45,8 +45,8 @@ def validate_and_init_rennet_model(model_fp):
         raise RuntimeError("Invalid model file: {}".format(model_fp))
 
 
-def main(rennet_model, filepath, to_dir=None):
-    return rennet_model.apply(filepath, to_dir=to_dir)
+def main(rennet_model, filepath, to_dir=None, streaming=False):
+    return rennet_model.apply(filepath, to_dir=to_dir, streaming=streaming)
 
 
 if __name__ == '__main__':
@@ -79,6 +79,11 @@ if __name__ == '__main__':
         help="Path to the model file \n(default: {}).\nPlease add if missing.".
         format(DEFAULT_MODEL_PATH),
     )
+    PARSER.add_argument(
+        '--streaming',
+        action='store_true',
+        help="Analyze the audio in blocks, to limit memory usage for long recordings."
+    )
     PARSER.add_argument(
         '--debug',
         action='store_true',
@@ -100,7 +105,7 @@ if __name__ == '__main__':
     for i, fp in enumerate(absinfilepaths):
         print("\nAnalyzing {}/{} :\n".format(i + 1, total_files), fp)
         try:
-            outfiles.append(main(model, fp, to_dir=todir))
+            outfiles.append(main(model, fp, to_dir=todir, streaming=args.streaming))
             print("Output created at", outfiles[-1])
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -51,6 +51,12 @@ class DT_2_nosub_0zero20one_mono_mn(mu.BaseRennetModel):  # pylint: disable=too-
             filepath=fp,
             samplerate=self.samplerate,
             mono=self.mono, )
+        self.iteraudio = lambda fp, blocksize, overlap: au.iter_audio_blocks(
+            filepath=fp,
+            blocksize=blocksize,
+            overlap=overlap,
+            samplerate=self.samplerate,
+            mono=self.mono, )
 
         # feature extraction
         self.win_len = int(self.samplerate * 0.032)
@@ -113,6 +119,7 @@ class DT_2_nosub_0zero20one_mono_mn(mu.BaseRennetModel):  # pylint: disable=too-
             self.rinit = f['rennet/model/viterbi/init'][()]
             self.rtran = f['rennet/model/viterbi/tran'][()]
         self.vinit, self.vtran = lu.normalize_raw_viterbi_priors(self.rinit, self.rtran)
+        self.viterbi_lag = None  # when streaming, None for the same result as otherwise
 
         # output
         self.seq_minstart = (
@@ -162,6 +169,83 @@ class DT_2_nosub_0zero20one_mono_mn(mu.BaseRennetModel):  # pylint: disable=too-
         data = self.normalize(data)
         return self.addcontext(data)
 
+    def _feature_blocks(self, filepath, nframes):
+        """ Generate features for blocks of `nframes` frames from the audio at `filepath`.
+
+        The audio is streamed in blocks, each overlapping with the next one by
+        `win_len - hop_len` samples, so that the frames are the same as for the
+        features extracted from the entire audio.
+        """
+        nsamples = (nframes - 1) * self.hop_len + self.win_len
+        for y in self.iteraudio(filepath, nsamples, self.win_len - self.hop_len):
+            if len(y) < self.win_len:  # no full frame left in the last block
+                break
+
+            yield self.exttractfeat(y)
+
+    def _normalized_blocks(self, feature_blocks):
+        """ Rolling normalization of blocks of features, same as `normalize` on all at once.
+
+        NOTE: `normalize` treats the first `2 * (norm_winlen - 1)` features differently,
+        because the values for `first_mean_var` are inserted at each of the first
+        `norm_winlen - 1` positions. Hence, the features are held back till there
+        are as many, and only the last `norm_winlen - 1` features are carried on after.
+        """
+        pending, carry = [], None
+        for feat in feature_blocks:
+            if carry is None:
+                pending.append(feat)
+                if sum(len(p) for p in pending) < 2 * (self.norm_winlen - 1):
+                    continue
+
+                feat = np.concatenate(pending)
+                pending = []
+                normed = self.normalize(feat)
+            else:
+                feat = np.concatenate([carry, feat])
+                normed = nu.normalize_mean_std_rolling(
+                    feat,
+                    win_len=self.norm_winlen,
+                    std_it=self.std_it,
+                    first_mean_var='skip',  # the window is full with the carried ones
+                )
+
+            carry = feat[len(feat) - (self.norm_winlen - 1):].copy()
+            yield normed
+
+        if pending:  # fewer features than were needed to be held back
+            yield self.normalize(np.concatenate(pending))
+
+    def _withcontext_blocks(self, normalized_blocks):
+        """ Add data-context to blocks of features, carrying the ones needed across blocks """
+        carry = None
+        for normed in normalized_blocks:
+            x = normed if carry is None else np.concatenate([carry, normed])
+            if len(x) >= self.data_context:
+                yield self.addcontext(x)
+
+            carry = x[max(0, len(x) - (self.data_context - 1)):].copy()
+
+    def preprocess_blocks(self, filepath, block_sec=60., **kwargs):  # pylint: disable=unused-argument
+        """ Generate the output of `preprocess` for `filepath`, block by block.
+
+        Each block is for about `block_sec` seconds of audio, and only that, plus the
+        features carried over for normalization and data-context, is kept in memory.
+
+        NOTE: If the audio has to be resampled, it is resampled while being decoded
+        (check `au.iter_audio_blocks`), and the features may differ slightly from the
+        ones from `preprocess`.
+        """
+        nframes = max(1, int(block_sec * self.samplerate) // self.hop_len)
+        return self._withcontext_blocks(
+            self._normalized_blocks(self._feature_blocks(filepath, nframes))
+        )
+
+    def predict_blocks(self, X_blocks, **kwargs):  # pylint: disable=unused-argument
+        """ Predict on blocks from `preprocess_blocks`, same as `predict` on all at once """
+        for x in X_blocks:
+            yield self.model.predict([x[..., None], x[..., None]], batch_size=self.batchsize)
+
     def predict(self, X, model_fp=None, **kwargs):  # pylint: disable=arguments-differ
         nsteps, x_gen = self.get_inputsgenerator(X)
 
@@ -175,6 +259,16 @@ class DT_2_nosub_0zero20one_mono_mn(mu.BaseRennetModel):  # pylint: disable=too-
         pred = self.mergepreds_fn(preds)
         return lu.viterbi_smoothing(pred, self.vinit, self.vtran)
 
+    def postprocess_blocks(self, preds_blocks, **kwargs):  # pylint: disable=unused-argument
+        """ Merge and smooth the predictions from `predict_blocks` as they come.
+
+        Only the smoothed tokens are kept for all the blocks.
+        """
+        decoder = lu.OnlineViterbi(self.vinit, self.vtran, lag=self.viterbi_lag)
+        tokens = [decoder.decode(self.mergepreds_fn(preds)) for preds in preds_blocks]
+        tokens.append(decoder.finish())
+        return np.concatenate(tokens)
+
     def output(self, pred, to_filepath, audio_path=None, **kwargs):  # pylint: disable=arguments-differ
         seq = lu.ContiguousSequenceLabels.from_dense_labels(
             pred,
@@ -196,7 +290,16 @@ class DT_2_nosub_0zero20one_mono_mn(mu.BaseRennetModel):  # pylint: disable=too-
             to_fileextn=".preds.eaf",
             use_cached_preds=None,
             return_pred=False,
+            streaming=False,
+            block_sec=60.,
             **kwargs):
+        """ Annotate the audio at `filepath`, and export the annotations to an EAF file.
+
+        With `streaming`, the audio is read, preprocessed, predicted on and smoothed
+        in blocks of about `block_sec` seconds, instead of all at once, so that memory
+        use does not grow with the length of the recording, except for the final
+        tokens. `use_cached_preds` is then ignored.
+        """
         filepath = os.path.abspath(filepath)
         if to_dir is None:
             to_dir = os.path.dirname(filepath)
@@ -206,15 +309,21 @@ class DT_2_nosub_0zero20one_mono_mn(mu.BaseRennetModel):  # pylint: disable=too-
         to_filename = os.path.basename(filepath) + to_fileextn
         to_filepath = os.path.join(to_dir, to_filename)
 
-        if use_cached_preds and filepath in self._cached_preds:
-            x = self._cached_preds
+        if streaming:
+            x = self.preprocess_blocks(filepath, block_sec=block_sec, **kwargs)
+            x = self.predict_blocks(x, **kwargs)
+            x = self.postprocess_blocks(x, **kwargs)
         else:
-            x = self.preprocess(filepath, **kwargs)
-            x = self.predict(x, **kwargs)
-            if use_cached_preds:
-                self._cached_preds[filepath] = copy.deepcopy(x)
+            if use_cached_preds and filepath in self._cached_preds:
+                x = self._cached_preds
+            else:
+                x = self.preprocess(filepath, **kwargs)
+                x = self.predict(x, **kwargs)
+                if use_cached_preds:
+                    self._cached_preds[filepath] = copy.deepcopy(x)
+
+            x = self.postprocess(x, **kwargs)
 
-        x = self.postprocess(x, **kwargs)
         self.output(x, to_filepath, audio_path=filepath)
 
         return (to_filepath, x) if return_pred else to_filepath
@@ -60,6 +60,7 @@ initial_epoch = 0
 trn_shuffle_seed = 32
 verbose = 2
 pickle_safe = True
+workers = 1  # each forked worker flows its own shard of the chunks in every pass
 max_q_size = 3 * steps_per_chunk + 1
 
 # OUPUT DIR ###################################################### OUTPUT DIR #
@@ -324,12 +325,15 @@ def main():
         indefinitely=True,
         only_labels=False,
         with_chunking=False,
+        shard=workers,
     )
     nepochs = epochs_per_pass * trn_passes
     steps_per_epoch = (
         trn_passes * trn_ip.steps_per_pass
     ) // nepochs if trn_passes != 0 else 0
 
+    # NOTE: not sharded, since Keras starts a new set of workers for validation
+    # in every epoch, while the forked copies of the training flow live on.
     val_gen = val_ip.flow(
         indefinitely=True,
         only_labels=False,
@@ -365,6 +369,7 @@ def main():
             callbacks=callbacks,
             verbose=verbose,
             pickle_safe=pickle_safe,
+            workers=workers,
             max_q_size=max_q_size,
             initial_epoch=initial_epoch,
         )
@@ -0,0 +1,113 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Helpers for loading the annotations for a whole corpus at once
+
+For example, to load the `ActiveSpeakers` for all Fisher transcripts:
+
+    from rennet.datasets import fisher
+    from rennet.datasets.corpus import load_corpus
+
+    loaded = load_corpus(filepaths, fisher.ActiveSpeakers, workers=8,
+                         allcalldata=calldata_filepath)
+    failed = [l for l in loaded if l.error is not None]
+
+@motjuste
+Created: 18-10-2026
+"""
+from __future__ import print_function, division, absolute_import
+import traceback
+from collections import namedtuple
+from functools import partial
+
+from ..utils.py_utils import imap_indexed
+
+# The result of loading the `index`-th of the filepaths.
+# `value` is `None` if there was an error loading the file, and `error` is then the
+# formatted traceback of the exception. Else, `error` is `None`.
+LoadedFile = namedtuple('LoadedFile', ['index', 'filepath', 'value', 'error'])
+
+
+def _load_file(loader, kwargs, index_filepath):
+    # module-level to be picklable for a pool of processes
+    index, filepath = index_filepath
+    try:
+        value = getattr(loader, 'from_file', loader)(filepath, **kwargs)
+        return LoadedFile(index, filepath, value, None)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:  # pylint: disable=bare-except
+        # NOTE: Catch all, so that one mis-behaving file doesn't mess all of them
+        return LoadedFile(index, filepath, None, traceback.format_exc())
+
+
+def iload_corpus(filepaths, loader, workers=1, chunksize=8, **kwargs):
+    """ Load each of `filepaths` with `loader`, yielding `LoadedFile` as they complete.
+
+    Parameters
+    ----------
+    filepaths: list of str
+    loader: class with a `from_file` classmethod, or a function
+        e.g. `fisher.Annotations`, `fisher.ActiveSpeakers`, `ka3.ActiveSpeakers`,
+        `timit.Annotations`. It is called with each filepath and `kwargs`.
+        When `workers > 1`, it and the loaded values should be picklable.
+    workers: int or None
+        Number of processes to load the files in, `None` for as many as there are CPUs.
+        With 1, they are loaded one after the other in this process, and in the same
+        order as `filepaths`.
+    chunksize: int
+        Number of files sent to a process at once.
+
+    Yields
+    ------
+    LoadedFile
+        With the `index` of its filepath in `filepaths`, since the order may be different.
+        Errors in loading a file are reported in it, and don't stop the others.
+    """
+    load = partial(_load_file, loader, kwargs)
+    for loaded in imap_indexed(load, list(enumerate(filepaths)), workers, chunksize):
+        yield loaded
+
+
+def load_corpus(filepaths, loader, workers=1, chunksize=8, **kwargs):
+    """ Load each of `filepaths` with `loader` in a pool of `workers` processes.
+
+    Returns the list of `LoadedFile` in the same order as `filepaths`.
+    See `iload_corpus` to get them as they complete, and for the parameters.
+    """
+    loaded = [None] * len(filepaths)
+    for l in iload_corpus(filepaths, loader, workers=workers, chunksize=chunksize, **kwargs):
+        loaded[l.index] = l
+
+    return loaded
+
+
+def load_corpus_values(filepaths, loader, workers=1, chunksize=8, **kwargs):
+    """ The values loaded by `load_corpus`, in the same order as `filepaths`.
+
+    Raises
+    ------
+    RuntimeError
+        If any of the files could not be loaded, with the error for the first of them,
+        after all of them have been tried.
+    """
+    loaded = load_corpus(filepaths, loader, workers=workers, chunksize=chunksize, **kwargs)
+    failed = [l for l in loaded if l.error is not None]
+    if failed:
+        raise RuntimeError(
+            "Loading {} of the {} files failed, e.g. {}, with:\n{}".format(
+                len(failed), len(loaded), failed[0].filepath, failed[0].error
+            )
+        )
+
+    return [l.value for l in loaded]
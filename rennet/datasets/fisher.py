@@ -17,8 +17,10 @@
 Created: 01-02-2017
 """
 from __future__ import print_function, division, absolute_import
+import re
 import warnings
-from os.path import abspath
+from os import getpid, rename
+from os.path import abspath, exists, getmtime
 from csv import reader
 import numpy as np
 import h5py as h
@@ -28,6 +30,7 @@ from ..utils import label_utils as lu
 from ..utils import np_utils as nu
 from ..utils import h5_utils as hu
 from ..utils.py_utils import BaseSlotsOnlyClass
+from .corpus import load_corpus_values
 
 samples_for_labelsat = lu.samples_for_labelsat  # pylint: disable=invalid-name
 times_for_labelsat = lu.times_for_labelsat  # pylint: disable=invalid-name
@@ -97,26 +100,20 @@ class AllCallData(object):
 
     @classmethod
     def from_file_for_callid(cls, filepath, callid):
-        filepath = abspath(filepath)
-        calldata = None
+        """ Read the CallData for only `callid` from the file at `filepath`.
 
-        with open(filepath, 'r') as f:
-            for i, row in enumerate(reader(f, delimiter=',')):
-                if i == 0 or row[0] != callid:
-                    # Header or not for callid
-                    continue
-
-                calldata = cls._read_calldata_from_row(row)
-                break
-
-        if calldata is None:
+        The row for `callid` is found with the `CallDataIndex` for the file,
+        hence, the whole file is scanned only once, and not for every `callid`.
+        """
+        row = CallDataIndex.for_file(filepath).read_row(callid)
+        if row is None:
             raise KeyError(
                 "Call Data for callid {} not found in provided filepath:\n{}".format(
-                    callid, filepath
+                    callid, abspath(filepath)
                 )
             )
 
-        return calldata
+        return cls._read_calldata_from_row(row)
 
     @classmethod
     def from_file_for_filename(cls, filepath, filename):
@@ -166,6 +163,97 @@ class AllCallData(object):
             )
 
 
+class CallDataIndex(object):
+    """ Index of the byte offsets of the rows for each callid in an AllCallData file.
+
+    It is built by scanning the file once, and saved as a sidecar `.idx.npy` file
+    next to it, if possible, to be loaded memory-mapped the next time, unless the
+    AllCallData file was modified after. Use `for_file` to also reuse the loaded
+    index within a process.
+    """
+    _loaded = dict()  # per-process, for each (filepath, mtime)
+
+    def __init__(self, filepath, index):
+        self.filepath = filepath
+        # structured array with 'callid' and 'offset', sorted on callid
+        self.index = index
+
+    @staticmethod
+    def sidecar_path(filepath):
+        return filepath + '.idx.npy'
+
+    @classmethod
+    def build(cls, filepath):
+        filepath = abspath(filepath)
+
+        callids, offsets = [], []
+        offset = 0
+        with open(filepath, 'rb') as f:
+            for i, line in enumerate(f):
+                if i > 0:  # skip the header
+                    callids.append(line.split(b',', 1)[0].strip())
+                    offsets.append(offset)
+
+                offset += len(line)
+
+        index = np.zeros(
+            len(callids),
+            dtype=[('callid', 'S{}'.format(max([1] + [len(c) for c in callids]))),
+                   ('offset', np.int64)]
+        )
+        index['callid'] = callids
+        index['offset'] = offsets
+
+        # stable, hence the first row for a duplicate callid comes first
+        return cls(filepath, index[np.argsort(index['callid'], kind='mergesort')])
+
+    @classmethod
+    def for_file(cls, filepath):
+        filepath = abspath(filepath)
+        key = (filepath, getmtime(filepath))
+        if key in cls._loaded:
+            return cls._loaded[key]
+
+        sidecar = cls.sidecar_path(filepath)
+        if exists(sidecar) and getmtime(sidecar) >= key[1]:
+            res = cls(filepath, np.load(sidecar, mmap_mode='r'))
+        else:
+            res = cls.build(filepath)
+            try:
+                # written in full before being moved in place, for other processes
+                tmp = "{}.{}.tmp".format(sidecar, getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, res.index)
+                rename(tmp, sidecar)
+            except (IOError, OSError):  # pylint: disable=overlapping-except
+                pass  # e.g. read-only dataset directory, the in-process one will do
+
+        cls._loaded[key] = res
+        return res
+
+    def offset(self, callid):
+        """ Byte offset of the row for `callid`, or `None` if there isn't one. """
+        callid = callid.encode() if not isinstance(callid, bytes) else callid
+        callids = self.index['callid']
+        i = np.searchsorted(callids, callid)
+        if i < len(callids) and callids[i] == callid:
+            return int(self.index['offset'][i])
+
+        return None
+
+    def read_row(self, callid):
+        """ The parsed csv row for `callid`, or `None` if there isn't one. """
+        offset = self.offset(callid)
+        if offset is None:
+            return None
+
+        with open(self.filepath, 'rb') as f:
+            f.seek(offset)
+            line = f.readline().decode()
+
+        return next(reader([line], delimiter=','))
+
+
 class Transcription(BaseSlotsOnlyClass):  # pylint: disable=too-few-public-methods
     __slots__ = ('speakerchannel', 'content')
 
@@ -174,6 +262,75 @@ class Transcription(BaseSlotsOnlyClass):  # pylint: disable=too-few-public-metho
         self.content = content
 
 
+# one annotation per line, e.g. "12.34 15.6 A: some transcription"
+TRANSCRIPTS_LINE_RE = re.compile(
+    r'^(\d+)\.(\d+) (\d+)\.(\d+) ([^:]*):(.*)$', flags=re.MULTILINE
+)
+# lines that are not empty, and not comments
+TRANSCRIPTS_ANNOT_RE = re.compile(r'^[^#\r\n]', flags=re.MULTILINE)
+TRANSCRIPTS_CHANNELS = {'A': 0, 'B': 1}
+
+
+def parse_transcripts(text, filepath=None):
+    """ Parse the content of a Fisher transcripts file.
+
+    All the lines are parsed in one pass of a regular expression, and the times
+    are converted as arrays.
+
+    Returns
+    -------
+    starts, ends: ndarray of int
+        at the `samplerate`, inferred from the max number of digits after decimal.
+    samplerate: int
+    channels: ndarray of int
+        0 for speaker channel 'A', and 1 for 'B'.
+    contents: list of str
+        the stripped transcription for each annotation.
+
+    Raises
+    ------
+    ValueError: if a line that is not empty or a comment could not be parsed,
+        or has a speaker channel other than A and B.
+    """
+    rows = TRANSCRIPTS_LINE_RE.findall(text)
+    if len(rows) != len(TRANSCRIPTS_ANNOT_RE.findall(text)):
+        bad = next(
+            l for l in text.splitlines()
+            if l and l[0] != '#' and not TRANSCRIPTS_LINE_RE.match(l)
+        )
+        raise ValueError("Unexpected line in file\n{}:\n{}".format(filepath, bad))
+
+    # NOTE: s, e are in seconds, but resolution goes to milliseconds.
+    # Floats are a pain in the proverbials.
+    # We infer the samplerate based on the ndigits after decimal,
+    # and then set the final samplerate based on max of such ndigits for all.
+    # Biggest assumption is that s and e are in seconds.
+    # Easy bad case is s and e ending with zeros after decimal.
+    times = np.fromstring(
+        " ".join(" ".join(r[:4]) for r in rows), dtype=np.int, sep=" "
+    ).reshape(-1, 4)
+    decimals = np.array([(len(r[1]), len(r[3])) for r in rows], dtype=np.int).reshape(-1, 2)
+
+    # we don't have to do lowest_common_multiple cuz it is only powers of 10
+    samplerate = 10**(np.max(decimals))
+    decimultiplier = 10**(np.max(decimals) - decimals)
+
+    starts = times[:, 0] * samplerate + times[:, 1] * decimultiplier[:, 0]
+    ends = times[:, 2] * samplerate + times[:, 3] * decimultiplier[:, 1]
+
+    channels = np.array(
+        [TRANSCRIPTS_CHANNELS.get(r[4].strip().upper(), -1) for r in rows], dtype=np.int
+    )
+    if np.any(channels < 0):
+        raise ValueError(
+            "Speaker channel other than A and B ({}) in file\n{}".format(
+                rows[np.argmin(channels)][4], filepath
+            )
+        )
+
+    return starts, ends, samplerate, channels, [r[5].strip() for r in rows]
+
+
 class Annotations(lu.SequenceLabels):
     """Annotations
     TODO: [ ] Add proper docs
@@ -186,7 +343,7 @@ class Annotations(lu.SequenceLabels):
 
     # PARENT'S SLOTS
     # __slots__ = ('_starts_ends', 'labels', '_orig_samplerate', '_samplerate',
-    #              '_minstart_at_orig_sr', )
+    #              '_minstart_at_orig_sr', '_flat_index', )
     __slots__ = ('sourcefile', 'calldata')
 
     def __init__(self, filepath, calldata, *args, **kwargs):
@@ -220,11 +377,6 @@ class Annotations(lu.SequenceLabels):
     def from_file(cls, filepath, allcalldata=None):
         filepath = abspath(filepath)
 
-        starts = []
-        ends = []
-        decimultiplier = []
-        trans = []
-
         if allcalldata is None:
             caldata = None
         elif isinstance(allcalldata, AllCallData):
@@ -238,50 +390,11 @@ class Annotations(lu.SequenceLabels):
             )
 
         with open(filepath, 'r') as f:
+            starts, ends, samplerate, channels, contents = parse_transcripts(
+                f.read(), filepath=filepath
+            )
 
-            for row in reader(f, delimiter=':'):
-                if not row or row[0][0] == '#':
-                    # ignore empty lines or comments
-                    continue
-                else:
-                    s, e, spk = row[0].split(' ')
-
-                    # NOTE: s, e are in seconds, but resolution goes to milliseconds.
-                    # Floats are a pain in the proverbials.
-                    # We infer the samplerate based on the ndigits after decimal,
-                    # and then set the final samplerate based on max of such ndigits for all.
-                    # The reolving is done below.
-                    # Biggest assumption is that s and e are in seconds.
-                    # Easy bad case is s and e ending with zeros after decimal.
-                    s = s.split('.')
-                    e = e.split('.')
-                    decimultiplier.append(tuple(map(len, (s[1], e[1]))))  # pylint: disable=bad-builtin
-                    starts.append(tuple(map(int, s)))  # pylint: disable=bad-builtin
-                    ends.append(tuple(map(int, e)))  # pylint: disable=bad-builtin
-
-                    spk = spk.strip()
-                    if spk.upper() == 'A':
-                        trans.append(Transcription(0, row[1].strip()))
-                    elif spk.upper() == 'B':
-                        trans.append(Transcription(1, row[1].strip()))
-                    else:
-                        raise ValueError(
-                            "Speaker channel other than A and B ({}) in file\n{}".format(
-                                spk, filepath
-                            )
-                        )
-
-        # resolve the final samplerate
-        # we don't have to do lowest_common_multiple cuz it is only powers of 10
-        starts = np.array(starts)
-        ends = np.array(ends)
-        decimultiplier = np.array(decimultiplier)
-
-        samplerate = 10**(np.max(decimultiplier))
-        decimultiplier = 10**(np.max(decimultiplier) - decimultiplier)
-
-        starts = starts[:, 0] * samplerate + starts[:, 1] * decimultiplier[:, 0]
-        ends = ends[:, 0] * samplerate + ends[:, 1] * decimultiplier[:, 1]
+        trans = [Transcription(ch, c) for ch, c in zip(channels.tolist(), contents)]
 
         return cls(
             filepath,
@@ -308,7 +421,7 @@ class Annotations(lu.SequenceLabels):
 class ActiveSpeakers(lu.ContiguousSequenceLabels):
     # PARENT'S SLOTS
     # __slots__ = ('_starts_ends', 'labels', '_orig_samplerate', '_samplerate',
-    #              '_minstart_at_orig_sr', )
+    #              '_minstart_at_orig_sr', '_flat_index', )
     __slots__ = ('sourcefile', 'calldata')
 
     def __init__(self, filepath, calldata, *args, **kwargs):
@@ -341,20 +454,13 @@ class ActiveSpeakers(lu.ContiguousSequenceLabels):
 
     @classmethod
     def from_annotations(cls, ann, warn_duplicates=True):
-        starts_ends, labels_idx = ann._flattened_indices()  # pylint: disable=protected-access
-
         # make contigious array of shape (total_duration, n_speakers)
         # NOTE: n_speakers is 2 for all Fisher data
+        # duplicate annots for the same speaker add up, and are caught below
         n_speakers = 2
-        labels = np.zeros(shape=(len(starts_ends), n_speakers), dtype=np.int)
-        for i, lix in enumerate(labels_idx):
-            if len(lix) == 1:
-                labels[i, ann.labels[lix[0]].speakerchannel] += 1
-            elif len(lix) > 1:
-                # for loop outside cuz there may be duplicate annots for the same speaker
-                # inline for loop will lead to numpy not incrementing for duplicates
-                for labelidx in lix:
-                    labels[i, ann.labels[labelidx].speakerchannel] += 1
+        channels = np.array([l.speakerchannel for l in ann.labels], dtype=np.int)
+        starts_ends, labels = ann._flattened_sums(  # pylint: disable=protected-access
+            np.eye(n_speakers, dtype=np.int)[channels])
 
         if labels.max() > 1:
             labels[labels > 1] = 1
@@ -380,6 +486,22 @@ class ActiveSpeakers(lu.ContiguousSequenceLabels):
         ann = Annotations.from_file(filepath, allcalldata)
         return cls.from_annotations(ann, warn_duplicates=warn_duplicates)
 
+    @classmethod
+    def from_files(cls, filepaths, allcalldata=None, warn_duplicates=True, processes=None):
+        """ `from_file` for each of `filepaths`, in a pool of `processes`.
+
+        Pass `allcalldata` as the filepath to it, to avoid sending all of it to each process.
+        Check `corpus.load_corpus_values` for how the errors are raised.
+        """
+        return load_corpus_values(
+            filepaths,
+            cls,
+            workers=processes,
+            chunksize=16,
+            allcalldata=allcalldata,
+            warn_duplicates=warn_duplicates,
+        )
+
     def __str__(self):
         s = "Source filepath:\n{}\n".format(self.sourcefile)
         s += "\nCalldata:\n{}\n".format(self.calldata)
@@ -25,6 +25,7 @@ import h5py as h
 from ..utils import label_utils as lu
 from ..utils.py_utils import BaseSlotsOnlyClass
 from ..utils import h5_utils as hu
+from .corpus import load_corpus_values
 
 samples_for_labelsat = lu.samples_for_labelsat  # pylint: disable=invalid-name
 times_for_labelsat = lu.times_for_labelsat  # pylint: disable=invalid-name
@@ -51,7 +52,7 @@ class Transcription(BaseSlotsOnlyClass):  # pylint: disable=too-few-public-metho
 class Annotations(lu.SequenceLabels):
     # PARENT'S SLOTS
     # __slots__ = ('_starts_ends', 'labels', '_orig_samplerate', '_samplerate',
-    #              '_minstart_at_orig_sr', )
+    #              '_minstart_at_orig_sr', '_flat_index', )
     __slots__ = ('sourcefile', 'speakers')
 
     def __init__(self, filepath, speakers, starts_ends, labels, samplerate=1):  # pylint: disable=too-many-arguments
@@ -142,7 +143,7 @@ class Annotations(lu.SequenceLabels):
 class ActiveSpeakers(lu.ContiguousSequenceLabels):
     # PARENT'S SLOTS
     # __slots__ = ('_starts_ends', 'labels', '_orig_samplerate', '_samplerate',
-    #              '_minstart_at_orig_sr', )
+    #              '_minstart_at_orig_sr', '_flat_index', )
     __slots__ = ('sourcefile', 'speakers')
 
     def __init__(self, filepath, speakers, starts_ends, labels, samplerate=1):  # pylint: disable=too-many-arguments
@@ -152,16 +153,12 @@ class ActiveSpeakers(lu.ContiguousSequenceLabels):
 
     @classmethod
     def from_annotations(cls, ann, warn_duplicates=True):
-        starts_ends, labels_idx = ann._flattened_indices()  # pylint: disable=protected-access
-
+        # one row per annotation, with 1 at its speaker, and summed up per flattened segment
+        # duplicate annots for the same speaker add up, and are caught below
         spks = np.array([s.speakerid for s in ann.speakers])
-        labels = np.zeros(shape=(len(starts_ends), len(spks)), dtype=np.int)
-        for i, lix in enumerate(labels_idx):
-            if len(lix) == 1:
-                labels[i] = (spks == ann.labels[lix[0]].speakerid).astype(np.int)
-            elif len(lix) > 1:
-                lspks = np.array([ann.labels[s].speakerid for s in lix])
-                labels[i] = (spks == lspks[:, None]).sum(axis=0)
+        lspks = np.array([l.speakerid for l in ann.labels])
+        starts_ends, labels = ann._flattened_sums(  # pylint: disable=protected-access
+            (lspks[:, None] == spks[None, :]).astype(np.int))
 
         if labels.max() > 1:
             labels[labels > 1] = 1
@@ -192,6 +189,21 @@ class ActiveSpeakers(lu.ContiguousSequenceLabels):
         ann = Annotations.from_file(filepath, **kwargs)
         return cls.from_annotations(ann, warn_duplicates)
 
+    @classmethod
+    def from_files(cls, filepaths, warn_duplicates=True, processes=None, **kwargs):
+        """ `from_file` for each of `filepaths`, in a pool of `processes`.
+
+        Check `corpus.load_corpus_values` for how the errors are raised.
+        """
+        return load_corpus_values(
+            filepaths,
+            cls,
+            workers=processes,
+            chunksize=16,
+            warn_duplicates=warn_duplicates,
+            **kwargs
+        )
+
     def __str__(self):
         s = "Source filepath: {}".format(self.sourcefile)
         s += "\nSpeakers: {}\n".format(len(self.speakers))
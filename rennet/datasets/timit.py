@@ -28,7 +28,7 @@ from ..utils.np_utils import group_by_values
 class Annotations(lu.SequenceLabels):
     # PARENT'S SLOTS
     # __slots__ = ('_starts_ends', 'labels', '_orig_samplerate', '_samplerate',
-    #              '_minstart_at_orig_sr', )
+    #              '_minstart_at_orig_sr', '_flat_index', )
     __slots__ = ('sourcefile', )
 
     def __init__(self, filepath, *args, **kwargs):
@@ -17,10 +17,12 @@
 Created: 18-08-2016
 """
 from __future__ import print_function, division, absolute_import
+import json
 import os
 import warnings
 from collections import namedtuple
 import subprocess as sp
+from tempfile import TemporaryFile
 import numpy as np
 import librosa as lr
 
@@ -55,8 +57,20 @@ def which(executable):
 
     # Returns:
         False or executable: depending on if the executable is accessible
+
+    NOTE: The result is memoised for the current PATH and working directory.
     """
+    key = (executable, os.environ["PATH"], os.getcwd())
+    if key not in WHICH_CACHE:
+        WHICH_CACHE[key] = _which(executable)
+
+    return WHICH_CACHE[key]
+
 
+WHICH_CACHE = dict()  # NOTE: clear it to look for the executables again
+
+
+def _which(executable):
     envdir_list = [os.curdir] + os.environ["PATH"].split(os.pathsep)
 
     for envdir in envdir_list:
@@ -108,6 +122,30 @@ def read_wavefile_metadata(filepath):
     # Reference
         https://github.com/scipy/scipy/blob/master/scipy/io/wavfile.py#L116
 
+    """
+    return _read_wavefile_header(filepath)[0]
+
+
+def _is_riff(filepath):
+    """ Whether the file at `filepath` starts like a (little or big endian) WAV file """
+    with open(filepath, 'rb') as f:
+        return f.read(4) in (b'RIFF', b'RIFX')
+
+
+# numpy dtype of the samples for the (format tag, bits per sample) of WAV files
+# that can be read directly, without a codec
+WAV_DTYPES = {
+    (1, 8): 'u1',  # PCM
+    (1, 16): 'i2',
+    (1, 32): 'i4',
+    (3, 32): 'f4',  # IEEE float
+    (3, 64): 'f8',
+}
+
+
+def _read_wavefile_header(filepath):  # pylint: disable=too-many-locals
+    """ AudioMetadata of the WAV file, along with the offset in bytes to its data, and
+    the numpy dtype of its samples (`None` if they can't be read directly).
     """
     import struct
     from scipy.io.wavfile import _read_riff_chunk, _read_fmt_chunk
@@ -126,16 +164,18 @@ def read_wavefile_metadata(filepath):
         return size // (bits // 8)  # indicates total number of samples
 
     try:
-        size, is_big_endian = _read_riff_chunk(fid)
+        # NOTE: newer versions of scipy also return whether it is an RF64 file
+        size, is_big_endian = _read_riff_chunk(fid)[:2]
 
         while fid.tell() < size:
             chunk = fid.read(4)
             if chunk == b'fmt ':
                 fmt_chunk = _read_fmt_chunk(fid, is_big_endian)
-                channels, samplerate = fmt_chunk[2:4]  # info relevant to us
+                format_tag, channels, samplerate = fmt_chunk[1:4]  # info relevant to us
                 bits = fmt_chunk[6]
             elif chunk == b'data':
                 n_samples = _read_n_samples(fid, is_big_endian, bits)
+                offset = fid.tell()
                 break  # NOTE: break as now we have all info we need
             elif chunk in (b'JUNK', b'Fake', b'LIST', b'fact'):
                 _skip_unknown_chunk(fid, is_big_endian)
@@ -147,7 +187,11 @@ def read_wavefile_metadata(filepath):
     finally:  # always close
         fid.close()
 
-    return AudioMetadata(
+    dtype = WAV_DTYPES.get((format_tag, bits), None)
+    if dtype is not None:
+        dtype = np.dtype(dtype).newbyteorder('>' if is_big_endian else '<')
+
+    meta = AudioMetadata(
         filepath=filepath,
         format='wav',
         samplerate=samplerate,
@@ -155,6 +199,7 @@ def read_wavefile_metadata(filepath):
         seconds=(n_samples // channels) / samplerate,
         nsamples=n_samples // channels  # for one channel
     )
+    return meta, offset, dtype
 
 
 def read_sph_metadata(filepath):
@@ -163,6 +208,27 @@ def read_sph_metadata(filepath):
     NOTE: Tested and developed specifically for the Fisher Dataset
     """
     filepath = os.path.abspath(filepath)
+    _, fields = _read_sph_header(filepath)
+
+    nsamples, nchannels, samplerate = (
+        fields.get(info, None) for info in [b'sample_count', b'channel_count', b'sample_rate']
+    )
+
+    if any(x is None for x in [nsamples, nchannels, samplerate]):
+        raise RuntimeError("The Sphere header was read, but some information was missing")
+    else:
+        return AudioMetadata(
+            filepath=filepath,
+            format='sph',
+            samplerate=int(samplerate),
+            nchannels=int(nchannels),
+            seconds=int(nsamples) / int(samplerate),
+            nsamples=int(nsamples)
+        )
+
+
+def _read_sph_header(filepath):
+    """ Size in bytes of the header of the SPHERE file, and the (bytes) values in it """
     fid = open(filepath, 'rb')
 
     try:
@@ -180,39 +246,96 @@ def read_sph_metadata(filepath):
         fid.seek(0)
         # Each info is on different lines (per dox)
         readlines = fid.read(_header_size).split(b'\n')
-
-        # Start reading relevant metadata
-        nsamples = None
-        nchannels = None
-        samplerate = None
-
-        for line in readlines:
-            splitline = line.split(b' ')
-            info, data = splitline[0], splitline[-1]
-
-            if info == b'sample_count':
-                nsamples = int(data)
-            elif info == b'channel_count':
-                nchannels = int(data)
-            elif info == b'sample_rate':
-                samplerate = int(data)
-            else:
-                continue
     finally:
         fid.close()
 
-    if any(x is None for x in [nsamples, nchannels, samplerate]):
-        raise RuntimeError("The Sphere header was read, but some information was missing")
+    fields = dict()
+    for line in readlines:
+        splitline = line.split(b' ')
+        info, data = splitline[0], splitline[-1]
+        if info and info != b'end_head':
+            fields[info] = data
+
+    return _header_size, fields
+
+
+def _ulaw_to_pcm_table():
+    """ int16 PCM value for each of the 256 G.711 mu-law encoded bytes """
+    ulaw = ~np.arange(256, dtype=np.uint8)
+    exponent = (ulaw >> 4) & 0x07
+    mantissa = (ulaw & 0x0F).astype(np.int16)
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(ulaw & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+ULAW_TO_PCM = _ulaw_to_pcm_table()
+
+
+def _memmap_sph(filepath):
+    """ memmap of the raw samples in a SPHERE file, of shape (nsamples, nchannels),
+    along with its AudioMetadata, and the function to convert its samples to int16.
+
+    Raises ValueError for the encodings that are not supported, e.g. shorten compressed.
+    """
+    meta = read_sph_metadata(filepath)
+    header_size, fields = _read_sph_header(filepath)
+    coding = fields.get(b'sample_coding', b'pcm')
+    nbytes = int(fields.get(b'sample_n_bytes', 2))
+    byteformat = fields.get(b'sample_byte_format', b'01')
+
+    if coding == b'ulaw' and nbytes == 1:
+        dtype, decode = np.uint8, ULAW_TO_PCM.take
+    elif coding == b'pcm' and nbytes == 2 and byteformat in (b'01', b'10'):
+        dtype, decode = np.dtype('<i2' if byteformat == b'01' else '>i2'), _to_native_int16
     else:
-        return AudioMetadata(
-            filepath=filepath,
-            format='sph',
-            samplerate=samplerate,
-            nchannels=nchannels,
-            seconds=nsamples / samplerate,
-            nsamples=nsamples
+        raise ValueError(
+            "Reading SPHERE files with sample_coding {!r} and {} bytes per sample is not "
+            "supported, found in file {}".format(coding, nbytes, filepath)
+        )
+
+    if fields.get(b'channels_interleaved', b'TRUE') != b'TRUE' and meta.nchannels > 1:
+        raise ValueError(
+            "Reading SPHERE files with non-interleaved channels is not supported, "
+            "found in file {}".format(filepath)
         )
 
+    data = np.memmap(
+        filepath,
+        dtype=dtype,
+        mode='r',
+        offset=header_size,
+        shape=(meta.nsamples, meta.nchannels),
+    )
+    return data, meta, decode
+
+
+def _to_native_int16(samples):
+    if samples.dtype.isnative:
+        return samples
+
+    return samples.astype(np.int16)
+
+
+def read_sph(filepath):
+    """ Read the samples in a SPHERE file with PCM or mu-law (ulaw) encoded samples,
+    without converting it to a WAV file first, e.g. with `sph2pipe`.
+
+    NOTE: Tested and developed specifically for the Fisher Dataset
+
+    # Arguments
+        filepath: str: path to the SPHERE file
+
+    # Returns
+        data: numpy array: of int16 samples of shape (nsamples x nchannels).
+            It is the read-only memmap of the file for little-endian PCM samples.
+        samplerate: int
+
+    # Raises
+        ValueError: for other encodings, e.g. shorten compressed ones.
+    """
+    data, meta, decode = _memmap_sph(filepath)
+    return decode(data), meta.samplerate
+
 
 def read_audio_metadata_codec(filepath):  # pylint: disable=too-complex
     """Read metadata of audio using a codec
@@ -368,21 +491,443 @@ def get_audio_metadata(filepath):
             )
 
 
-def load_audio(filepath, samplerate=8000, mono=True, return_samplerate=False, **kwargs):
+class AudioMetadataCache(object):
+    """ Cache of the AudioMetadata of files, keyed by their absolute path, and used only
+    while their size and modification time are the same.
+
+    If `filepath` is given, the cache is loaded from, and saved to it as JSON, so that it
+    persists, e.g. as a sidecar to a directory of media files. Else, it is only kept in
+    memory.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self._entries = None  # loaded when first required
+        self._changed = False
+
+    def _loaded(self):
+        if self._entries is None:
+            self._entries = dict()
+            if self.filepath is not None and os.path.exists(self.filepath):
+                with open(self.filepath, 'r') as f:
+                    self._entries = json.load(f)
+
+        return self._entries
+
+    @staticmethod
+    def _stat(filepath):
+        st = os.stat(filepath)
+        return [st.st_size, st.st_mtime]
+
+    def get(self, filepath):
+        """ The cached AudioMetadata for `filepath`, or `None` if not, or out-of-date. """
+        entry = self._loaded().get(os.path.abspath(filepath), None)
+        try:
+            if entry is None or entry['stat'] != self._stat(filepath):
+                return None
+        except (IOError, OSError):  # pylint: disable=overlapping-except
+            return None
+
+        # NOTE: keep the filepath as it would have been given by get_audio_metadata
+        meta = entry['meta']
+        return AudioMetadata(
+            filepath=os.path.abspath(filepath) if entry['abspath'] else filepath, **meta
+        )
+
+    def put(self, filepath, meta):
+        meta = meta._asdict()
+        self._loaded()[os.path.abspath(filepath)] = {
+            'stat': self._stat(filepath),
+            'abspath': meta.pop('filepath') != filepath,
+            'meta': meta,
+        }
+        self._changed = True
+
+    def save(self):
+        """ Save the cache to `filepath`, if there is one, and there were changes. """
+        if self.filepath is None or not self._changed:
+            return
+
+        # write atomically, in case another process is reading it
+        tmp = "{}.{}.tmp".format(self.filepath, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f)
+
+        os.rename(tmp, self.filepath)
+        self._changed = False
+
+
+AUDIO_METADATA_CACHE = AudioMetadataCache()  # NOTE: in memory, for this process
+
+
+def _probe_audio_metadata(filepath):
+    try:
+        return get_audio_metadata(filepath), None
+    except Exception as e:  # pylint: disable=broad-except
+        return None, e
+
+
+def get_audio_metadata_batch(filepaths, cache=None, workers=8):
+    """ Get the metadata for many audio files, probing the ones not in `cache` concurrently.
+
+    For formats other than WAV and SPH, `get_audio_metadata` starts a process of FFMPEG
+    or AVCONV for each file, hence, at most `workers` of them are run at a time.
+
+    # Arguments
+        filepaths: list of str: paths to the audio files
+        cache: AudioMetadataCache, or path to its JSON file, or None: to use the one in
+            memory for this process, `AUDIO_METADATA_CACHE`.
+        workers: int: number of files to be probed at a time.
+
+    # Returns
+        metadatas: list of AudioMetadata: in the same order as `filepaths`,
+            with `None` for the files that failed, after raising a RuntimeWarning for each
+    """
+    from multiprocessing.pool import ThreadPool
+
+    if cache is None:
+        cache = AUDIO_METADATA_CACHE
+    elif not isinstance(cache, AudioMetadataCache):
+        cache = AudioMetadataCache(cache)
+
+    metadatas = [cache.get(filepath) for filepath in filepaths]
+    uncached = [i for i, meta in enumerate(metadatas) if meta is None]
+    if not uncached:
+        return metadatas
+
+    if workers == 1 or len(uncached) == 1:
+        probed = [_probe_audio_metadata(filepaths[i]) for i in uncached]
+    else:
+        # NOTE: threads are enough, most of the time is spent waiting for the codec
+        pool = ThreadPool(min(workers, len(uncached)))
+        try:
+            probed = pool.map(_probe_audio_metadata, [filepaths[i] for i in uncached])
+        finally:
+            pool.close()
+            pool.join()
+
+    for i, (meta, error) in zip(uncached, probed):
+        if error is not None:
+            warnings.warn(
+                "Failed to read metadata of {} with error:\n{!r}".format(filepaths[i], error),
+                RuntimeWarning
+            )
+        else:
+            cache.put(filepaths[i], meta)
+            metadatas[i] = meta
+
+    cache.save()
+    return metadatas
+
+
+def load_audio(  # pylint: disable=too-many-arguments
+        filepath,
+        samplerate=8000,
+        mono=True,
+        return_samplerate=False,
+        mmap=False,
+        **kwargs):
     """ Load an audio file supported by `librosa.load(...)`.
 
     Extra keyword arguments supported by `librosa.load(...)` are passed on.
     Interesting ones may include `offset`, `duration`, `res_type`. Check references.
 
+    PCM WAV files with 16 bit samples that are already at `samplerate` (or for
+    `samplerate=None`), e.g. the ones from `pydub_utils.convert_to_standard`, are read
+    directly with memory-mapped reads instead, since there is nothing to decode or
+    resample. Only `offset` and `duration` are supported for them, else librosa is used.
+
+    With `mmap=True`, for such files, the read-only `numpy.memmap` of the int16
+    samples in the file is returned as is, without making any copy. They can be
+    converted with `as_float` when required, e.g. in blocks. Mixing down to mono is
+    not possible for them, and `ValueError` is raised for multi-channel files with
+    `mono=True`, or when the file can't be read directly.
+
     References
     ----------
     http://librosa.github.io/librosa/generated/librosa.core.load.html#librosa.core.load
     """
-    data, sr = lr.core.load(filepath, sr=samplerate, mono=mono, **kwargs)
-    data = data.T  # librosa loads data in shape (n, ) or (2, n), which is stupid
+    wav = _read_wavefile_direct(filepath, samplerate, **kwargs)
+    if wav is None:
+        if mmap:
+            raise ValueError(
+                "Only PCM WAV files with 16 bit samples at samplerate {} can be "
+                "memory-mapped, file {} is not one of them".format(samplerate, filepath)
+            )
+
+        data, sr = lr.core.load(filepath, sr=samplerate, mono=mono, **kwargs)
+        data = data.T  # librosa loads data in shape (n, ) or (2, n), which is stupid
+    else:
+        data, sr = wav
+        if mmap and mono and data.shape[1] > 1:
+            raise ValueError(
+                "A memory-mapped file can't be mixed down to mono, pass `mono=False`"
+            )
+        elif mmap:
+            data = data[:, 0] if data.shape[1] == 1 else data
+        else:
+            data = _memmap_as_float(data, mono)
+
     return (data, sr) if return_samplerate else data
 
 
+def as_float(samples):
+    """ Convert the integer (or float) samples of audio to float32 between -1 and 1.
+
+    Same as what librosa does when loading audio.
+    """
+    if samples.dtype.kind == 'f':
+        return samples.astype(np.float32)
+    elif samples.dtype.kind == 'u':
+        return (samples.astype(np.float32) - 128) / 128
+
+    return samples.astype(np.float32) / (1 << (8 * samples.dtype.itemsize - 1))
+
+
+def _memmap_wavefile(filepath, meta, offset, dtype):
+    """ Read-only memmap of the samples of the WAV file, of shape (nsamples, nchannels) """
+    # NOTE: nsamples may be wrong in the header if the file was written to a pipe
+    nframes = (os.path.getsize(filepath) - offset) // (dtype.itemsize * meta.nchannels)
+    return np.memmap(
+        filepath,
+        dtype=dtype,
+        mode='r',
+        offset=offset,
+        shape=(min(nframes, meta.nsamples), meta.nchannels),
+    )
+
+
+def _read_wavefile_direct(filepath, samplerate, offset=0.0, duration=None, **kwargs):
+    """ (memmap, samplerate) for the part of a 16 bit PCM WAV file at `samplerate`
+    from `offset` for `duration` seconds, or `None` if it should be read with librosa.
+
+    The samples are picked the same way as librosa does.
+    """
+    kwargs.pop('res_type', None)  # nothing to resample
+    if kwargs:
+        return None
+
+    if not _is_riff(filepath):
+        return None
+
+    meta, dataoffset, dtype = _read_wavefile_header(filepath)
+    if dtype is None or dtype.itemsize != 2 or samplerate not in (None, meta.samplerate):
+        return None
+
+    data = _memmap_wavefile(filepath, meta, dataoffset, dtype)
+    start = int(np.round(meta.samplerate * offset))
+    end = None if duration is None else start + int(np.round(meta.samplerate * duration))
+    return data[start:end], meta.samplerate
+
+
+def _memmap_as_float(data, mono, blocksize=1 << 16):
+    """ float32 samples for the memmap `data`, converted in blocks of `blocksize`. """
+    if mono or data.shape[1] == 1:
+        res = np.empty(len(data), dtype=np.float32)
+    else:
+        res = np.empty(data.shape, dtype=np.float32)
+
+    for i in range(0, len(data), blocksize):
+        block = as_float(data[i:i + blocksize])
+        res[i:i + blocksize] = block.mean(axis=1) if res.ndim == 1 else block
+
+    return res
+
+
+def iter_audio_blocks(filepath, blocksize, overlap=0, samplerate=None, mono=True):
+    """ Yield the audio in `filepath` in blocks of `blocksize` samples, each
+    overlapping with the previous one by `overlap` samples.
+
+    Only one block is kept in memory at a time, so that even hours long recordings
+    can be processed in constant memory, e.g. for extracting spectrograms of frames
+    of length `win_len` and hop `hop_len`, by setting `overlap = win_len - hop_len`.
+
+    WAV files with PCM or float samples, and SPHERE files with PCM or mu-law samples,
+    are read directly, with memory-mapped reads, when they are already at `samplerate`.
+    Other files, e.g. compressed ones, are decoded in a pipe by `sph2pipe` for SPH files
+    at their own samplerate, else by FFMPEG or AVCONV, also resampling them to
+    `samplerate`.
+
+    Parameters
+    ----------
+    filepath: str
+    blocksize: int
+        Number of samples in each block. The last block may have fewer samples.
+    overlap: int
+        Number of samples that each block shares with the previous one.
+        Should be less than `blocksize`.
+    samplerate: int or None
+        Samplerate to read the audio at, `None` for the samplerate of the file.
+    mono: bool
+        Whether to mix the channels down to one by taking their mean.
+
+    Yields
+    ------
+    block: numpy.ndarray
+        of float32 samples between -1 and 1, of shape (n, ) if `mono` is `True`, else
+        of shape (n, nchannels), as with `load_audio`.
+    """
+    if not 0 <= overlap < blocksize:
+        raise ValueError(
+            "overlap should be in [0, blocksize), found {} for blocksize {}".format(
+                overlap, blocksize
+            )
+        )
+
+    memmapped = _memmap_direct(filepath, samplerate)
+    if memmapped is not None:
+        blocks = _iter_memmap_blocks(memmapped[0], memmapped[1], blocksize, overlap)
+    else:
+        blocks = _iter_pipe_blocks(_decoder_command(filepath, samplerate), blocksize, overlap)
+
+    for block in blocks:
+        yield block.mean(axis=1) if mono else block
+
+
+def _iter_blocks(read, blocksize, overlap):
+    """ Blocks from frames (samples for all channels) returned by `read(n)`, until empty. """
+    hop = blocksize - overlap
+    block = as_float(read(blocksize))
+    while len(block) > 0:  # pylint: disable=len-as-condition
+        yield block
+
+        if len(block) < blocksize:
+            break
+
+        # only if there is something new after the previous block
+        frames = as_float(read(hop))
+        if len(frames) == 0:  # pylint: disable=len-as-condition
+            break
+
+        block = np.concatenate([block[hop:], frames])
+
+
+def _memmap_direct(filepath, samplerate):
+    """ memmap of the samples in a WAV or SPHERE file that can be read directly at
+    `samplerate`, along with the function to convert them to numbers, else `None`.
+    """
+    if filepath.lower().endswith('sph'):
+        try:
+            data, meta, decode = _memmap_sph(filepath)
+        except ValueError:
+            # an unsupported encoding, e.g. shorten compressed
+            return None
+    elif _is_riff(filepath):
+        meta, offset, dtype = _read_wavefile_header(filepath)
+        if dtype is None:
+            return None
+
+        data, decode = _memmap_wavefile(filepath, meta, offset, dtype), np.asarray
+    else:
+        return None
+
+    return (data, decode) if samplerate in (None, meta.samplerate) else None
+
+
+def _iter_memmap_blocks(data, decode, blocksize, overlap):
+    at = [0]
+
+    def _read(n):
+        frames = decode(data[at[0]:at[0] + n])
+        at[0] += n
+        return frames
+
+    for block in _iter_blocks(_read, blocksize, overlap):
+        yield block
+
+
+def _decoder_command(filepath, samplerate):
+    """ Command to decode `filepath` as WAV into stdout, at `samplerate` """
+    if filepath.lower().endswith('sph') and get_sph2pipe():
+        if samplerate in (None, read_sph_metadata(filepath).samplerate):
+            return [get_sph2pipe(), "-p", "-f", "riff", filepath]
+
+    if not get_codec():
+        raise RuntimeError(
+            "Neither FFMPEG or AVCONV was found to decode file %s" % filepath
+        )
+
+    command = [CODEC_EXEC, "-v", "error", "-i", filepath, "-f", "wav", "-acodec", "pcm_s16le"]
+    if samplerate is not None:
+        command.extend(["-ar", str(samplerate)])
+
+    return command + ["-"]
+
+
+def _read_wav_stream_header(fid):
+    """ nchannels and dtype of the samples of the WAV stream in `fid`, leaving it at the
+    start of the data, or `None` if it was not a WAV stream that can be read directly.
+
+    NOTE: The sizes in the header are ignored, since they are not known when writing
+    to a pipe.
+    """
+    import struct
+
+    riff = fid.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:] != b'WAVE':
+        return None
+
+    fmt = None
+    while True:
+        chunk = fid.read(8)
+        if len(chunk) < 8:
+            return None
+
+        name, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if name == b'data':
+            break
+
+        body = fid.read(size + size % 2)  # chunks are padded to even sizes
+        if name == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', body[:16])
+            if fmt[0] == 0xFFFE and len(body) >= 26:  # WAVE_FORMAT_EXTENSIBLE
+                fmt = struct.unpack('<H', body[24:26]) + fmt[1:]
+
+    if fmt is None or (fmt[0], fmt[-1]) not in WAV_DTYPES:
+        return None
+
+    return fmt[1], np.dtype(WAV_DTYPES[(fmt[0], fmt[-1])]).newbyteorder('<')
+
+
+def _iter_pipe_blocks(command, blocksize, overlap):
+    """ Blocks from the WAV stream written to stdout by `command`, while it is running.
+
+    The process is killed if the blocks are not read till the end.
+    """
+    # NOTE: stderr goes to a file, since the decoder blocks on a full pipe for it,
+    # e.g. with many errors for a corrupt input, while stdout is still being read.
+    errfile = TemporaryFile()
+    proc = sp.Popen(command, stdout=sp.PIPE, stderr=errfile, stdin=DEVNULL)
+    try:
+        header = _read_wav_stream_header(proc.stdout)
+        if header is not None:
+            nchannels, dtype = header
+            framesize = nchannels * dtype.itemsize
+
+            def _read(n):
+                buf = proc.stdout.read(n * framesize)
+                buf = buf[:len(buf) // framesize * framesize]  # only complete frames
+                return np.frombuffer(buf, dtype=dtype).reshape(-1, nchannels)
+
+            for block in _iter_blocks(_read, blocksize, overlap):
+                yield block
+
+        if proc.wait() != 0 or header is None:
+            errfile.seek(0)
+            raise RuntimeError(
+                "Decoding with {} failed with:\n{}\n{}".format(
+                    command[0], proc.returncode, errfile.read()
+                )
+            )
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+        proc.stdout.close()
+        proc.wait()
+        errfile.close()
+
+
 def powspectrogram(y, n_fft, hop_len, win_len=None, window='hann'):
     return np.abs(
         lr.stft(
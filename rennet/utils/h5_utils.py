@@ -17,7 +17,16 @@
 Created: Mon, 10-Apr-2017
 """
 from __future__ import print_function, division, absolute_import
-from collections import namedtuple, Iterable
+import os
+import atexit
+from collections import namedtuple, Iterable, OrderedDict, deque
+from functools import partial
+from hashlib import sha1
+from itertools import chain, cycle
+from multiprocessing import Array, Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from types import GeneratorType
 from warnings import warn as warning
 from six.moves import zip, range
 import numpy as np
@@ -25,6 +34,7 @@ import numpy.random as nr
 import h5py as h
 
 from . import np_utils as nu
+from .py_utils import makedirs_with_existok
 
 Chunking = namedtuple('Chunking', [
     'datapath',
@@ -33,6 +43,200 @@ Chunking = namedtuple('Chunking', [
     'labelslice',
 ])
 
+# FILE-HANDLES ##################################################### FILE-HANDLES #
+
+
+class H5FileHandlesPool(object):
+    """ Per-process pool of read-only HDF5 file handles.
+
+    Opening an HDF5 file has to parse its superblock, metadata and B-trees, which
+    adds up quickly when the same file is opened for every chunk being read.
+    The pool instead opens each file lazily on first use, and then keeps the handle
+    open for later reads.
+
+    Handles are keyed on the absolute filepath and the raw-data chunk cache settings
+    (`rdcc_nbytes`, `rdcc_nslots`, `rdcc_w0`) used to open it, since HDF5 only
+    accepts these settings when opening the file.
+
+    NOTE: HDF5 handles are not safe to share across processes. If the pool finds
+    itself in a different process than the one that opened the handles
+    (e.g. a forked worker), the inherited handles are forgotten and the files are
+    re-opened in the new process on their next use.
+
+    NOTE: Setting the chunk-cache requires `h5py >= 2.9`.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = Lock()
+        self._handles = dict()
+
+    def _maybe_reset_after_fork(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # Inherited from parent process. Don't close them, just forget them.
+            # The parent, if still alive, owns these handles.
+            self._pid = pid
+            self._lock = Lock()
+            self._handles = dict()
+
+    @staticmethod
+    def _key(filepath, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None):
+        return (os.path.abspath(filepath), rdcc_nbytes, rdcc_nslots, rdcc_w0)
+
+    def get(self, filepath, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None):
+        """ Get an open read-only `h5py.File` for `filepath`, opening it if necessary.
+
+        The chunk-cache settings, when `None`, are left to HDF5's defaults.
+        """
+        self._maybe_reset_after_fork()
+        key = self._key(filepath, rdcc_nbytes, rdcc_nslots, rdcc_w0)
+
+        with self._lock:
+            f = self._handles.get(key, None)
+            if f is None or not f.id.valid:  # never opened, or closed externally
+                rdcc = {
+                    k: v
+                    for k, v in zip(('rdcc_nbytes', 'rdcc_nslots', 'rdcc_w0'), key[1:])
+                    if v is not None
+                }
+                f = h.File(key[0], 'r', **rdcc)
+                self._handles[key] = f
+
+        return f
+
+    def close(self, filepath=None):
+        """ Close all the pooled handles for `filepath`, or all the handles if `None`. """
+        self._maybe_reset_after_fork()
+        if filepath is not None:
+            filepath = os.path.abspath(filepath)
+
+        with self._lock:
+            keys = [k for k in self._handles if filepath is None or k[0] == filepath]
+            for k in keys:
+                f = self._handles.pop(k)
+                if f.id.valid:
+                    f.close()
+
+    def __contains__(self, filepath):
+        self._maybe_reset_after_fork()
+        filepath = os.path.abspath(filepath)
+        return any(k[0] == filepath for k in self._handles)
+
+    def __len__(self):
+        self._maybe_reset_after_fork()
+        return len(self._handles)
+
+
+H5_FILE_HANDLES = H5FileHandlesPool()
+atexit.register(H5_FILE_HANDLES.close)
+
+
+# PREPPED CACHE ################################################### PREPPED CACHE #
+
+
+class PreppedChunksCache(object):
+    """ In-memory (or memmapped) LRU cache for the prepped data and label of chunks.
+
+    The inputs providers re-read and re-prep every chunk in every pass (and the
+    validation ones in every epoch), which can be avoided by keeping the prepped
+    arrays around, upto a budget of `max_nbytes`.
+
+    When `memmap_dir` is given, the arrays are saved there as `.npy` files,
+    and are read back memmapped, hence, the budget is then on the disk space used.
+    The files are removed when evicted, or when the cache is cleared.
+
+    The cached arrays are read-only, so that they are not changed in-place by mistake.
+
+    NOTE: The cache is per-process, and is not shared with prefetching worker processes.
+    """
+
+    def __init__(self, max_nbytes, memmap_dir=None):
+        assert max_nbytes >= 0, "max_nbytes should be >= 0, v/s {}".format(max_nbytes)
+        self.max_nbytes = max_nbytes
+        self.memmap_dir = memmap_dir
+        if memmap_dir is not None:
+            makedirs_with_existok(memmap_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+        self._entries = OrderedDict()  # key: (arrays, nbytes), least recently used first
+        self._lock = Lock()
+
+    def _memmap_paths(self, key, narrays):
+        if self.memmap_dir is None:
+            return [None] * narrays
+
+        name = sha1(repr(key).encode('utf-8')).hexdigest()
+        return [
+            os.path.join(self.memmap_dir, "{}.{}.npy".format(name, i))
+            for i in range(narrays)
+        ]
+
+    def _evict(self, key):
+        arrays, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+        for path in self._memmap_paths(key, len(arrays)):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def get(self, key):
+        """ The cached arrays for `key`, or None if not cached (a miss). """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, arrays):
+        """ Cache `arrays` for `key` if they fit in the budget, evicting the least
+        recently used ones as necessary.
+
+        Returns the cached (read-only) arrays, or `arrays` as is if they don't fit.
+        """
+        nbytes = sum(a.nbytes for a in arrays)
+        if nbytes > self.max_nbytes:
+            return arrays
+
+        cached = []
+        for a, path in zip(arrays, self._memmap_paths(key, len(arrays))):
+            if self.memmap_dir is not None and a.size > 0:  # empty ones can't be mmapped
+                np.save(path, a)
+                cached.append(np.load(path, mmap_mode='r'))
+            else:
+                a = a if a.base is None else a.copy()  # don't keep any larger base alive
+                a.flags.writeable = False
+                cached.append(a)
+
+        cached = tuple(cached)
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+            while self._entries and self.nbytes + nbytes > self.max_nbytes:
+                self._evict(next(iter(self._entries)))
+
+            self._entries[key] = (cached, nbytes)
+            self.nbytes += nbytes
+
+        return cached
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._evict(next(iter(self._entries)))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
 
 # IDEA: Move all logic for reading from hdf5 to h5 chunking reader.
 # Then, any other chunking reader, for example one working with csv, can be implemented
@@ -97,18 +301,41 @@ class BaseH5ChunkPrepper(object):
     and to carry out some of the computations that are actually not specilized.
     """
 
-    def __init__(self, filepath, **kwargs):  # pylint: disable=unused-argument
+    def __init__(  # pylint: disable=unused-argument
+            self, filepath, rdcc_nbytes=None, rdcc_nslots=None, **kwargs):
         self.filepath = filepath
 
+        # raw-data chunk cache settings for opening the HDF5 file, None for defaults
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+
+    def h5file(self):
+        """ The open, read-only HDF5 file, from the per-process `H5_FILE_HANDLES` pool.
+
+        The file is opened only on first use, and is kept open for later reads,
+        until `close_h5file` is called.
+        """
+        return H5_FILE_HANDLES.get(
+            self.filepath,
+            rdcc_nbytes=getattr(self, 'rdcc_nbytes', None),
+            rdcc_nslots=getattr(self, 'rdcc_nslots', None),
+        )
+
+    def close_h5file(self):
+        """ Close the pooled handles to the HDF5 file.
+
+        NOTE: The handles are shared with every other user of the same file in this process.
+        """
+        H5_FILE_HANDLES.close(self.filepath)
+
     def read_h5_data_label_chunk(self, chunking, only_labels=False, **kwargs):  # pylint: disable=unused-argument
         """ Read the data and label chunks from the HDF5 file. """
-
-        with h.File(self.filepath, 'r') as f:
-            label = f[chunking.labelpath][chunking.labelslice]
-            if not only_labels:
-                data = f[chunking.datapath][chunking.dataslice]
-            else:
-                data = np.empty_like(label)
+        f = self.h5file()
+        label = f[chunking.labelpath][chunking.labelslice]
+        if not only_labels:
+            data = f[chunking.datapath][chunking.dataslice]
+        else:
+            data = np.empty_like(label)
 
         return data, label
 
@@ -269,11 +496,39 @@ class BaseChunkMeanVarianceNormalizer(BaseDataNormalizer):  # pylint: disable=ab
 # INPUTS PROVIDERS ######################################### INPUTS PROVIDERS #
 
 
+def _qualified_name(fn):
+    """ `module.qualname` of the callable `fn`, or None if it doesn't name `fn` alone """
+    name = getattr(fn, '__qualname__', getattr(fn, '__name__', None))
+    module = getattr(fn, '__module__', None)
+    if name is None or module is None or '<' in name:  # e.g. <lambda>, or <locals>
+        return None
+
+    return "{}.{}".format(module, name)
+
+
 class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint: disable=abstract-method
-    def __init__(self, filepath, shuffle_seed=None, npasses=1, **kwargs):
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            filepath,
+            shuffle_seed=None,
+            npasses=1,
+            rdcc_nbytes=None,
+            rdcc_nslots=None,
+            prepped_cache=None,
+            **kwargs):
         assert npasses >= 1, "npasses should be >= 1, v/s {}".format(npasses)
         self.npasses = npasses
 
+        # PreppedChunksCache to keep prepped data and labels of chunks across passes.
+        # It can be shared with other providers, since the keys include the config.
+        self.prepped_cache = prepped_cache
+
+        # NOTE: BaseH5ChunkingsReader.__init__ does not call BaseH5ChunkPrepper.__init__
+        # raw-data chunk cache settings for the HDF5 file, None for defaults.
+        # Set rdcc_nbytes to fit the chunks of a pass to hit memory on later passes.
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+
         assert shuffle_seed is None or isinstance(shuffle_seed, (int, np.int_)),\
                 ("shuffle_seed should be either None (no shuffling)"
                  " or an integer, v/s {}".format(shuffle_seed))
@@ -311,24 +566,74 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
     def steps_per_pass(self):
         return self.nchunks
 
+    def prepped_cache_key(self, chunking, only_labels=False, **kwargs):
+        """ Key for the prepped data and label of `chunking` in the `prepped_cache`.
+
+        It includes the source file, the class, and the public attributes of the
+        provider with simple values, as its configuration, along with any `kwargs`.
+        Callable attributes, e.g. `label_from_subcontext_fn`, are keyed by their
+        qualified name, and the key is `None`, i.e. nothing is cached, when any of them
+        has none to tell it apart, e.g. a lambda.
+        Override to add anything else that changes the prepped data or label.
+        """
+        simples = (bool, int, float, np.number, str, tuple, type(None))
+        config = sorted(
+            (k, v) for k, v in vars(self).items()
+            if not k.startswith('_') and isinstance(v, simples)
+        )
+
+        fnames = sorted(
+            (k, _qualified_name(v)) for k, v in vars(self).items()
+            if not k.startswith('_') and callable(v)
+        )
+        if any(n is None for _, n in fnames):
+            return None
+
+        config.extend(fnames)
+        return (
+            os.path.abspath(self.filepath),
+            self.__class__.__name__,
+            repr(chunking),
+            only_labels,
+            repr(config),
+            repr(sorted(kwargs.items())),
+        )
+
+    def get_prepped_data_label(self, chunking, only_labels=False, **kwargs):
+        """ Get the prepped data and label chunks, from the `prepped_cache` if any """
+        sup = super(BaseInputsProvider, self)
+        if self.prepped_cache is None:
+            return sup.get_prepped_data_label(chunking, only_labels=only_labels, **kwargs)
+
+        key = self.prepped_cache_key(chunking, only_labels=only_labels, **kwargs)
+        if key is None:
+            return sup.get_prepped_data_label(chunking, only_labels=only_labels, **kwargs)
+
+        prepped = self.prepped_cache.get(key)
+        if prepped is None:
+            prepped = self.prepped_cache.put(
+                key, sup.get_prepped_data_label(chunking, only_labels=only_labels, **kwargs)
+            )
+
+        return prepped
+
     def _setup_shuffling_seeds(self):
         if self.shuffle_seed is None:
             self._pseeds = (None, ) * self.npasses
             self._corder = (np.arange(self.nchunks), ) * self.npasses
             self._cseeds = ((None, ) * self.nchunks, ) * self.npasses
         else:
+            # NOTE: Each seed gets its own RandomState, instead of reseeding the global
+            # numpy.random, so that the streams are independent of each other, and of
+            # anything else using numpy.random, in any thread.
+            # The results are the same as from reseeding the global one.
             nseeds = self.npasses * (1 + self.nchunks)
-            nr.seed(self.shuffle_seed)
-            seeds = nr.randint(41184535, size=nseeds)
+            seeds = nr.RandomState(self.shuffle_seed).randint(41184535, size=nseeds)
 
             self._pseeds = tuple(seeds[:self.npasses])
-
-            _corder = []
-            for s in self._pseeds:
-                nr.seed(s)
-                _corder.append(nr.permutation(self.nchunks))
-
-            self._corder = tuple(_corder)
+            self._corder = tuple(
+                nr.RandomState(s).permutation(self.nchunks) for s in self._pseeds
+            )
             self._cseeds = nu.totuples(seeds[self.npasses:].reshape((self.npasses, -1)))
 
     def _chunk_order_for_pass(self, p):
@@ -348,8 +653,10 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
         if shuffle_seed is None:
             return arr
         elif isinstance(shuffle_seed, (int, np.int_)):
-            nr.seed(shuffle_seed)
-            nr.shuffle(arr)
+            if not arr.flags.writeable:  # e.g. from the prepped_cache
+                arr = arr.copy()
+
+            nr.RandomState(shuffle_seed).shuffle(arr)
             return arr
         else:
             raise ValueError(
@@ -377,27 +684,118 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
             self.maybe_shuffle_array(label, array_shuffle_seed)
         )
 
-    def flow_for_pass(
-            self, at, starting_chunk_at=0, only_labels=False, with_chunking=False, **kwargs
-    ):  # yapf: disable
-        chunk_order = self._chunk_order_for_pass(at)
-        n_seen_chunks = 0
+    def _chunks_to_flow(self, passes, starting_chunk_at=0, shard=None):
+        """ Generate `(pass, position in pass, chunkidx)` for chunks in the order of flow
+
+        With `shard` as `(k, nshards)`, only every `nshards`-th chunk in the order of
+        each pass is generated, starting at the position `k`.
+        """
+        index = shard if isinstance(shard, SharedShardIndex) else None
+        if index is not None:
+            shard = index.claim()
+
+        k, nshards = (0, 1) if shard is None else shard
         try:
-            for i in range(starting_chunk_at, len(chunk_order)):
-                n_seen_chunks = i
-                chunkidx = chunk_order[i]
-                chunking = self.chunkings[chunkidx]
-                seed = self._seed_for_chunk_in_pass(at, chunkidx)
-
-                inputs = self.get_prepped_inputs(
-                    chunking=chunking,
-                    array_shuffle_seed=seed,
-                    only_labels=only_labels,
-                    **kwargs
+            for p in passes:
+                chunk_order = self._chunk_order_for_pass(p)
+                start = starting_chunk_at + (k - starting_chunk_at) % nshards
+                for i in range(start, len(chunk_order), nshards):
+                    yield p, i, chunk_order[i]
+
+                starting_chunk_at = 0
+        finally:
+            if index is not None:
+                index.release(shard)
+
+    def _prefetching_pool(self, prefetch, prefetch_with='threads'):
+        """ Pool of workers, and the function they will call to prep inputs for a chunk """
+        if prefetch_with == 'threads':
+            # NOTE: the shuffling of each chunk uses its own RandomState(s),
+            # and hence, is the same no matter which thread preps it.
+            return ThreadPool(prefetch), partial(_prepped_inputs_as_list, self)
+        elif prefetch_with == 'processes':
+            return (
+                Pool(prefetch, _set_prefetching_inputs_provider, (self, )),
+                _prepped_inputs_in_worker,
+            )
+        else:
+            raise ValueError(
+                "prefetch_with should be either 'threads' or 'processes', "
+                "v/s {}".format(prefetch_with)
+            )
+
+    def _check_prefetch(self, prefetch):
+        """ Raise if prefetching can't be combined with the config of the provider """
+        if prefetch > 0 and getattr(self, 'batch_buffers', None) is not None:
+            # NOTE: all the steps of the chunks being prefetched are gathered at once,
+            # and would overwrite the ones of earlier chunks still to be consumed.
+            raise ValueError(
+                "batch_buffers cannot be used along with prefetch > 0, v/s {}".format(
+                    prefetch
                 )
+            )
+
+    def _flow_chunks(  # pylint: disable=too-many-arguments, too-many-locals
+            self,
+            chunks,
+            only_labels=False,
+            with_chunking=False,
+            prefetch=0,
+            prefetch_with='threads',
+            **kwargs):
+        """ Flow the prepped inputs for `chunks` from `_chunks_to_flow`, in the same order.
+
+        When `prefetch` > 0, the inputs for upto `prefetch` chunks are prepped
+        in the background while the earlier ones are being consumed.
+        """
+        if prefetch > 0:
+            pool, prepfn = self._prefetching_pool(prefetch, prefetch_with)
+        else:
+            pool, prepfn = None, None
+
+        chunks = iter(chunks)
+        inflight = deque()
+        at, n_seen_chunks = None, 0
+        try:
+            while True:
+                while pool is not None and len(inflight) < prefetch:
+                    c = next(chunks, None)
+                    if c is None:
+                        break
+
+                    inflight.append((
+                        c,
+                        pool.apply_async(
+                            prepfn, (
+                                self.chunkings[c[2]],
+                                self._seed_for_chunk_in_pass(c[0], c[2]),
+                                only_labels,
+                                kwargs,
+                            )
+                        ),
+                    ))
+
+                if pool is not None:
+                    if not inflight:
+                        break
+
+                    (at, n_seen_chunks, chunkidx), inputs = inflight.popleft()
+                    inputs = inputs.get()
+                else:
+                    c = next(chunks, None)
+                    if c is None:
+                        break
+
+                    at, n_seen_chunks, chunkidx = c
+                    inputs = self.get_prepped_inputs(
+                        chunking=self.chunkings[chunkidx],
+                        array_shuffle_seed=self._seed_for_chunk_in_pass(at, chunkidx),
+                        only_labels=only_labels,
+                        **kwargs
+                    )
 
                 if with_chunking:
-                    yield inputs, ((chunkidx, ), chunking)
+                    yield inputs, ((chunkidx, ), self.chunkings[chunkidx])
                 else:
                     yield inputs
 
@@ -412,6 +810,49 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
             print("soucefile:\n{}".format(self.filepath))
             raise
 
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def flow_for_pass(  # pylint: disable=too-many-arguments
+            self,
+            at,
+            starting_chunk_at=0,
+            only_labels=False,
+            with_chunking=False,
+            prefetch=0,
+            prefetch_with='threads',
+            shard=None,
+            **kwargs):
+        """ Flow the prepped inputs for all chunks in the pass `at`.
+
+        When `prefetch` > 0, the inputs for upto `prefetch` chunks are prepped
+        in the background, by `prefetch` threads (`prefetch_with='threads'`), or
+        worker processes (`prefetch_with='processes'`). The order of chunks and their
+        shuffling remains the same as without prefetching.
+
+        To split the chunks between workers, each worker can flow only its `shard`:
+        - `(k, nshards)`: every `nshards`-th chunk of the pass, starting at the `k`-th.
+        - `nshards` (int): each process that starts a copy of this flow, e.g. the
+          workers forked by Keras' `fit_generator(pickle_safe=True, workers=nshards)`,
+          gets the next free shard (check `SharedShardIndex`).
+
+        The shards of all the workers are disjoint, and together have all the chunks
+        of the pass, shuffled the same as without sharding.
+        """
+        self._check_prefetch(prefetch)
+        return self._flow_chunks(
+            self._chunks_to_flow(
+                [at], starting_chunk_at=starting_chunk_at, shard=_as_shard(shard)
+            ),
+            only_labels=only_labels,
+            with_chunking=with_chunking,
+            prefetch=prefetch,
+            prefetch_with=prefetch_with,
+            **kwargs
+        )
+
     def flow(  # pylint: disable=too-many-arguments
             self,
             indefinitely=False,
@@ -420,27 +861,114 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
             only_labels=False,
             only_data=False,
             with_chunking=False,
+            prefetch=0,
+            prefetch_with='threads',
+            shard=None,
             **kwargs):
-        while True:
-            for p in range(starting_pass_at, self.npasses):
-                for inputs in self.flow_for_pass(
-                        at=p,
-                        starting_chunk_at=starting_chunk_at,
-                        only_labels=only_labels,
-                        with_chunking=with_chunking,
-                        **kwargs
-                ):  # yapf: disable
-                    if only_data:
-                        inputs = inputs[0]
+        """ Flow the prepped inputs for all chunks in all passes (check `flow_for_pass`).
 
-                    yield inputs
+        The prefetching, if any, continues across passes,
+        and so does the `shard`, if any.
 
-                starting_chunk_at = 0
+        NOTE: Returns the generator without starting it, so that a shard can be
+        claimed by each of the processes it is copied into before being started.
+        """
+        self._check_prefetch(prefetch)
+        passes = range(starting_pass_at, self.npasses)
+        if indefinitely:
+            passes = chain(passes, cycle(range(self.npasses)))
+
+        gen = self._flow_chunks(
+            self._chunks_to_flow(
+                passes, starting_chunk_at=starting_chunk_at, shard=_as_shard(shard)
+            ),
+            only_labels=only_labels,
+            with_chunking=with_chunking,
+            prefetch=prefetch,
+            prefetch_with=prefetch_with,
+            **kwargs
+        )
+
+        return (inputs[0] for inputs in gen) if only_data else gen
+
+
+class SharedShardIndex(object):
+    """ Hands out a distinct shard index to each process that starts a copy of a flow.
+
+    The counters live in shared memory, hence, they are shared by the processes forked
+    after it was created, and the first of them to claim gets the shard `(0, nshards)`,
+    the next one `(1, nshards)`, and so on.
+
+    A flow releases its shard when it ends or is closed. Once all the `nshards` have
+    been claimed and released, they can be claimed again, e.g. by the copies started
+    by the next Keras enqueuer. A shard is not handed out again before that, so that
+    a copy that ends early doesn't leave its shard to one of the same group.
+    """
+
+    def __init__(self, nshards):
+        assert nshards >= 1, "nshards should be >= 1, v/s {}".format(nshards)
+        self.nshards = nshards
+        self._counts = Array('i', 2)  # claimed, released
+
+    def claim(self):
+        with self._counts.get_lock():
+            k = self._counts[0]
+            if k < self.nshards:
+                self._counts[0] += 1
+
+        if k >= self.nshards:
+            raise RuntimeError(
+                "More flows were started than the {} shards available".format(
+                    self.nshards
+                )
+            )
+
+        return k, self.nshards
+
+    def release(self, shard):  # pylint: disable=unused-argument
+        with self._counts.get_lock():
+            self._counts[1] += 1
+            if self._counts[1] == self.nshards:  # all done, start over
+                self._counts[0], self._counts[1] = 0, 0
+
+
+def _as_shard(shard):
+    """ `None`, `(k, nshards)` or a `SharedShardIndex` for the `shard` of a flow """
+    if shard is None or isinstance(shard, SharedShardIndex):
+        return shard
+    elif isinstance(shard, (int, np.int_)):
+        return None if shard == 1 else SharedShardIndex(shard)
+
+    k, nshards = shard
+    assert 0 <= k < nshards, "Invalid shard {} of {} shards".format(k, nshards)
+    return k, nshards
+
+
+def _prepped_inputs_as_list(  # pylint: disable=too-many-arguments
+        inputs_provider, chunking, array_shuffle_seed, only_labels, kwargs):
+    """ Prepped inputs for a chunk, with stepped inputs collected into a list.
+
+    The generators of stepped inputs cannot be sent back from a prefetching worker.
+    """
+    inputs = inputs_provider.get_prepped_inputs(
+        chunking=chunking,
+        array_shuffle_seed=array_shuffle_seed,
+        only_labels=only_labels,
+        **kwargs
+    )
+    return list(inputs) if isinstance(inputs, GeneratorType) else inputs
 
-            starting_pass_at = 0
 
-            if not indefinitely:
-                break
+_PREFETCHING_INPUTS_PROVIDER = None  # set in each prefetching worker process
+
+
+def _set_prefetching_inputs_provider(inputs_provider):
+    global _PREFETCHING_INPUTS_PROVIDER  # pylint: disable=global-statement
+    _PREFETCHING_INPUTS_PROVIDER = inputs_provider
+
+
+def _prepped_inputs_in_worker(*args):
+    return _prepped_inputs_as_list(_PREFETCHING_INPUTS_PROVIDER, *args)
 
 
 class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable=abstract-method
@@ -510,61 +1038,67 @@ class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable
 
         return self._ratios
 
-    @staticmethod
-    def _prep_keep(segs_keeps, keep_seed=None, **kwargs):  # pylint: disable=unused-argument
-        if keep_seed is None:
-            return np.sort(np.concatenate([seg[:keep] for seg, keep in segs_keeps]))
+    def _class_keys(self, labels):
+        """ `classkeyfn` for each of the labels, vectorised for the default `np.argmax` """
+        if self.classkeyfn is np.argmax:
+            return np.argmax(labels.reshape((len(labels), -1)), axis=-1)
 
-        nr.seed(keep_seed)
-        seeds = nr.randint(41184535, size=len(segs_keeps))
+        return np.array([self.classkeyfn(l) for l in labels], dtype=np.int)
 
-        keeps = []
-        for i, (s, k) in enumerate(segs_keeps):
-            if len(s) == k:
-                # we're keeping all
-                keeps.append(s)
-            else:
-                nr.seed(seeds[i])
-                keeps.append(nr.permutation(s)[:k])
+    def keeping_decision(self, inputs, keep_seed=None, **kwargs):  # pylint: disable=unused-argument
+        """ Indices of the inputs to keep after subsampling each contiguous segment.
 
-        # NOTE: We only do random sampling, not shuffling
-        return np.sort(np.concatenate(keeps))
+        A segment of `n` labels of a class with ratio `r` keeps:
+        - none, if `r` is 0.
+        - all, if `r` is 1.
+        - `int(n * r)`, but at least 1, otherwise.
 
-    def keeping_decision(self, inputs, keep_seed=None, **kwargs):  # pylint: disable=too-many-locals
+        The first ones in the segment are kept if `keep_seed` is None,
+        else a uniformly random selection from the segment.
+        """
         labels = inputs[1]  # this is usually the case, esp for Keras inputs
+        nlabels = len(labels)
         if all(l == 1. for l in self.ratios.values()):
             # we're keeping all ...
             # shuffling will happen on these keeps later
-            return np.arange(len(labels))
-
-        # Ref:
-        # http://stackoverflow.com/questions/4651683/numpy-grouping-using-itertools-groupby-performance
-        # FIXME: Assumes categorical labels ... 2D
-        diff = np.concatenate([
-            np.ones((1, ) + labels.shape[1:], dtype=labels.dtype),
-            np.diff(labels, axis=0),
-        ])
-        starts = np.unique(np.where(diff)[0])
-        ends = np.concatenate([starts[1:], [len(labels)]])
-
-        seg_keep = []
-        for s, e, l in zip(starts, ends, labels[starts]):
-            ratio = self.ratios[self.classkeyfn(l)]
-            idx = np.arange(s, e)
-
-            if ratio == 0.:  # skip all
-                continue
-            elif ratio == 1.:  # keep all
-                seg_keep.append((idx, len(idx)))
-            else:
-                lenkeep = int(len(idx) * ratio)
-                if lenkeep == 0:
-                    # keep at least 1, cuz we are subsamping, not skipping
-                    # NOTE: this may be controversial
-                    lenkeep = 1
-                seg_keep.append((idx, lenkeep))
+            return np.arange(nlabels)
+        elif nlabels == 0:
+            return np.arange(0)
+
+        # segment ids from where the labels change
+        changes = np.ones(nlabels, dtype=np.bool)
+        changes[1:] = np.any(
+            np.diff(labels, axis=0).reshape((nlabels - 1, int(np.prod(labels.shape[1:])))) != 0,
+            axis=1,
+        )
+        starts = np.flatnonzero(changes)
+        segids = np.cumsum(changes) - 1
+        seglens = np.diff(np.append(starts, nlabels))
+
+        # number of labels to keep in each segment
+        ratios = np.array([self.ratios[k] for k in range(self.nclasses)])
+        segratios = ratios[self._class_keys(labels[starts])]
+        segkeeps = np.where(
+            segratios == 0.,
+            0,
+            # keep at least 1, cuz we are subsamping, not skipping
+            # NOTE: this may be controversial
+            np.maximum(1, (seglens * segratios).astype(np.int)),
+        )
+        segkeeps[segratios == 1.] = seglens[segratios == 1.]
 
-        return self._prep_keep(seg_keep, keep_seed=keep_seed, **kwargs)
+        if keep_seed is None:
+            # keep the first ones in each segment
+            ranks = np.arange(nlabels) - starts[segids]
+            return np.flatnonzero(ranks < segkeeps[segids])
+
+        # keep the ones that rank first within their segment in a random order.
+        # NOTE: random values in [0, 1) added to segids keep the segments in order
+        order = np.argsort(segids + nr.RandomState(keep_seed).rand(nlabels))
+        ranks = np.arange(nlabels) - starts[segids[order]]
+
+        # NOTE: We only do random sampling, not shuffling
+        return np.sort(order[ranks < segkeeps[segids[order]]])
 
     def get_prepped_inputs(self, chunking, array_shuffle_seed=None, **kwargs):  # pylint: disable=arguments-differ
         sup = super(BaseClassSubsamplingInputsProvider, self)
@@ -574,8 +1108,7 @@ class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable
         if array_shuffle_seed is None:
             kseed, aseed = None, None
         elif isinstance(array_shuffle_seed, (int, np.int_)):
-            nr.seed(array_shuffle_seed)
-            kseed, aseed = nr.randint(41184535, size=2)
+            kseed, aseed = nr.RandomState(array_shuffle_seed).randint(41184535, size=2)
 
         keeps = self.keeping_decision(inputs, keep_seed=kseed, **kwargs)
 
@@ -641,8 +1174,7 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
         if shuffle_seed is None:
             oseed, aseed = None, None
         elif isinstance(shuffle_seed, (int, np.int_)):
-            nr.seed(shuffle_seed)
-            oseed, aseed = nr.randint(41184535, size=2)
+            oseed, aseed = nr.RandomState(shuffle_seed).randint(41184535, size=2)
 
         starts = self.maybe_shuffle_array(np.array(starts), oseed)
         ends = self.maybe_shuffle_array(np.array(ends), oseed)
@@ -686,6 +1218,11 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
             **kwargs
         )
 
+        # NOTE: Not started here, for the same reasons as in BaseInputsProvider.flow
+        return self._flow_steps(gen, only_data=only_data, with_chunking=with_chunking)
+
+    @staticmethod
+    def _flow_steps(gen, only_data=False, with_chunking=False):
         for stepped_inputs in gen:
             if with_chunking:
                 stepped_inputs, (chunkidx, chunking) = stepped_inputs
@@ -743,8 +1280,7 @@ class BaseClassSubsamplingSteppedInputsProvider(  # pylint: disable=abstract-met
         if array_shuffle_seed is None:
             kseed, seed = None, None
         elif isinstance(array_shuffle_seed, (int, np.int_)):
-            nr.seed(array_shuffle_seed)
-            kseed, seed = nr.randint(41184535, size=2)
+            kseed, seed = nr.RandomState(array_shuffle_seed).randint(41184535, size=2)
 
         keeps = self.keeping_decision(inputs, keep_seed=kseed, **kwargs)
         if keeps.shape[0] < 1:
@@ -765,6 +1301,54 @@ class BaseClassSubsamplingSteppedInputsProvider(  # pylint: disable=abstract-met
             yield [i[keeps[s:e], ...] for i in inputs]
 
 
+class BatchBuffersRing(object):
+    """ A ring of reusable arrays to gather the batches for steps into.
+
+    Gathering the rows `keeps` of each of the inputs, e.g. of a `strided_view` with
+    data-context, with `np.take(..., out=...)` reads straight from the underlying
+    chunk into the buffers, without allocating a new copy for every step.
+
+    NOTE: The batch gathered into a buffer is valid only until `nbuffers` more batches
+    have been gathered, after which the buffer is reused. Hence, `nbuffers` should be
+    more than the number of batches that are held on to at once, e.g. the `max_q_size`
+    of Keras + 1. It cannot be used when prefetching, since all the steps of the chunks
+    being prefetched are gathered at once.
+    """
+
+    def __init__(self, nbuffers):
+        assert nbuffers >= 1, "nbuffers should be >= 1, v/s {}".format(nbuffers)
+        self.nbuffers = nbuffers
+        self._buffers = [None] * nbuffers  # list of arrays, one per input, per buffer
+        self._at = 0
+        self._lock = Lock()
+
+    def _next_buffers(self, inputs, n):
+        with self._lock:
+            at = self._at
+            self._at = (self._at + 1) % self.nbuffers
+
+        buffers = self._buffers[at]
+        if buffers is None or len(buffers) != len(inputs) or any(
+                len(b) < n or b.shape[1:] != i.shape[1:] or b.dtype != i.dtype
+                for b, i in zip(buffers, inputs)
+        ):  # yapf: disable
+            # (re)allocate for the largest batch seen so far
+            n = max([n] + ([len(b) for b in buffers] if buffers is not None else []))
+            buffers = [np.empty((n, ) + i.shape[1:], dtype=i.dtype) for i in inputs]
+            self._buffers[at] = buffers
+
+        return buffers
+
+    def gather(self, inputs, keeps):
+        """ Gather `[i[keeps, ...] for i in inputs]` into the next buffers in the ring """
+        n = len(keeps)
+        return [
+            # NOTE: np.take buffers the output in mode='raise', keeps are valid anyway
+            np.take(i, keeps, axis=0, out=b[:n], mode='clip')
+            for i, b in zip(inputs, self._next_buffers(inputs, n))
+        ]
+
+
 class BaseWithContextSteppedInputsProvider(  # pylint: disable=abstract-method
         BaseWithContextPrepper, BaseSteppedInputsProvider):
     """ Base With-Context Stepped Inputs-Provider
@@ -782,7 +1366,12 @@ class BaseWithContextSteppedInputsProvider(  # pylint: disable=abstract-method
             steps_per_chunk=8,
             shuffle_seed=None,
             npasses=1,
+            batch_buffers=0,
             **kwargs):
+        # number of reusable buffers to gather shuffled steps into,
+        # 0 to copy each step into a new array (check BatchBuffersRing)
+        self.batch_buffers = _batch_buffers_ring(batch_buffers)
+
         sup = super(BaseWithContextSteppedInputsProvider, self)
         sup.__init__(
             filepath,
@@ -821,13 +1410,15 @@ class BaseWithContextSteppedInputsProvider(  # pylint: disable=abstract-method
 
         len_input = len(inputs[0])
         if array_shuffle_seed is not None:
+            # NOTE: with batch_buffers, the steps are gathered straight from the chunk
+            # (the data from strided view), into reusable buffers, instead of new copies
             starts, ends, aseed = self.se_for_chunksteps_maybeshuffled(
                 len_input, shuffle_seed=array_shuffle_seed, **kwargs
             )
 
             keeps = self.maybe_shuffle_array(np.arange(len_input), aseed)
             for s, e in zip(starts, ends):
-                yield [i[keeps[s:e], ...] for i in inputs]
+                yield _gather_step(inputs, keeps[s:e], self.batch_buffers)
         else:
             # no shuffling ... don't copy ...
             # used in validation inputs providers
@@ -853,7 +1444,11 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
             class_subsample_to_ratios=1.,  # float, tuple or dict, default keeps all
             shuffle_seed=None,
             npasses=1,
+            batch_buffers=0,
             **kwargs):
+        # number of reusable buffers to gather shuffled or subsampled steps into,
+        # 0 to copy each step into a new array (check BatchBuffersRing)
+        self.batch_buffers = _batch_buffers_ring(batch_buffers)
 
         # Mainly here for documentation and auto-completion
         sup = super(BaseWithContextClassSubsamplingSteppedInputsProvider, self)
@@ -903,8 +1498,9 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
             if array_shuffle_seed is None:
                 kseed, seed = None, None
             elif isinstance(array_shuffle_seed, (int, np.int_)):
-                nr.seed(array_shuffle_seed)
-                kseed, seed = nr.randint(41184535, size=2)
+                kseed, seed = nr.RandomState(array_shuffle_seed).randint(
+                    41184535, size=2
+                )
 
             # decide which to keep
             keeps = self.keeping_decision(inputs, keep_seed=kseed, **kwargs)
@@ -927,7 +1523,7 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
             # step through the keeps
             keeps = self.maybe_shuffle_array(keeps, seed)
             for s, e in zip(starts, ends):
-                yield [i[keeps[s:e], ...] for i in inputs]
+                yield _gather_step(inputs, keeps[s:e], self.batch_buffers)
 
         else:
             # no shuffling ... no subsampling ... don't copy ...
@@ -940,5 +1536,16 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
                 yield [i[s:e, ...] for i in inputs]
 
 
+def _batch_buffers_ring(batch_buffers):
+    return BatchBuffersRing(batch_buffers) if batch_buffers > 0 else None
+
+
+def _gather_step(inputs, keeps, batch_buffers=None):
+    if batch_buffers is None:
+        return [i[keeps, ...] for i in inputs]
+
+    return batch_buffers.gather(inputs, keeps)
+
+
 BaseWCtxSubsplStpdInputsProvider = BaseWithContextClassSubsamplingSteppedInputsProvider
 BaseWCtxStpdInputsProvider = BaseWithContextSteppedInputsProvider
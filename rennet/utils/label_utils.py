@@ -19,19 +19,229 @@ Created: 26-08-2016
 from __future__ import print_function, division, absolute_import
 from collections import Iterable, OrderedDict
 from contextlib import contextmanager
+from functools import partial
 from itertools import groupby
-from os.path import abspath
+from importlib import import_module
+import json
+from os import getpid, listdir, remove, rename, stat, utime
+from os.path import abspath, join
+from hashlib import sha1
 import sys
 import warnings
 import numpy as np
+from six import string_types
 from six.moves import zip, range
 
 from pympi import Eaf
 
 from .. import __version__ as rennet_version
-from .py_utils import BaseSlotsOnlyClass
+from .py_utils import BaseSlotsOnlyClass, makedirs_with_existok
 from .np_utils import normalize_confusion_matrix, confusion_matrix_forcategorical
-from .mpeg7_utils import parse_mpeg7
+from .mpeg7_utils import iterparse_mpeg7
+
+
+def _csr_rows(offsets, values, rows, keep=None):
+    """ Select `rows` of the CSR format `offsets` and `values`.
+
+    The rows where `keep` is `False` are left empty. Returns the selected
+    `offsets` and `values`, also in CSR format.
+    """
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    if keep is not None:
+        counts = np.where(keep, counts, 0)
+
+    res_offsets = np.zeros(len(rows) + 1, dtype=np.int)
+    np.cumsum(counts, out=res_offsets[1:])
+
+    # position in `values` for each of the selected values
+    at = np.arange(res_offsets[-1]) + np.repeat(starts - res_offsets[:-1], counts)
+    return res_offsets, values[at]
+
+
+def _slots_of(cls):
+    """ All the `__slots__` of `cls` and its bases, in order from the base-most """
+    return [
+        slot for c in reversed(cls.__mro__)
+        for slot in c.__dict__.get('__slots__', ())
+    ]
+
+
+def _import_class(path, slots=()):
+    """ The class at the dotted `path`, as named in a file being loaded.
+
+    Raises TypeError if it is not a class, or doesn't have all of the `slots`.
+    """
+    module, name = path.rsplit('.', 1)
+    cls = getattr(import_module(module), name, None)
+    if not isinstance(cls, type) or not set(slots) <= set(_slots_of(cls)):
+        raise TypeError("{} is not a class with the slots {}".format(path, sorted(slots)))
+
+    return cls
+
+
+def _to_jsonable(obj):
+    """ Encode `obj` as JSON-able values, including the slots-only objects in it """
+    if obj is None or isinstance(obj, (bool, int, float, string_types)):
+        return obj
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, list):
+        return [_to_jsonable(o) for o in obj]
+    elif isinstance(obj, tuple):
+        return {'__tuple__': [_to_jsonable(o) for o in obj]}
+    elif isinstance(obj, np.ndarray):
+        return {'__ndarray__': _to_jsonable(obj.tolist()), 'dtype': obj.dtype.str}
+    elif hasattr(obj.__class__, '__slots__'):
+        return {
+            '__slots_class__': ".".join((obj.__module__, obj.__class__.__name__)),
+            'slots': {s: _to_jsonable(getattr(obj, s)) for s in _slots_of(obj.__class__)},
+        }
+    else:
+        raise TypeError("Cannot save value of type {}".format(type(obj)))
+
+
+def _from_jsonable(obj):
+    """ Decode the values encoded with `_to_jsonable` """
+    if isinstance(obj, list):
+        return [_from_jsonable(o) for o in obj]
+    elif isinstance(obj, dict) and '__tuple__' in obj:
+        return tuple(_from_jsonable(o) for o in obj['__tuple__'])
+    elif isinstance(obj, dict) and '__ndarray__' in obj:
+        return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+    elif isinstance(obj, dict) and '__slots_class__' in obj:
+        cls = _import_class(obj['__slots_class__'], slots=obj['slots'])
+        res = cls.__new__(cls)
+        for slot, value in obj['slots'].items():
+            setattr(res, slot, _from_jsonable(value))
+        return res
+    else:
+        return obj
+
+
+class ParseCache(object):
+    """ Opt-in on-disk cache of the `starts_ends`, labels and samplerate parsed from
+    annotation files, e.g. MPEG7 or ELAN, saved with `SequenceLabels.save`.
+
+    Entries are keyed by the file's path, size and modification time (or a hash of its
+    content, if `content_hash`), the parser, and the parser options, hence, a modified
+    file is parsed again. When the total size of the entries is above `max_nbytes`,
+    the least recently used ones are deleted.
+
+    Disabled, until `enable` is called with a `cache_dir`. Use `PARSE_CACHE` from this
+    module, which is used by `SequenceLabels.from_mpeg7` and `SequenceLabels.from_eaf`.
+    """
+    ext = '.rsl'
+
+    def __init__(self, cache_dir=None, max_nbytes=2**30, content_hash=False):
+        self.cache_dir = None
+        self.max_nbytes = max_nbytes
+        self.content_hash = content_hash
+        if cache_dir is not None:
+            self.enable(cache_dir, max_nbytes=max_nbytes, content_hash=content_hash)
+
+    @property
+    def enabled(self):
+        return self.cache_dir is not None
+
+    def enable(self, cache_dir, max_nbytes=2**30, content_hash=False):
+        makedirs_with_existok(cache_dir, exist_ok=True)
+        self.cache_dir = abspath(cache_dir)
+        self.max_nbytes = max_nbytes
+        self.content_hash = content_hash
+
+    def disable(self):
+        """ Stop using the cache. The entries on disk are kept, see `clear`. """
+        self.cache_dir = None
+
+    def key(self, filepath, parser, **options):
+        filepath = abspath(filepath)
+        st = stat(filepath)
+        if self.content_hash:
+            with open(filepath, 'rb') as f:
+                version = sha1(f.read()).hexdigest()
+        else:
+            version = st.st_mtime
+
+        return sha1(
+            repr((
+                filepath, st.st_size, version, parser, sorted(options.items()),
+                rennet_version
+            )).encode('utf-8')
+        ).hexdigest()
+
+    def _path(self, key):
+        return join(self.cache_dir, key + self.ext)
+
+    def _entries(self):
+        """ (last used time, nbytes, path) of all the entries, least recently used first """
+        entries = []
+        for fn in listdir(self.cache_dir):
+            if fn.endswith(self.ext):
+                st = stat(join(self.cache_dir, fn))
+                entries.append((st.st_mtime, st.st_size, join(self.cache_dir, fn)))
+
+        return sorted(entries)
+
+    def get(self, key):
+        """ The cached `(starts_ends, labels, samplerate)` for `key`, or `None`. """
+        path = self._path(key)
+        try:
+            res = SequenceLabels.load(path, mmap_mode=None)
+            utime(path, None)  # last used now
+        except (IOError, OSError, ValueError):  # pylint: disable=overlapping-except
+            return None
+
+        return res.starts_ends, res.labels, res.samplerate
+
+    def put(self, key, starts_ends, labels, samplerate):
+        """ Cache the parsed `(starts_ends, labels, samplerate)` for `key`. """
+        path = self._path(key)
+
+        # written in full before being moved in place, for other processes
+        tmp = "{}.{}.tmp".format(path, getpid())
+        SequenceLabels(starts_ends, labels, samplerate).save(tmp)
+        rename(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+        """ Delete the least recently used entries till all fit in `max_nbytes`. """
+        entries = self._entries()
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, path in entries:
+            if total <= self.max_nbytes:
+                break
+
+            try:
+                remove(path)
+            except OSError:
+                pass  # already removed by someone else
+
+            total -= nbytes
+
+    def clear(self):
+        for _, _, path in self._entries():
+            remove(path)
+
+    def cached(self, parse, filepath, parser, **options):
+        """ `parse()` the file at `filepath`, unless cached, or the cache is disabled.
+
+        `parse` should return `(starts_ends, labels, samplerate)`.
+        """
+        if not self.enabled:
+            return parse()
+
+        key = self.key(filepath, parser, **options)
+        res = self.get(key)
+        if res is None:
+            res = parse()
+            self.put(key, *res)
+
+        return res
+
+
+PARSE_CACHE = ParseCache()
 
 
 class SequenceLabels(object):
@@ -56,6 +266,7 @@ class SequenceLabels(object):
         '_orig_samplerate',
         '_samplerate',
         '_minstart_at_orig_sr',
+        '_flat_index',
     )
 
     # To save memory, maybe? I just wanted to learn about them.
@@ -106,6 +317,9 @@ class SequenceLabels(object):
 
         self._minstart_at_orig_sr = self._starts_ends.item(0)  # min-start
 
+        # computed lazily, only once, from the never modified self._starts_ends
+        self._flat_index = None
+
     @property
     def samplerate(self):
         """float or int: The current samplerate of `starts_ends`.
@@ -198,13 +412,18 @@ class SequenceLabels(object):
 
         self._starts_ends is stored at self._orig_samplerate and never modified.
         """
-        starts_ends = self._starts_ends
-        ominstart = starts_ends.item(0)
+        return self._as_current(self._starts_ends)
+
+    def _as_current(self, values):
+        """ Shift and convert `values` in terms of `self._starts_ends` to the
+        contextually most recent min-start and samplerate.
+        """
+        ominstart = self._starts_ends.item(0)
         if self._minstart_at_orig_sr != ominstart:
-            starts_ends = starts_ends - (ominstart - self._minstart_at_orig_sr)
+            values = values - (ominstart - self._minstart_at_orig_sr)
 
         return self._convert_samplerate(
-            starts_ends,
+            values,
             from_samplerate=self._orig_samplerate,
             to_samplerate=self._samplerate,
         )
@@ -322,39 +541,121 @@ class SequenceLabels(object):
     # which will definitely lead to change in samplerate (and I don't want to implement it), or
     # needs me to do my PhD first.
 
-    def _flattened_indices(self, return_bins=False):
-        """Calculate indices of the labels that form the flattened labels.
+    def _flattened_index(self):
+        """Cached index of the labels that form the flattened labels.
 
         Flattened means, there is 1 and only 1 "label" for each time-step within
         the min-start and max-end. No less, no more.
 
-        That is, all time-steps between min-start and max-end are accounted for,
-        even if with an empty `tuple()`.
+        Returns
+        -------
+        bins: ndarray
+            Sorted unique boundaries of all the segments, at the original
+            samplerate and min-start, i.e. in terms of `self._starts_ends`.
+        offsets: ndarray of int, len(bins)
+            The indices of the labels active between `bins[i]` and `bins[i + 1]`
+            are `label_ids[offsets[i]:offsets[i + 1]]`, in CSR format.
+        label_ids: ndarray of int
+            Indices into `self.labels`.
 
-        Returns empty `tuple()` for start-end pairs for which no labels can be inferred.
+        Note
+        ----
+        It is computed only once, on first use, since `self._starts_ends` is never
+        modified after initialization.
         """
-        # TODO: Proper dox; add params and returns
-
-        se = self.starts_ends
+        if self._flat_index is not None:
+            return self._flat_index
 
+        se = self._starts_ends
         if np.any(se[1:, 0] != se[:-1, 1]):  # not flat
             # `numpy.unique` also sorts the (flattened) array
             bins, sorting_indices = np.unique(se, return_inverse=True)
 
-            sorting_indices = sorting_indices.reshape(-1, 2)  # un-flatten
+            starts, ends = sorting_indices.reshape(-1, 2).T  # un-flatten
 
-            labels_indices = [tuple()] * (len(bins) - 1)
-            for j, (s, e) in enumerate(sorting_indices):
-                # `(e - s)` is small but > 0, usually 1
-                # `s` may also repeat, hence can't do fancy `numpy` w/ readability
-                for i in range(s, e):
-                    labels_indices[i] += (j, )
+            # label j is active in the flattened segments starts[j] to ends[j] - 1.
+            # Sweep over the boundaries, counting the labels active in each segment.
+            nsegs = len(bins) - 1
+            active = np.cumsum(
+                np.bincount(starts, minlength=nsegs + 1) -
+                np.bincount(ends, minlength=nsegs + 1)
+            )
+            offsets = np.zeros(len(bins), dtype=np.int)
+            np.cumsum(active[:-1], out=offsets[1:])
+
+            # one (segment, label) pair for each segment a label is active in,
+            # stable sorted on segments, to keep the labels sorted within a segment
+            spans = ends - starts
+            firsts = np.cumsum(spans) - spans
+            segs = np.repeat(starts - firsts, spans) + np.arange(spans.sum())
+            label_ids = np.repeat(np.arange(len(se)), spans)
+            label_ids = label_ids[np.argsort(segs, kind='mergesort')]
         else:  # already flat
             bins = np.zeros(len(se) + 1, dtype=se.dtype)
             bins[:-1] = se[:, 0]
             bins[-1] = se[-1, 1]
 
-            labels_indices = [(i, ) for i in range(len(se))]
+            offsets = np.arange(len(se) + 1)
+            label_ids = np.arange(len(se))
+
+        self._flat_index = bins, offsets, label_ids
+        return self._flat_index
+
+    def _flattened_csr(self):
+        """ The flattened index of labels with `bins` in the current context.
+
+        `bins` are shifted and converted to the contextually most recent min-start
+        and samplerate. See `_flattened_index` for the `offsets` and `label_ids`.
+        """
+        bins, offsets, label_ids = self._flattened_index()
+        bins = self._as_current(bins)
+
+        # distinct bins may become the same on conversion, drop the empty segments
+        empty = bins[1:] == bins[:-1]
+        if np.any(empty):
+            offsets, label_ids = _csr_rows(offsets, label_ids, np.flatnonzero(~empty))
+            bins = np.delete(bins, np.flatnonzero(empty))
+
+        return bins, offsets, label_ids
+
+    def _flattened_sums(self, label_values):
+        """ Sum of `label_values` of all the labels in each flattened segment.
+
+        `label_values` should have one row for each of `self.labels`.
+        Returns the `starts_ends` of the flattened segments, in the current context,
+        and the sums, with one row for each of them.
+        """
+        bins, offsets, label_ids = self._flattened_csr()
+        label_values = np.asarray(label_values)
+
+        # differences of the cumulative sums at the offsets, i.e. sums between them
+        cumsums = np.zeros(
+            (len(label_ids) + 1, ) + label_values.shape[1:], dtype=label_values.dtype
+        )
+        np.cumsum(label_values[label_ids, ...], axis=0, out=cumsums[1:])
+        sums = cumsums[offsets[1:], ...] - cumsums[offsets[:-1], ...]
+
+        return np.stack((bins[:-1], bins[1:]), axis=1), sums
+
+    def _flattened_indices(self, return_bins=False):
+        """Calculate indices of the labels that form the flattened labels.
+
+        Flattened means, there is 1 and only 1 "label" for each time-step within
+        the min-start and max-end. No less, no more.
+
+        That is, all time-steps between min-start and max-end are accounted for,
+        even if with an empty `tuple()`.
+
+        Returns empty `tuple()` for start-end pairs for which no labels can be inferred.
+
+        Prefer `_flattened_csr`, this only repackages it as a list of tuples.
+        """
+        # TODO: Proper dox; add params and returns
+
+        bins, offsets, label_ids = self._flattened_csr()
+        labels_indices = [
+            tuple(label_ids[s:e]) for s, e in zip(offsets[:-1], offsets[1:])
+        ]
 
         if return_bins:
             # return as bins for `numpy.digitize`
@@ -365,11 +666,12 @@ class SequenceLabels(object):
 
         return res
 
-    def labels_at(self, ends, samplerate=None, default_label=(), rounded=10):
-        """ TODO: [ ] Proper Dox
+    def _bins_at(self, ends, samplerate=None, rounded=10):
+        """ Indices of the flattened segments that each of `ends` falls in.
 
-        if `samplerate` is `None`, it is assumed that `ends` are at the same
-        `samplerate` as our contextually most recent one. See `samplerate_as`
+        -1 for the `ends` that are outside all the segments.
+        Returned along with the `offsets` and `label_ids` of the same segments from
+        `_flattened_csr`, in which the empty ones have been dropped.
         """
         if not isinstance(ends, Iterable):
             ends = [ends]
@@ -377,7 +679,7 @@ class SequenceLabels(object):
             ends = np.array(ends)
 
         with self.samplerate_as(samplerate):
-            bins, labels_idx = self._flattened_indices(return_bins=True)
+            bins, offsets, label_ids = self._flattened_csr()
 
         if ends.dtype != np.int or bins.dtype != np.int:
             # floating point comparison issues
@@ -388,24 +690,55 @@ class SequenceLabels(object):
         # starting at an `end`. Hence choose side='right'.
         # ends outside bins will have value 0 or len(bins)
         bin_idx = np.searchsorted(bins, ends, side='right')
+        bin_idx[bin_idx == len(bins)] = 0
 
-        # construct labels for only the unique bin_idx, repackage when returning
-        unique_bin_idx, bin_idx = np.unique(bin_idx, return_inverse=True)
+        # labels for bin_idx == 1 are at the flattened segment 0
+        return bin_idx - 1, offsets, label_ids
 
-        unique_res_labels = np.empty(len(unique_bin_idx), dtype=np.object)
-        unique_res_labels.fill(default_label)
-        for i, idx in enumerate(unique_bin_idx):
-            if idx != 0 and idx != len(bins):  # if not outside bins
+    def labels_idx_at(self, ends, samplerate=None, rounded=10):
+        """ Indices of the labels at `ends`, in CSR format.
 
-                # labels for bin_idx == 1 are at labels_idx[0]
-                l = labels_idx[idx - 1]
+        if `samplerate` is `None`, it is assumed that `ends` are at the same
+        `samplerate` as our contextually most recent one. See `samplerate_as`
+
+        Returns
+        -------
+        offsets: ndarray of int, len(ends) + 1
+            The indices of labels at `ends[i]` are `label_ids[offsets[i]:offsets[i + 1]]`.
+            Empty for `ends` outside all the segments, or where there are no labels.
+        label_ids: ndarray of int
+            Indices into `self.labels`.
+        """
+        seg, offsets, label_ids = self._bins_at(ends, samplerate=samplerate, rounded=rounded)
+
+        within = seg >= 0
+        return _csr_rows(offsets, label_ids, np.where(within, seg, 0), keep=within)
+
+    def labels_at(self, ends, samplerate=None, default_label=(), rounded=10):
+        """ TODO: [ ] Proper Dox
+
+        if `samplerate` is `None`, it is assumed that `ends` are at the same
+        `samplerate` as our contextually most recent one. See `samplerate_as`
+
+        See `labels_idx_at` to get the indices of the labels in a compact form instead.
+        """
+        seg, offsets, label_ids = self._bins_at(ends, samplerate=samplerate, rounded=rounded)
+
+        # construct labels for only the unique segments, repackage when returning
+        unique_seg, seg = np.unique(seg, return_inverse=True)
+
+        unique_res_labels = np.empty(len(unique_seg), dtype=np.object)
+        unique_res_labels.fill(default_label)
+        for i, idx in enumerate(unique_seg):
+            if idx >= 0:  # if not outside bins
+                l = label_ids[offsets[idx]:offsets[idx + 1]]
                 if len(l) == 1:
                     unique_res_labels[i] = (self.labels[l[0], ...], )
                 elif len(l) > 1:
                     unique_res_labels[i] = tuple(self.labels[l, ...])
                 # else: it is prefilled with default_label
 
-        return unique_res_labels[bin_idx, ...]
+        return unique_res_labels[seg, ...]
 
     @classmethod
     def from_dense_labels(  # pylint: disable=too-many-arguments, too-many-locals
@@ -569,12 +902,30 @@ class SequenceLabels(object):
         RuntimeError: if not annotations are found in the given file.
         ValueError: Check `rennet.utils.mpeg7_utils`.
         """
-        # se, sr, sids, gen, gn, conf, trn = parse_mpeg7(filepath, use_tags=use_tags)
         filepath = abspath(filepath)
-        parsed = parse_mpeg7(filepath, use_tags=use_tags)
+        starts_ends, labels, samplerate = PARSE_CACHE.cached(
+            partial(cls._parse_mpeg7, filepath, use_tags),
+            filepath,
+            'mpeg7',
+            use_tags=use_tags,
+        )
+
+        if cls == SequenceLabels:
+            res = cls(starts_ends, labels, samplerate)
+        else:
+            # some child class
+            # let's honor kwargs, they should too
+            res = starts_ends, labels, samplerate, kwargs
+
+        return res
+
+    @staticmethod
+    def _parse_mpeg7(filepath, use_tags):
+        # se, sr, sids, gen, gn, conf, trn = iterparse_mpeg7(filepath, use_tags=use_tags)
+        parsed = iterparse_mpeg7(filepath, use_tags=use_tags)
         starts_ends, samplerate = parsed[:2]
 
-        if not starts_ends:
+        if len(starts_ends) == 0:
             raise RuntimeError(
                 "No Annotations were found from file {}.\n".format(filepath) + \
                 "Check `use_tags` parameter for `mpeg7_utils.parse_mpeg7` "+\
@@ -592,17 +943,10 @@ class SequenceLabels(object):
             ) for sid, gen, gn, conf, trn in zip(*parsed[2:])
         ]
 
-        if cls == SequenceLabels:
-            res = cls(starts_ends, labels, samplerate)
-        else:
-            # some child class
-            # let's honor kwargs, they should too
-            res = starts_ends, labels, samplerate, kwargs
-
-        return res
+        return starts_ends, labels, samplerate
 
     @classmethod
-    def from_eaf(cls, filepath, tiers=(), **kwargs):  # pylint: disable=too-many-locals
+    def from_eaf(cls, filepath, tiers=(), **kwargs):
         """ Create instance of SequenceLabels from an ELAN annotation file.
 
         NOTE: Not all features of ELAN files are supported. For example:
@@ -639,7 +983,6 @@ class SequenceLabels(object):
         RuntimeError: if no tiers are found, or if all tiers are empty
         """
         filepath = abspath(filepath)
-        eaf = Eaf(file_path=filepath)
 
         # FIXME: Check if the each element is a string, and support py2 as well.
         if not (isinstance(tiers, (tuple, list)) or callable(tiers)):
@@ -648,7 +991,25 @@ class SequenceLabels(object):
                 format(tiers)
             )
 
-        tiers = tuple(tiers) if not callable(tiers) else tiers
+        if callable(tiers):
+            # can't tell if the predicate is the same as when cached
+            starts_ends, labels, samplerate = cls._parse_eaf(filepath, tiers)
+        else:
+            starts_ends, labels, samplerate = PARSE_CACHE.cached(
+                partial(cls._parse_eaf, filepath, tuple(tiers)),
+                filepath,
+                'eaf',
+                tiers=tuple(tiers),
+            )
+
+        return (
+            cls(starts_ends, labels, samplerate)
+            if cls == SequenceLabels else (starts_ends, labels, samplerate, kwargs)
+        )
+
+    @staticmethod
+    def _parse_eaf(filepath, tiers):  # pylint: disable=too-many-locals
+        eaf = Eaf(file_path=filepath)
 
         warnemptytier = True
         if tiers == ():  # read all tiers
@@ -705,10 +1066,7 @@ class SequenceLabels(object):
                 "All tiers {} were found to be empty in file\n{}".format(tiers, filepath)
             )
 
-        return (
-            cls(starts_ends, labels, samplerate)
-            if cls == SequenceLabels else (starts_ends, labels, samplerate, kwargs)
-        )
+        return starts_ends, labels, samplerate
 
     def to_eaf(  # pylint: disable=too-many-arguments, too-many-locals, too-complex
             self,
@@ -725,11 +1083,11 @@ class SequenceLabels(object):
 
         # flatten everything
         with self.samplerate_as(1000):  # pympi only supports milliseconds
-            se, label_idx = self._flattened_indices()
-            if se.dtype != np.int:
+            bins, offsets, label_ids = self._flattened_csr()
+            if bins.dtype != np.int:
                 # EAF requires integers as starts and ends
                 # IDEA: Warn rounding?
-                se = np.rint(se).astype(np.int)
+                bins = np.rint(bins).astype(np.int)
 
         if eafobj is None:
             eaf = Eaf(author=author)
@@ -752,9 +1110,10 @@ class SequenceLabels(object):
                 )
 
         # seen_tier_names = set()
-        for (start, end), lix in zip(se, label_idx):
+        for i, (start, end) in enumerate(zip(bins[:-1], bins[1:])):
             curr_seen_tier_names = set()
-            if lix:
+            lix = label_ids[offsets[i]:offsets[i + 1]]
+            if len(lix) > 0:
                 for ann in labels[lix, ...]:
                     if ann.tier_name not in eaf.tiers:
                         # FIXME: handle different participant and annotator for same tier_name
@@ -785,6 +1144,187 @@ class SequenceLabels(object):
 
         return eaf
 
+    _SAVE_MAGIC = b'RENNETSL'
+    _SAVE_VERSION = 1
+    _SAVE_ALIGN = 64
+
+    def _labels_to_save(self):
+        """ The arrays to be saved for `self.labels`, and the rest as JSON-able values.
+
+        Labels as a numeric or string array are saved as they are. Slots-only label
+        objects, like `EAFAnnotationInfo`, are saved as one array per slot, when it can
+        be, and as JSON-able values otherwise. Any other labels are saved as JSON-able.
+        """
+        labels = self.labels
+        if labels.dtype.kind in 'biufcSU':
+            return {'labels': labels}, {'kind': 'array'}
+
+        classes = set(l.__class__ for l in labels)
+        if len(classes) != 1 or not hasattr(next(iter(classes)), '__slots__'):
+            return {}, {'kind': 'json', 'values': _to_jsonable(labels.tolist())}
+
+        cls = classes.pop()
+        arrays, slots = {}, {}
+        for slot in _slots_of(cls):
+            values = [getattr(l, slot) for l in labels]
+            column = np.array(values)
+            if column.dtype.kind in 'biufSU' and column.shape == (len(labels), ):
+                arrays['labels.' + slot] = column
+                slots[slot] = None
+            else:
+                slots[slot] = _to_jsonable(values)
+
+        return arrays, {
+            'kind': 'slots',
+            'class': ".".join((cls.__module__, cls.__name__)),
+            'slots': slots,
+        }
+
+    @staticmethod
+    def _labels_from_saved(arrays, info):
+        if info['kind'] == 'array':
+            return arrays['labels']
+        elif info['kind'] == 'json':
+            values = _from_jsonable(info['values'])
+        else:  # slots
+            cls = _import_class(info['class'], slots=info['slots'])
+            columns = {
+                slot: (arrays['labels.' + slot].tolist() if v is None else _from_jsonable(v))
+                for slot, v in info['slots'].items()
+            }
+            values = [cls.__new__(cls) for _ in range(len(arrays['starts_ends']))]
+            for slot, column in columns.items():
+                for l, v in zip(values, column):
+                    setattr(l, slot, v)
+
+        # avoid numpy making a multi-dimensional array out of a list of tuples
+        labels = np.empty(len(values), dtype=np.object)
+        labels[:] = values
+        return labels
+
+    def save(self, filepath):
+        """ Save to `filepath` in a binary format that can be loaded memory-mapped.
+
+        The `starts_ends`, and labels that are numeric or string arrays, are saved as is,
+        after a JSON header with the rest, including the extra slots of the sub-classes.
+        The contextual samplerate and min-start are not saved; it is saved as original.
+
+        See `load` for loading it back.
+        """
+        arrays, labels_info = self._labels_to_save()
+        arrays['starts_ends'] = self._starts_ends
+
+        own_slots = set(_slots_of(SequenceLabels))
+        header = {
+            'version': self._SAVE_VERSION,
+            'class': ".".join((self.__module__, self.__class__.__name__)),
+            'samplerate': _to_jsonable(self._orig_samplerate),
+            'labels': labels_info,
+            'slots': {
+                s: _to_jsonable(getattr(self, s))
+                for s in _slots_of(self.__class__) if s not in own_slots
+            },
+            'arrays': {},
+        }
+
+        # each array starts aligned, at its offset after the header
+        offset = 0
+        arrays = [(name, np.ascontiguousarray(arr)) for name, arr in sorted(arrays.items())]
+        for name, arr in arrays:
+            header['arrays'][name] = {
+                'dtype': arr.dtype.str,
+                'shape': arr.shape,
+                'offset': offset,
+            }
+            offset += -(-arr.nbytes // self._SAVE_ALIGN) * self._SAVE_ALIGN
+
+        offsets = {name: info['offset'] for name, info in header['arrays'].items()}
+
+        header = json.dumps(header).encode('utf-8')
+        datastart = len(self._SAVE_MAGIC) + 8 + len(header)
+        datastart = -(-datastart // self._SAVE_ALIGN) * self._SAVE_ALIGN
+
+        with open(filepath, 'wb') as f:
+            f.write(self._SAVE_MAGIC)
+            f.write(np.array(len(header), dtype='<u8').tobytes())
+            f.write(header)
+            for name, arr in arrays:
+                f.seek(datastart + offsets[name])
+                f.write(arr.tobytes())
+
+    @classmethod
+    def load(cls, filepath, mmap_mode='r'):
+        """ Load the SequenceLabels (or a sub-class) saved with `save` at `filepath`.
+
+        The arrays are memory-mapped with `mmap_mode` (see `numpy.memmap`), or read into
+        memory if it is `None`. The returned instance is of the class it was saved from,
+        which has to be `cls` or a sub-class of it.
+
+        NOTE: Only load files from trusted sources. The modules of the classes named in
+        the file, for itself and its labels, are imported, which runs their code.
+
+        Raises
+        ------
+        ValueError: If `filepath` was not saved with `save`.
+        TypeError: If the saved class is not `cls` or a sub-class of it, or the class of
+            the labels doesn't have the saved slots.
+        """
+        with open(filepath, 'rb') as f:
+            magic = f.read(len(cls._SAVE_MAGIC))
+            if magic != cls._SAVE_MAGIC:
+                raise ValueError("Not a saved SequenceLabels file: {}".format(filepath))
+
+            headerlen = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(headerlen).decode('utf-8'))
+
+        if header['version'] != cls._SAVE_VERSION:
+            raise ValueError(
+                "Unsupported version {} of saved SequenceLabels file: {}".format(
+                    header['version'], filepath
+                )
+            )
+
+        savedcls = _import_class(header['class'])
+        if not issubclass(savedcls, cls):
+            raise TypeError(
+                "{} was saved from {}, which is not a {}".format(
+                    filepath, header['class'], cls.__name__
+                )
+            )
+
+        datastart = len(cls._SAVE_MAGIC) + 8 + headerlen
+        datastart = -(-datastart // cls._SAVE_ALIGN) * cls._SAVE_ALIGN
+        arrays = {}
+        for name, info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            offset = datastart + info['offset']
+            if mmap_mode is None or np.prod(shape) == 0:
+                with open(filepath, 'rb') as f:
+                    f.seek(offset)
+                    count = int(np.prod(shape))
+                    arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+            else:
+                arrays[name] = np.memmap(
+                    filepath, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape
+                )
+
+        # already sorted and validated before saving, skip the __init__
+        slots = {s: _from_jsonable(v) for s, v in header['slots'].items()}
+        slots.update({
+            '_starts_ends': arrays['starts_ends'],
+            'labels': cls._labels_from_saved(arrays, header['labels']),
+            '_orig_samplerate': header['samplerate'],
+            '_samplerate': header['samplerate'],
+            '_minstart_at_orig_sr': arrays['starts_ends'].item(0),
+            '_flat_index': None,
+        })
+
+        res = savedcls.__new__(savedcls)
+        for slot, value in slots.items():
+            setattr(res, slot, value)
+
+        return res
+
     # TODO: [ ] Export to mpeg7
 
     # IDEA: [ ] Merge with other SequenceLabels, with label_fn to replace or overlap
@@ -842,7 +1382,7 @@ class ContiguousSequenceLabels(SequenceLabels):
 
     # PARENT'S SLOTS
     # __slots__ = ('_starts_ends', 'labels', '_orig_samplerate', '_samplerate',
-    #              '_minstart_at_orig_sr', )
+    #              '_minstart_at_orig_sr', '_flat_index', )
     __slots__ = ()
 
     def __init__(self, *args, **kwargs):
@@ -1132,3 +1672,170 @@ def viterbi_smoothing(obs, init, tran, amin=1e-15):
         tokens[t] = backpt[t + 1, tokens[t + 1]]
 
     return tokens
+
+
+class OnlineViterbi(object):
+    """ Viterbi decoder for observations that arrive in blocks, e.g. when streaming.
+
+    The trellis is carried from one block to the next, and the tokens are emitted
+    as soon as they are final, which is when the best paths to all the states
+    converge. Everything before such a convergence-point is the same as what
+    `viterbi_smoothing` would have decoded for all the observations at once.
+
+    The convergence may take arbitrarily long though. With `lag`, the tokens for
+    the observations older than `lag` are emitted anyway, by tracing back from the
+    currently most likely state. A smaller `lag` means lower latency,
+    but the tokens may differ from the ones decoded with all the observations.
+
+    The observations, `init` and `tran` are the same as for `viterbi_smoothing`.
+
+    Example
+    -------
+    >>> decoder = OnlineViterbi(init, tran, lag=100)
+    >>> tokens = [decoder.decode(obs) for obs in blocks_of_obs]
+    >>> tokens.append(decoder.finish())
+    >>> tokens = np.concatenate(tokens)
+    """
+
+    def __init__(self, init, tran, lag=None, amin=1e-15):
+        assert lag is None or lag >= 0, "lag should be None or >= 0, v/s {}".format(lag)
+        self.amin = amin
+        self.init = np.log(np.maximum(amin, init))
+        self.tran = np.log(np.maximum(amin, tran))
+        self.lag = lag
+
+        self._trellis = None  # at the last observation
+        self._backpt = None  # for the observations whose tokens are not emitted yet
+
+    @property
+    def npending(self):
+        """ Number of observations whose tokens are yet to be emitted """
+        return 0 if self._backpt is None else len(self._backpt)
+
+    def _traceback(self, state, upto):
+        """ Tokens for the pending observations till `upto` (incl.), ending in `state` """
+        tokens = np.empty(upto + 1, dtype=np.int)
+        tokens[upto] = state
+        for t in range(upto - 1, -1, -1):
+            tokens[t] = self._backpt[t + 1, tokens[t + 1]]
+
+        return tokens
+
+    def _convergence_point(self):
+        """ The latest pending position where the best paths to all states converge """
+        paths = np.arange(self._backpt.shape[1])
+        for t in range(len(self._backpt) - 1, 0, -1):
+            paths = self._backpt[t, paths]
+            if np.all(paths == paths[0]):
+                return t - 1, paths[0]
+
+        return -1, None
+
+    def _emit(self, upto, state):
+        """ Emit the tokens till pending position `upto`, and keep the rest pending """
+        tokens = self._traceback(state, upto)
+        self._backpt = self._backpt[upto + 1:]
+        return tokens
+
+    def decode(self, obs):
+        """ Decode the next block of observations, and return the tokens that are final.
+
+        The returned tokens are for the earliest observations whose tokens have not
+        been returned yet, and there may be none.
+        """
+        obs = np.log(np.maximum(self.amin, obs))
+        if len(obs) == 0:
+            return np.empty(0, dtype=np.int)
+
+        backpt = np.ones_like(obs, dtype=np.int) * -1
+        if self._trellis is None:
+            trellis_last = self.init + obs[0, ...]
+            start = 1
+        else:
+            trellis_last = self._trellis
+            start = 0
+
+        for t in range(start, len(obs)):
+            x = trellis_last[None, ...] + self.tran
+            backpt[t, ...] = np.argmax(x, axis=1)
+            trellis_last = np.max(x, axis=1) + obs[t, ...]
+
+        self._trellis = trellis_last
+        if self._backpt is None:
+            self._backpt = backpt
+        else:
+            self._backpt = np.concatenate([self._backpt, backpt])
+
+        tokens = []
+        upto, state = self._convergence_point()
+        if upto >= 0:
+            tokens.append(self._emit(upto, state))
+
+        if self.lag is not None and self.npending > self.lag:
+            # NOTE: forced, and may differ from the tokens decoded at the end
+            upto = self.npending - self.lag - 1
+            state = self._traceback(self._trellis.argmax(), self.npending - 1)[upto]
+            tokens.append(self._emit(upto, state))
+
+        return np.concatenate(tokens) if tokens else np.empty(0, dtype=np.int)
+
+    def finish(self):
+        """ Return the tokens for all the pending observations, and reset the decoder """
+        if self.npending > 0:
+            tokens = self._traceback(self._trellis.argmax(), self.npending - 1)
+        else:
+            tokens = np.empty(0, dtype=np.int)
+
+        self._trellis, self._backpt = None, None
+        return tokens
+
+
+def viterbi_smoothing_batch(obs_seqs, init, tran, amin=1e-15):
+    """ Viterbi decode many sequences of observations together.
+
+    Gives the same tokens as `viterbi_smoothing` on each of `obs_seqs`, but steps
+    through all the sequences at once, instead of one after the other.
+
+    The sequences can be of different lengths. They are packed one after the other,
+    and sorted by their length, so that at each time-step only the ones that are
+    that long are stepped through. The backpointers are kept in the smallest
+    unsigned dtype for the number of states, e.g. uint8 for <= 256 states.
+
+    Returns a list of tokens for each of `obs_seqs`, in the same order.
+    """
+    lens = np.array([len(o) for o in obs_seqs], dtype=np.int)
+    nstates = init.shape[-1]
+    if lens.sum() == 0:
+        return [np.empty(0, dtype=np.int) for _ in lens]
+
+    # longest first, hence, the sequences still being stepped through are in front
+    order = np.argsort(-lens, kind='mergesort')
+    slens = lens[order]
+    starts = np.concatenate([[0], np.cumsum(lens)[:-1]])[order]
+    nactive = np.searchsorted(-slens, -np.arange(slens[0]), side='left')  # len > t
+
+    obs = np.log(np.maximum(amin, np.concatenate(obs_seqs)))
+    init = np.log(np.maximum(amin, init))
+    tran = np.log(np.maximum(amin, tran))
+
+    backpt = np.zeros(obs.shape, dtype=np.min_scalar_type(nstates - 1))
+    trellis = np.zeros((len(lens), nstates), dtype=obs.dtype)
+    n = nactive[0]
+    trellis[:n] = init + obs[starts[:n], ...]
+    for t in range(1, slens[0]):
+        n = nactive[t]
+        x = trellis[:n, None, :] + tran
+        backpt[starts[:n] + t, ...] = np.argmax(x, axis=2)
+        trellis[:n] = np.max(x, axis=2) + obs[starts[:n] + t, ...]
+
+    # the trellis of sequences that ended earlier were left as they were at their end
+    tokens = np.ones(len(obs), dtype=np.int) * -1
+    n = nactive[0]
+    states = trellis[:n].argmax(axis=1)
+    tokens[starts[:n] + slens[:n] - 1] = states
+    for t in range(slens[0] - 2, -1, -1):
+        n = nactive[t + 1]  # the ones that have a token at t + 1 to trace back from
+        states[:n] = backpt[starts[:n] + t + 1, states[:n]]
+        tokens[starts[:n] + t] = states[:n]
+
+    return np.split(tokens, np.cumsum(lens)[:-1])
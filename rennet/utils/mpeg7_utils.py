@@ -17,9 +17,12 @@
 Created: 21-11-2017
 """
 from __future__ import division, absolute_import, print_function
+import re
 import warnings
 import xml.etree.ElementTree as et
-from six.moves import zip, reduce
+from itertools import compress
+from six.moves import reduce
+import numpy as np
 
 from .py_utils import lowest_common_multiple
 
@@ -57,36 +60,91 @@ MPEG7_TAGS = {
     "givenname": ".//mpeg7:GivenName",
 }
 
+# '[date]Thh:mm:ss:nFN', with n fractions of the N fractions per second
+TIMEPOINT_REGEX = re.compile(r'^[^T\n]*T(\d+):(\d+):(\d+):(\d+)F(\d+)$', re.MULTILINE)
 
-def parse_mpeg7(filepath, use_tags="ns"):  # pylint: disable=too-many-locals,too-complex
-    """ Parse MPEG7 speech annotations into lists of data
+# 'P[nD]T[nH][nM][nS][nN]NF', with n fractions of the N fractions per second
+DURATION_REGEX = re.compile(
+    r'^[^T\n]*T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?(?:(\d+)N)?(\d+)F$', re.MULTILINE
+)
 
-    """
-    tree = et.parse(filepath)
-    root = tree.getroot()
 
+def _tags_for(use_tags):
     if use_tags == "mpeg7":
-        tags = MPEG7_TAGS
+        return MPEG7_TAGS
     elif use_tags == "ns":
-        tags = NS2_TAGS
+        return NS2_TAGS
     else:
         raise ValueError("Supported `use_tags` : 'mpeg7' and 'ns'.")
 
+
+def parse_mpeg7(filepath, use_tags="ns"):
+    """ Parse MPEG7 speech annotations into lists of data
+
+    """
+    tree = et.parse(filepath)
+    root = tree.getroot()
+    tags = _tags_for(use_tags)
+
     # find all AudioSegments
     segments = root.findall(tags["audiosegment"], MPEG7_NAMESPACES)
-    if not segments:
-        raise ValueError("No AudioSegment tags found. Check your xml file.")
+    return _parse_segments(segments, tags, filepath)
+
+
+def iterparse_mpeg7(filepath, use_tags="ns"):
+    """ Parse MPEG7 speech annotations into lists of data, streaming through the file.
+
+    Same as `parse_mpeg7`, but the AudioSegments are parsed as soon as they are read,
+    and then cleared, instead of first loading the whole tree of the file in memory.
+    """
+    tags = _tags_for(use_tags)
+    return _parse_segments(_iter_segments(filepath, tags), tags, filepath)
+
+
+def _clark_tag(tag):
+    """ '{namespace}name' for a 'prefix:name' tag, as used by ElementTree """
+    prefix, name = tag.split('/')[-1].split(':')
+    return "{{{}}}{}".format(MPEG7_NAMESPACES[prefix], name)
+
 
-    starts_ends = []
-    persecs = []
-    speakerids = []
-    genders = []
-    givennames = []
-    confidences = []
-    transcriptions = []
+def _iter_segments(filepath, tags):
+    """ Stream through the AudioSegments in `filepath` in the same order as `findall`.
+
+    An outermost AudioSegment is yielded, along with the ones inside it, once it is
+    read completely. It is then cleared before reading further.
+    """
+    segtag = _clark_tag(tags["audiosegment"])
+    root = None
+    depth = 0
+    for event, elem in et.iterparse(filepath, events=('start', 'end')):
+        if root is None:
+            # findall will not include the root, even when it is an AudioSegment
+            root = elem
+            continue
+        elif elem.tag != segtag:
+            continue
+
+        if event == 'start':
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 0:
+            for segment in elem.iter(segtag):
+                yield segment
+
+            elem.clear()
+
+
+def _parse_segments(segments, tags, filepath):  # pylint: disable=too-many-locals
+    positions = []
+    timepoints = []
+    durations = []
+    descriptions = []
+    i = -1
     for i, s in enumerate(segments):
         try:
-            start_end_persec, descriptor = _parse_segment(s, tags)
+            timepoint, duration, descriptor = _parse_segment(s, tags)
         except ValueError:
             print("Segment number :%d" % (i + 1))
             raise
@@ -95,94 +153,124 @@ def parse_mpeg7(filepath, use_tags="ns"):  # pylint: disable=too-many-locals,too
             # NOTE: if there is not descriptor, there is no speech. Ignore!
             continue
 
-        if start_end_persec[1] <= start_end_persec[0]:  # (end - start) <= 0
-            msg = (
-                "(end - start) <= 0 ignored for annotation at position "
-                "{} with values {} in file:\n{}".format(i, start_end_persec, filepath)
-            )
-
-            warnings.warn(RuntimeWarning(msg))
-            continue
-
-        starts_ends.append(start_end_persec[:-1])
-        persecs.append(start_end_persec[-1])
+        positions.append(i)
+        timepoints.append(timepoint)
+        durations.append(duration)
 
         try:
             sid, gen, gname, conf, tran = _parse_descriptor(descriptor, tags)
         except ValueError:
             print("Segment number:%d" % (i + 1))
 
-        speakerids.append(sid)
-        genders.append(gen)
-        givennames.append(gname)
-        confidences.append(conf)
-        transcriptions.append(tran)
+        descriptions.append((sid, gen, gname, conf, tran))
 
-    starts_ends, persecs = _sanitize_starts_ends(starts_ends, persecs)
+    if i < 0:
+        raise ValueError("No AudioSegment tags found. Check your xml file.")
 
-    return (
-        starts_ends, persecs, speakerids, genders, givennames, confidences, transcriptions
-    )
+    starts_ends, persec = parse_timestrings(timepoints, durations)
 
+    valid = starts_ends[:, 1] > starts_ends[:, 0]
+    for j in np.where(~valid)[0]:
+        msg = (
+            "(end - start) <= 0 ignored for annotation at position "
+            "{} with values {} in file:\n{}".format(
+                positions[j], tuple(starts_ends[j].tolist()) + (persec, ), filepath
+            )
+        )
 
-def _parse_segment(segment, tags):
-    timepoint = segment.find(tags["timepoint"], MPEG7_NAMESPACES).text
-    duration = segment.find(tags["duration"], MPEG7_NAMESPACES).text
-    descriptor = segment.find(tags["descriptor"], MPEG7_NAMESPACES)
+        warnings.warn(RuntimeWarning(msg))
 
-    if any(d is None for d in [timepoint, duration]):  #, descriptor]):
-        raise ValueError("timepoint, duration or decriptor not found in segment")
+    if not np.all(valid):
+        # persec only for the ones left
+        starts_ends, persec = parse_timestrings(
+            list(compress(timepoints, valid)), list(compress(durations, valid))
+        )
+        descriptions = list(compress(descriptions, valid))
 
-    start_end_persec = _parse_timestring(timepoint, duration)
+    speakerids, genders, givennames, confidences, transcriptions = (
+        [d[k] for d in descriptions] for k in range(5)
+    )
 
-    return start_end_persec, descriptor
+    return (
+        [tuple(se) for se in starts_ends.tolist()], persec, speakerids, genders, givennames,
+        confidences, transcriptions
+    )
 
 
-def _parse_timestring(timepoint, duration):
-    tpt, tps = _parse_timepoint(timepoint)
-    dur, dps = _parse_duration(duration)
+def parse_timestrings(timepoints, durations):
+    """ Parse MPEG7 timepoint and duration strings into starts and ends, all at once.
+
+    Parameters
+    ----------
+    timepoints: list of str
+        Like 'T00:01:02:3F25', i.e. starting at 3/25-th of a second after 62 seconds.
+    durations: list of str
+        Like 'PT1M2S3N25F', i.e. lasting 3/25-th of a second more than 62 seconds.
+
+    Returns
+    -------
+    starts_ends: numpy.ndarray
+        Of shape (len(timepoints), 2), with the integer start and end for each,
+        in samples at `persec`.
+    persec: int
+        Lowest common multiple of all the fractions per second, so that there are no
+        rounding errors.
+
+    Raises
+    ------
+    ValueError
+        If any of the strings is not in the expected format.
+    """
+    if len(timepoints) != len(durations):
+        raise ValueError(
+            "Number of timepoints {} and durations {} are different".format(
+                len(timepoints), len(durations)
+            )
+        )
 
-    # bring them to the same persec before calculating end
-    persec = lowest_common_multiple(tps, dps)
-    tpt *= (persec // tps)
-    return tpt, tpt + dur * (persec // dps), persec
+    if not timepoints:
+        return np.zeros((0, 2), dtype=np.int64), 1
 
+    tps = _parse_time_values(TIMEPOINT_REGEX, timepoints)
+    durs = _parse_time_values(DURATION_REGEX, durations)
 
-def _parse_timepoint(timepoint):
-    _, timepoint = timepoint.split('T')  # 'T' indicates the rest part is time
-    hours, minutes, sec, timepoint = timepoint.split(':')
+    tpersec, dpersec = tps[:, -1], durs[:, -1]
+    persec = reduce(lowest_common_multiple, set(tpersec.tolist() + dpersec.tolist()), 1)
 
-    # timepoint will have the nFN
-    # n = number of fraction of seconds
-    # N = the standard number of fractions per second
-    val, persec = timepoint.split('F')
+    # NOTE: Convert with integer ops only, the float sums are not great
+    seconds = [3600, 60, 1]
+    starts = (tps[:, :3].dot(seconds) * tpersec + tps[:, 3]) * (persec // tpersec)
+    ends = starts + (durs[:, :3].dot(seconds) * dpersec + durs[:, 3]) * (persec // dpersec)
 
-    res = int(hours) * 3600 +\
-          int(minutes) * 60 +\
-          int(sec)
+    return np.stack([starts, ends], axis=1), persec
 
-    return res * int(persec) + int(val), int(persec)
 
+def _parse_time_values(regex, strings):
+    """ Array of (hours, minutes, seconds, fractions, fractions per second) for each string
 
-def _parse_duration(duration):
-    _, duration = duration.split('T')
+    All the strings are matched at once, one per line, with the missing values as 0.
+    """
+    strings = [s.strip() for s in strings]
+    values = regex.findall("\n".join(strings))
+    if len(values) != len(strings) or any("\n" in s for s in strings):
+        for i, s in enumerate(strings):
+            if "\n" in s or regex.match(s) is None:
+                raise ValueError("Unexpected time-string {!r} at position {}".format(s, i))
 
-    splits = [0] * 5
-    for i, marker in enumerate(['H', 'M', 'S', 'N', 'F']):
-        if marker in duration:
-            value, duration = duration.split(marker)
-            splits[i] = int(value)
-        else:
-            splits[i] = 0
+    values = np.array(values).reshape(-1, 5)
+    values[values == ''] = '0'
+    return values.astype(np.int64)
+
+
+def _parse_segment(segment, tags):
+    timepoint = segment.find(tags["timepoint"], MPEG7_NAMESPACES).text
+    duration = segment.find(tags["duration"], MPEG7_NAMESPACES).text
+    descriptor = segment.find(tags["descriptor"], MPEG7_NAMESPACES)
 
-    hours, minutes, sec, val, persec = splits
-    res = int(hours) * 3600 +\
-          int(minutes) * 60 +\
-          int(sec)
+    if any(d is None for d in [timepoint, duration]):  #, descriptor]):
+        raise ValueError("timepoint, duration or decriptor not found in segment")
 
-    return res * int(persec) + int(val), int(
-        persec
-    )  # need to send separately as the float sum is not great
+    return timepoint, duration, descriptor
 
 
 def _parse_descriptor(descriptor, tags):
@@ -198,11 +286,3 @@ def _parse_descriptor(descriptor, tags):
         raise ValueError("Some descriptor information is None / not found")
 
     return speakerid, gender, givenname, confidence, transcription
-
-
-def _sanitize_starts_ends(starts_ends, persecs):
-    """ Sanitize starts ends to be of the same samplerate (persec) """
-    persec = reduce(lowest_common_multiple, set(persecs))
-    return [
-        (s * persec // p, e * persec // p) for (s, e), p in zip(starts_ends, persecs)
-    ], persec
@@ -200,3 +200,36 @@ def makedirs_with_existok(name, exist_ok=False):
                 pass
             else:
                 raise
+
+
+def imap_indexed(func, indexed, workers=1, chunksize=1):
+    """ Yield `func((index, item))` for each `(index, item)` in `indexed`, as they complete
+    in a pool of `workers` processes.
+
+    With `workers == 1`, they are run one after the other in this process, in order.
+    Else, `func` should be picklable, e.g. a module-level function or a `partial` of one,
+    and it should return the `index` in its result, since the order may be different.
+
+    The pool is closed once all of them are done, and terminated only if the caller
+    stops early, or there is an error.
+    """
+    if workers == 1:
+        for index_item in indexed:
+            yield func(index_item)
+
+        return
+
+    from multiprocessing import Pool
+
+    pool = Pool(workers)
+    try:
+        for result in pool.imap_unordered(func, indexed, chunksize):
+            yield result
+    except:  # pylint: disable=bare-except
+        # NOTE: includes GeneratorExit when the caller stops early
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
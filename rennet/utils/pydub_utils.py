@@ -14,13 +14,25 @@
 """Utilities for audio-io and conversions using Pydub.
 Separated from `audio_utils` to remove dependency, I guess.
 
+Can also be run to convert a batch of media files to the standard format, e.g.:
+
+    python -m rennet.utils.pydub_utils --todir wav8k --samplerate 8000 --workers 8 *.sph
+
+Run with `--help` for all the options.
+
 @motjuste
 Created: 11-10-2017
 """
 from __future__ import print_function, division, absolute_import
+import argparse
+import json
 import subprocess as sp
 import os
+import sys
+import traceback
 import warnings
+from collections import namedtuple
+from functools import partial
 from tempfile import NamedTemporaryFile
 from six.moves import range
 from pydub import AudioSegment
@@ -29,7 +41,9 @@ from .audio_utils import (
     AudioMetadata,
     get_audio_metadata,
     get_sph2pipe,
+    read_sph,
 )
+from .py_utils import imap_indexed
 
 
 class AudioIO(AudioSegment):
@@ -40,6 +54,12 @@ class AudioIO(AudioSegment):
         meta = get_audio_metadata(file)
 
         if meta.format == 'sph' or format == 'sph':
+            try:
+                return cls._from_sph_native(meta.filepath)
+            except ValueError:
+                # Not PCM or ulaw, e.g. shorten compressed. Let sph2pipe handle it.
+                pass
+
             output = NamedTemporaryFile(mode='rb', delete=False)
 
             # check if sph2pipe is provided or else, is it available on path
@@ -89,6 +109,20 @@ class AudioIO(AudioSegment):
     def from_sph(cls, file_path):
         return cls.from_file(file_path, format='sph')
 
+    @classmethod
+    def _from_sph_native(cls, file_path):
+        """ Read a PCM or ulaw SPHERE file directly, without sph2pipe and a temporary WAV.
+
+        Raises ValueError for other encodings.
+        """
+        data, samplerate = read_sph(file_path)
+        return cls(
+            data=data.astype('<i2').tobytes(),  # interleaved 16 bit PCM, as from sph2pipe
+            sample_width=2,
+            frame_rate=samplerate,
+            channels=data.shape[1],
+        )
+
     @classmethod
     def from_audiometadata(cls, audiometadata):
         """ classmethod to create new AudioIO object from AudioMetadata, PLUS
@@ -151,7 +185,7 @@ def convert_to_standard(
         filepath, todir, tofmt="wav", samplerate=16000, channels=1, **kwargs
 ):  # yapf: disable
     """ Convert a single media file to the standard format """
-    tofilename = os.path.splitext(os.path.basename(filepath))[0] + "." + tofmt
+    tofilename = standard_tofilenames(filepath, tofmt)[0]
     tofilepath = os.path.join(todir, tofilename)
     s = AudioIO.from_file(filepath, **kwargs)
     f = s.export_standard(tofilepath, samplerate=samplerate, channels=channels, fmt=tofmt)
@@ -165,14 +199,258 @@ def convert_to_standard_split(filepath, todir, tofmt="wav", samplerate=16000, **
 
     splits = s.split_to_mono()
 
-    tofilename = os.path.splitext(os.path.basename(filepath))[0]
-    tofilenames = []
-    for i, split in enumerate(splits):
-        _tofilename = tofilename + ".c{}.".format(i) + tofmt
+    tofilenames = standard_tofilenames(filepath, tofmt, nsplits=len(splits))
+    for _tofilename, split in zip(tofilenames, splits):
         tofilepath = os.path.join(todir, _tofilename)
-        tofilenames.append(_tofilename)
 
         f = split.export(tofilepath, format=tofmt)
         f.close()
 
     return tofilenames
+
+
+def standard_tofilenames(filepath, tofmt="wav", nsplits=None):
+    """ Names of the files `filepath` is converted to by `convert_to_standard`, or by
+    `convert_to_standard_split` into `nsplits` channels.
+    """
+    tofilename = os.path.splitext(os.path.basename(filepath))[0]
+    if nsplits is None:
+        return [tofilename + "." + tofmt]
+
+    return [tofilename + ".c{}.".format(i) + tofmt for i in range(nsplits)]
+
+
+# The result of converting the `index`-th of the filepaths.
+# `status` is one of 'converted', 'skipped' (already up-to-date) or 'failed'.
+# `error` is the formatted traceback of the exception on failure, else `None`.
+ConvertedFile = namedtuple(
+    'ConvertedFile', ['index', 'filepath', 'tofilenames', 'status', 'error']
+)
+
+
+def _up_to_date_tofilenames(  # pylint: disable=too-many-arguments
+        filepath, todir, split=False, tofmt="wav", samplerate=16000, channels=1, **_):
+    """ Names of the converted files in `todir` for `filepath` if all of them are newer
+    than it, and have the expected samplerate, nchannels and duration, else `None`.
+    """
+    meta = get_audio_metadata(filepath)
+    tofilenames = standard_tofilenames(filepath, tofmt, meta.nchannels if split else None)
+    for tofilename in tofilenames:
+        tofilepath = os.path.join(todir, tofilename)
+        if not os.path.isfile(tofilepath):
+            return None
+        elif os.path.getmtime(tofilepath) < os.path.getmtime(filepath):
+            return None
+
+        try:
+            tometa = get_audio_metadata(tofilepath)
+        except (RuntimeError, ValueError, IOError, OSError):  # pylint: disable=overlapping-except
+            return None
+
+        if (tometa.samplerate, tometa.nchannels) != (samplerate, 1 if split else channels):
+            return None
+        elif abs(tometa.seconds - meta.seconds) > 0.05:  # e.g. left half-written
+            return None
+
+    return tofilenames
+
+
+def _convert_file(todir, split, force, kwargs, clashing, index_filepath):  # pylint: disable=too-many-arguments
+    # module-level to be picklable for a pool of processes
+    index, filepath = index_filepath
+    if index in clashing:
+        return ConvertedFile(index, filepath, [], 'failed', clashing[index])
+
+    try:
+        if not force:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # inexact metadata from the codec
+                tofilenames = _up_to_date_tofilenames(filepath, todir, split, **kwargs)
+
+            if tofilenames is not None:
+                return ConvertedFile(index, filepath, tofilenames, 'skipped', None)
+
+        if split:
+            kwargs = dict(kwargs)
+            kwargs.pop('channels', None)  # all are split into mono
+            tofilenames = convert_to_standard_split(filepath, todir, **kwargs)
+        else:
+            tofilenames = convert_to_standard(filepath, todir, **kwargs)
+
+        return ConvertedFile(index, filepath, tofilenames, 'converted', None)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:  # pylint: disable=bare-except
+        # NOTE: Catch all, so that one mis-behaving file doesn't mess all of them
+        return ConvertedFile(index, filepath, [], 'failed', traceback.format_exc())
+
+
+def _clashing_tofilenames(filepaths):
+    """ Error for each index of `filepaths` whose converted files would have the same
+    names as those of another one, since they all are written to the same `todir`.
+    """
+    bynames = dict()
+    for index, filepath in enumerate(filepaths):
+        bynames.setdefault(standard_tofilenames(filepath, "")[0], []).append(index)
+
+    errors = dict()
+    for indices in bynames.values():
+        if len(indices) > 1:
+            for index in indices:
+                errors[index] = (
+                    "ValueError: The converted files of {} will have the same names as "
+                    "those of {}".format(
+                        filepaths[index],
+                        ", ".join(filepaths[i] for i in indices if i != index),
+                    )
+                )
+
+    return errors
+
+
+def iconvert_to_standard_batch(  # pylint: disable=too-many-arguments
+        filepaths, todir, split=False, workers=1, force=False, chunksize=1, **kwargs):
+    """ Convert each of `filepaths` to the standard format in `todir`, yielding
+    `ConvertedFile` as they complete.
+
+    Parameters
+    ----------
+    filepaths: list of str
+    todir: str
+        Created right away if it doesn't exist, before any of the files are converted.
+    split: bool
+        Whether to split the channels into separate mono files with
+        `convert_to_standard_split`, else to convert with `convert_to_standard`.
+    workers: int
+        Number of processes to convert the files in. With 1, they are converted one after
+        the other in this process, and in the same order as `filepaths`.
+    force: bool
+        Whether to convert a file even if its converted files in `todir` are up-to-date,
+        i.e. newer than it, and with the expected samplerate, nchannels and duration.
+    chunksize: int
+        Number of files sent to a process at once.
+    kwargs:
+        Passed on to the convert function, e.g. `tofmt`, `samplerate`, `channels`.
+
+    Yields
+    ------
+    ConvertedFile
+        With the `index` of its filepath in `filepaths`, since the order may be different.
+        Errors in converting a file are reported in it, and don't stop the others.
+        The files whose converted files will have the same names in `todir`, e.g.
+        'a/x.sph' and 'b/x.sph', all fail without being converted.
+    """
+    if not os.path.isdir(todir):
+        os.makedirs(todir)
+
+    clashing = _clashing_tofilenames(filepaths)
+    convert = partial(_convert_file, todir, split, force, kwargs, clashing)
+    return imap_indexed(convert, list(enumerate(filepaths)), workers, chunksize)
+
+
+def convert_to_standard_batch(  # pylint: disable=too-many-arguments
+        filepaths, todir, split=False, workers=1, force=False, manifest=None, **kwargs):
+    """ Convert each of `filepaths` to the standard format in `todir` in a pool of
+    `workers` processes.
+
+    Returns the list of `ConvertedFile` in the same order as `filepaths`.
+    If `manifest` is a filepath, each of them is also written to it as a line of JSON as
+    soon as it completes.
+    See `iconvert_to_standard_batch` for the other parameters.
+    """
+    converting = iconvert_to_standard_batch(
+        filepaths, todir, split=split, workers=workers, force=force, **kwargs
+    )
+
+    converted = [None] * len(filepaths)
+    mf = open(manifest, 'w') if manifest is not None else None
+    try:
+        for c in converting:
+            converted[c.index] = c
+            if mf is not None:
+                mf.write(json.dumps(c._asdict()) + "\n")
+                mf.flush()
+    finally:
+        if mf is not None:
+            mf.close()
+
+    return converted
+
+
+def main(argv=None):
+    """ Convert a batch of media files to the standard format from the command line.
+
+    Returns the exit code, 1 if any of the files failed to convert, else 0.
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert media files to the standard format, e.g. 16kHz mono WAV.",
+        prog='python -m rennet.utils.pydub_utils'
+    )
+    parser.add_argument(
+        'infilepaths', nargs='*', help="Paths to the media files to be converted"
+    )
+    parser.add_argument(
+        '--fromlist',
+        type=argparse.FileType('r'),
+        help="File with more paths to media files, one per line",
+    )
+    parser.add_argument('--todir', required=True, help="Path to the output directory")
+    parser.add_argument('--tofmt', default="wav", help="Output format (default: wav)")
+    parser.add_argument(
+        '--samplerate', type=int, default=16000, help="Output samplerate (default: 16000)"
+    )
+    parser.add_argument(
+        '--channels', type=int, default=1, help="Output nchannels (default: 1)"
+    )
+    parser.add_argument(
+        '--split',
+        action='store_true',
+        help="Split the channels into separate mono files instead",
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1, help="Number of processes (default: 1)"
+    )
+    parser.add_argument(
+        '--force', action='store_true', help="Convert even the up-to-date files too"
+    )
+    parser.add_argument(
+        '--manifest',
+        default=None,
+        help="Path to write the results to (default: TODIR/manifest.jsonl)",
+    )
+    args = parser.parse_args(argv)
+
+    filepaths = list(args.infilepaths)
+    if args.fromlist is not None:
+        filepaths.extend(l.strip() for l in args.fromlist if l.strip())
+
+    manifest = args.manifest
+    if manifest is None:
+        manifest = os.path.join(args.todir, "manifest.jsonl")
+
+    converted = convert_to_standard_batch(
+        filepaths,
+        args.todir,
+        split=args.split,
+        workers=args.workers,
+        force=args.force,
+        manifest=manifest,
+        tofmt=args.tofmt,
+        samplerate=args.samplerate,
+        channels=args.channels,
+    )
+
+    statuses = [c.status for c in converted]
+    print(
+        "Converted: {}, Skipped: {}, Failed: {}. Check {}".format(
+            statuses.count('converted'),
+            statuses.count('skipped'),
+            statuses.count('failed'),
+            manifest,
+        )
+    )
+    return 1 if 'failed' in statuses else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
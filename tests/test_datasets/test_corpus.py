@@ -0,0 +1,95 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test loading the annotations for a whole corpus at once
+
+@motjuste
+Created: 18-10-2026
+"""
+from __future__ import print_function, division
+from threading import Thread
+import pytest
+import numpy as np
+import numpy.testing as npt
+
+from rennet.datasets import timit
+from rennet.datasets.corpus import load_corpus, iload_corpus, load_corpus_values
+
+# pylint: disable=redefined-outer-name, invalid-name, missing-docstring
+
+
+@pytest.fixture(scope='module')
+def timit_corpus(tmpdir_factory):
+    root = tmpdir_factory.mktemp('timit')
+    rs = np.random.RandomState(32)
+    filepaths = []
+    for i in range(40):
+        fp = root.join("{:02}.phn".format(i))
+        if i % 13 == 5:
+            fp.write("0 not-a-number h#\n")  # broken file
+        else:
+            ends = np.cumsum(rs.randint(1, 1000, size=20))
+            fp.write("".join("{} {} p{}\n".format(s, e, j)
+                             for j, (s, e) in enumerate(zip(ends[:-1], ends[1:]))))
+        filepaths.append(str(fp))
+
+    return filepaths
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_load_corpus(timit_corpus, workers):
+    loaded = load_corpus(timit_corpus, timit.Annotations, workers=workers, chunksize=2)
+
+    assert [l.filepath for l in loaded] == timit_corpus
+    assert [l.index for l in loaded] == list(range(len(timit_corpus)))
+    for i, l in enumerate(loaded):
+        if i % 13 == 5:
+            assert l.value is None
+            assert 'ValueError' in l.error
+        else:
+            assert l.error is None
+            expected = timit.Annotations.from_file(timit_corpus[i])
+            npt.assert_array_equal(expected.starts_ends, l.value.starts_ends)
+            npt.assert_array_equal(expected.labels, l.value.labels)
+
+
+def test_iload_corpus_streams_all(timit_corpus):
+    loaded = iload_corpus(timit_corpus, timit.Annotations, workers=3, samplerate=100)
+    first = next(loaded)
+    assert first.value is None or first.value.samplerate == 100
+
+    rest = list(loaded)
+    assert sorted(l.index for l in [first] + rest) == list(range(len(timit_corpus)))
+
+    # stopping early is fine too, without hanging
+    loaded = iload_corpus(timit_corpus, timit.Annotations, workers=3, chunksize=1)
+    next(loaded)
+    closing = Thread(target=loaded.close)
+    closing.daemon = True
+    closing.start()
+    closing.join(timeout=60)
+    assert not closing.is_alive(), "Stopping early did not finish in time"
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_load_corpus_values(timit_corpus, workers):
+    good = [fp for i, fp in enumerate(timit_corpus) if i % 13 != 5]
+    values = load_corpus_values(good, timit.Annotations, workers=workers)
+    assert [v.sourcefile for v in values] == good
+
+    # all are tried, before raising for the broken ones
+    with pytest.raises(RuntimeError) as excinfo:
+        load_corpus_values(timit_corpus, timit.Annotations, workers=workers)
+
+    assert "3 of the 40 files" in str(excinfo.value)
+    assert timit_corpus[5] in str(excinfo.value)
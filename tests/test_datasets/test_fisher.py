@@ -0,0 +1,214 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the helpers for the Fisher dataset
+
+@motjuste
+Created: 18-10-2026
+"""
+from __future__ import print_function, division
+import os
+from csv import reader
+from timeit import default_timer as timer
+import pytest
+import numpy as np
+import numpy.testing as npt
+
+from rennet.datasets import fisher as fe
+
+# pylint: disable=redefined-outer-name, invalid-name, missing-docstring
+
+
+def synthetic_transcripts(nannots, seed):
+    rs = np.random.RandomState(seed)
+    # in tenths of a second, so that they are exact with one or two decimals
+    starts = np.cumsum(rs.randint(1, 50, size=nannots))
+    ends = starts + rs.randint(1, 100, size=nannots)
+    ndecimals = rs.randint(1, 3, size=(nannots, 2))
+
+    lines = ["# fe_03_{:05}.sph".format(seed), ""]
+    for (s, e), (ns, ne), spk in zip(
+            np.stack([starts, ends], axis=1), ndecimals, rs.choice(['A', 'B'], nannots)):
+        lines.append(
+            "{:.{}f} {:.{}f} {}: word{} and  another ".format(s / 10, ns, e / 10, ne, spk, s)
+        )
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def csv_parse_transcripts(filepath):
+    """ The csv based parser that was used before, as reference """
+    starts, ends, decimultiplier, channels, contents = [], [], [], [], []
+    with open(filepath, 'r') as f:
+        for row in reader(f, delimiter=':'):
+            if not row or row[0][0] == '#':
+                continue
+
+            s, e, spk = row[0].split(' ')
+            s = s.split('.')
+            e = e.split('.')
+            decimultiplier.append(tuple(map(len, (s[1], e[1]))))  # pylint: disable=bad-builtin
+            starts.append(tuple(map(int, s)))  # pylint: disable=bad-builtin
+            ends.append(tuple(map(int, e)))  # pylint: disable=bad-builtin
+            channels.append({'A': 0, 'B': 1}[spk.strip().upper()])
+            contents.append(row[1].strip())
+
+    starts = np.array(starts)
+    ends = np.array(ends)
+    decimultiplier = np.array(decimultiplier)
+
+    samplerate = 10**(np.max(decimultiplier))
+    decimultiplier = 10**(np.max(decimultiplier) - decimultiplier)
+
+    starts = starts[:, 0] * samplerate + starts[:, 1] * decimultiplier[:, 0]
+    ends = ends[:, 0] * samplerate + ends[:, 1] * decimultiplier[:, 1]
+    return starts, ends, samplerate, channels, contents
+
+
+@pytest.fixture(scope='module')
+def synthetic_corpus(tmpdir_factory):
+    root = tmpdir_factory.mktemp('fisher-transcripts')
+    filepaths = []
+    for i in range(50):
+        fp = root.join("fe_03_{:05}.txt".format(i + 1))
+        fp.write(synthetic_transcripts(200, seed=i + 1))
+        filepaths.append(str(fp))
+
+    return filepaths
+
+
+def test_parse_transcripts_same_as_csv(synthetic_corpus):
+    for fp in synthetic_corpus:
+        expected = csv_parse_transcripts(fp)
+        with open(fp, 'r') as f:
+            starts, ends, samplerate, channels, contents = fe.parse_transcripts(f.read())
+
+        npt.assert_array_equal(expected[0], starts)
+        npt.assert_array_equal(expected[1], ends)
+        assert expected[2] == samplerate
+        assert expected[3] == channels.tolist()
+        assert expected[4] == contents
+
+        ann = fe.Annotations.from_file(fp)
+        assert ann.samplerate == expected[2]
+        assert sorted(zip(expected[0], expected[1], expected[3], expected[4])) == sorted(
+            (s, e, t.speakerchannel, t.content) for (s, e), t in ann
+        )
+
+
+def test_parse_transcripts_raises():
+    with pytest.raises(ValueError):
+        fe.parse_transcripts("0.5 1.5 C: hello\n")
+
+    with pytest.raises(ValueError):
+        fe.parse_transcripts("# comment\n\n0.5 1 A: hello\n")
+
+
+@pytest.mark.benchmark
+@pytest.mark.skipif(
+    'RENNET_BENCHMARKS' not in os.environ, reason="opt-in with RENNET_BENCHMARKS=1"
+)
+def test_parse_transcripts_benchmark(synthetic_corpus):
+    s = timer()
+    for fp in synthetic_corpus:
+        csv_parse_transcripts(fp)
+    csv = timer() - s
+
+    s = timer()
+    for fp in synthetic_corpus:
+        with open(fp, 'r') as f:
+            fe.parse_transcripts(f.read())
+    fast = timer() - s
+
+    print("\ntranscripts csv: {:.4f}s, regex: {:.4f}s".format(csv, fast))
+
+
+@pytest.fixture
+def calldata_tbl(tmpdir):
+    rs = np.random.RandomState(32)
+    rows = ["CALL_ID,DATE,TOPICID,SIGGRADE,CNVGRADE,APIN,ASX.DL,APHNUM,APHSET,APHTYP,"
+            "BPIN,BSX.DL,BPHNUM,BPHSET,BPHTYP"]
+    for callid in rs.permutation(300) + 1:
+        rows.append(
+            "{:05},20031221,ENG{:02},{},{},{},f.a,1,2,3,{},m.o,4,5,6".format(
+                callid, callid % 40, rs.randint(1, 5), rs.randint(1, 5),
+                rs.randint(10000), rs.randint(10000)
+            )
+        )
+
+    fp = tmpdir.join("fe_03_p1_calldata.tbl")
+    fp.write("\n".join(rows) + "\n")
+    return str(fp)
+
+
+def test_calldata_from_file_for_callid_uses_index(calldata_tbl):
+    allcalldata = fe.AllCallData.from_file(calldata_tbl)
+    for c in allcalldata.allcalldata[::7]:
+        assert repr(c) == repr(fe.AllCallData.from_file_for_callid(calldata_tbl, c.callid))
+        assert repr(c) == repr(
+            fe.AllCallData.from_file_for_filename(
+                calldata_tbl, "/a/b/fe_03_{}.txt".format(c.callid)
+            )
+        )
+
+    with pytest.raises(KeyError):
+        fe.AllCallData.from_file_for_callid(calldata_tbl, '99999')
+
+    # saved next to the file, and loaded as is from there
+    sidecar = fe.CallDataIndex.sidecar_path(calldata_tbl)
+    npt.assert_array_equal(
+        fe.CallDataIndex.build(calldata_tbl).index, np.load(sidecar, mmap_mode='r')
+    )
+    fe.CallDataIndex._loaded.clear()  # pylint: disable=protected-access
+    assert isinstance(fe.CallDataIndex.for_file(calldata_tbl).index, np.memmap)
+
+
+def test_save_load_with_calldata(synthetic_corpus, calldata_tbl, tmpdir):
+    ann = fe.Annotations.from_file(synthetic_corpus[0], allcalldata=calldata_tbl)
+    act = fe.ActiveSpeakers.from_annotations(ann, warn_duplicates=False)
+
+    for labels in (ann, act):
+        fp = str(tmpdir.join('labels.rsl'))
+        labels.save(fp)
+        loaded = fe.lu.SequenceLabels.load(fp)
+
+        assert type(loaded) is type(labels)  # pylint: disable=unidiomatic-typecheck
+        assert loaded.sourcefile == labels.sourcefile
+        assert loaded.callid == labels.callid
+        assert repr(loaded.calldata) == repr(labels.calldata)
+        npt.assert_array_equal(labels.starts_ends, loaded.starts_ends)
+        if labels.labels.dtype == np.object:
+            assert [repr(l) for l in labels.labels] == [repr(l) for l in loaded.labels]
+        else:
+            npt.assert_array_equal(labels.labels, loaded.labels)
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_active_speakers_from_files(synthetic_corpus, calldata_tbl, processes):
+    filepaths = synthetic_corpus[:10]
+    loaded = fe.ActiveSpeakers.from_files(
+        filepaths, allcalldata=calldata_tbl, warn_duplicates=False, processes=processes
+    )
+    for fp, act in zip(filepaths, loaded):
+        expected = fe.ActiveSpeakers.from_file(
+            fp, allcalldata=calldata_tbl, warn_duplicates=False
+        )
+        assert act.sourcefile == fp
+        npt.assert_array_equal(expected.starts_ends, act.starts_ends)
+        npt.assert_array_equal(expected.labels, act.labels)
+
+    with pytest.raises(RuntimeError):
+        fe.ActiveSpeakers.from_files(
+            filepaths + ["/not/a/transcript.txt"], warn_duplicates=False, processes=processes
+        )
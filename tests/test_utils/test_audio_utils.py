@@ -17,12 +17,19 @@
 Created: 18-08-2016
 """
 from __future__ import print_function, division
+import json
+import os
 from glob import glob
 import sys
 from tempfile import NamedTemporaryFile
 from math import ceil
+from shutil import copyfile
+from struct import pack
 import pytest
+import numpy as np
+import numpy.testing as npt
 from numpy.testing import assert_almost_equal
+from scipy.io import wavfile
 
 import rennet.utils.audio_utils as au
 import rennet.utils.pydub_utils as pu
@@ -153,6 +160,59 @@ def test_valid_audio_metadata(valid_media_files):
 #         assert True
 
 
+def test_which_is_memoised(monkeypatch):
+    au.WHICH_CACHE.clear()
+    assert au.which("surely-not-an-executable") is False
+    codec = au.get_codec()
+
+    def _raise(*_):
+        raise AssertionError("PATH should not be searched again")
+
+    monkeypatch.setattr(au, '_which', _raise)
+    assert au.which("surely-not-an-executable") is False
+    assert au.get_codec() == codec
+
+    monkeypatch.setenv("PATH", "")
+    with pytest.raises(AssertionError):
+        au.which("surely-not-an-executable")  # PATH changed
+
+    au.WHICH_CACHE.clear()
+
+
+def test_get_audio_metadata_batch(tmpdir, monkeypatch):
+    filepaths = []
+    for i in range(6):
+        fp = str(tmpdir.join("{}.wav".format(i)))
+        copyfile(test_1_wav.filepath if i != 3 else test_1_96k_wav.filepath, fp)
+        filepaths.append(fp)
+
+    broken = tmpdir.join("broken.wav")
+    broken.write("not a wav file")
+    filepaths.append(str(broken))
+
+    cachepath = str(tmpdir.join("metadata.json"))
+    with pytest.warns(RuntimeWarning):
+        metadatas = au.get_audio_metadata_batch(filepaths, cache=cachepath, workers=3)
+
+    assert metadatas[-1] is None
+    assert metadatas[:-1] == [au.get_audio_metadata(fp) for fp in filepaths[:-1]]
+    assert metadatas[3].samplerate == 96000
+
+    # loaded from the cache file, without probing
+    probed = []
+    get_audio_metadata = au.get_audio_metadata
+    monkeypatch.setattr(
+        au, 'get_audio_metadata', lambda fp: probed.append(fp) or get_audio_metadata(fp)
+    )
+    broken.write("still not a wav file")
+    os.utime(filepaths[2], None)
+    with pytest.warns(RuntimeWarning):
+        cached = au.get_audio_metadata_batch(filepaths, cache=cachepath)
+
+    assert sorted(probed) == sorted([filepaths[2], filepaths[-1]])
+    assert cached[:2] + cached[3:-1] == metadatas[:2] + metadatas[3:-1]
+
+
 # LOAD_AUDIO ############################################################## LOAD_AUDIO #
 def test_load_audio_as_is(valid_media_files):
     correct_sr = valid_media_files.samplerate
@@ -195,6 +255,205 @@ def test_load_audio_with_defaults(valid_media_files):
     assert_almost_equal(data_defaults, data)
 
 
+def test_load_audio_wav_direct(valid_wav_files):
+    filepath = valid_wav_files.filepath
+    sr = valid_wav_files.samplerate
+    _, whole = wavfile.read(filepath)
+
+    data = au.load_audio(filepath, samplerate=sr, mono=False)
+    assert data.dtype == np.float32
+    npt.assert_array_equal(whole / 32768, data)
+
+    data = au.load_audio(filepath, samplerate=None, offset=0.5, duration=1.25)
+    npt.assert_array_equal((whole / 32768).mean(axis=1)[sr // 2:sr // 2 + sr * 5 // 4], data)
+
+    data = au.load_audio(filepath, samplerate=sr, mono=False, mmap=True, offset=2)
+    assert isinstance(data, np.memmap)
+    npt.assert_array_equal(whole[sr * 2:], data)
+    npt.assert_array_equal(whole[sr * 2:] / 32768, au.as_float(data))
+
+    with pytest.raises(ValueError):
+        au.load_audio(filepath, samplerate=sr, mmap=True)  # mono
+
+    with pytest.raises(ValueError):
+        au.load_audio(filepath, samplerate=sr // 2, mono=False, mmap=True)  # resample
+
+
+def test_load_audio_wav_direct_parser_errors(valid_wav_files, tmpdir, monkeypatch):
+    filepath = valid_wav_files.filepath
+    sr = valid_wav_files.samplerate
+
+    # newer versions of scipy also return whether the file is RF64
+    read_riff_chunk = wavfile._read_riff_chunk  # pylint: disable=protected-access
+    monkeypatch.setattr(
+        wavfile, '_read_riff_chunk', lambda fid: read_riff_chunk(fid) + (False, )
+    )
+    assert isinstance(au.load_audio(filepath, samplerate=sr, mono=False, mmap=True), np.memmap)
+    monkeypatch.undo()
+
+    # a broken header, here of a too short fmt chunk, is not mistaken for not a WAV file
+    broken = tmpdir.join("broken.wav")
+    broken.write_binary(b'RIFF' + pack('<I', 20) + b'WAVEfmt ' + pack('<I', 8) + b'\0' * 8)
+    with pytest.raises(ValueError) as excinfo:
+        au.load_audio(str(broken), samplerate=sr, mono=False, mmap=True)
+    assert "can be memory-mapped" not in str(excinfo.value)
+
+    # ... while any other file is left to be read otherwise
+    notwav = tmpdir.join("notwav.wav")
+    notwav.write("not a wav file")
+    assert au._memmap_direct(str(notwav), None) is None  # pylint: disable=protected-access
+
+
+# ITER_AUDIO_BLOCKS ################################################ ITER_AUDIO_BLOCKS #
+def assert_blocks_same_as_whole(blocks, whole, blocksize, overlap):
+    hop = blocksize - overlap
+    for i, block in enumerate(blocks):
+        assert block.dtype == np.float32
+        assert len(block) == blocksize or i == len(blocks) - 1
+        npt.assert_array_equal(whole[i * hop:i * hop + blocksize], block)
+
+    assert len(blocks) == max(1, int(ceil((len(whole) - overlap) / hop)))
+
+
+@pytest.mark.parametrize('blocksize, overlap', [(4000, 0), (4000, 176), (1 << 15, 1)])
+def test_iter_audio_blocks_wav(valid_wav_files, blocksize, overlap):
+    filepath = valid_wav_files.filepath
+    _, whole = wavfile.read(filepath)
+    whole = whole / 32768
+
+    blocks = list(au.iter_audio_blocks(filepath, blocksize, overlap=overlap, mono=False))
+    assert blocks[0].shape[1] == valid_wav_files.nchannels
+    assert_blocks_same_as_whole(blocks, whole, blocksize, overlap)
+
+    blocks = list(
+        au.iter_audio_blocks(
+            filepath, blocksize, overlap, samplerate=valid_wav_files.samplerate
+        )
+    )
+    assert_blocks_same_as_whole(blocks, whole.mean(axis=1), blocksize, overlap)
+
+
+def test_iter_audio_blocks_from_pipe(tmpdir):
+    # pylint: disable=protected-access
+    filepath = test_1_wav.filepath
+    cat = [sys.executable, "-c", "import sys, shutil; "
+           "shutil.copyfileobj(open(sys.argv[1], 'rb'), sys.stdout.buffer)"]
+    blocks = list(au._iter_pipe_blocks(cat + [filepath], 3000, 200))
+    expected = list(au.iter_audio_blocks(filepath, 3000, 200, mono=False))
+    assert len(blocks) == len(expected)
+    for b, e in zip(blocks, expected):
+        npt.assert_array_equal(e, b)
+
+    # stopping early kills the decoder
+    blocks = au._iter_pipe_blocks(cat + [filepath], 3000, 200)
+    next(blocks)
+    blocks.close()
+
+    notwav = tmpdir.join("not.wav")
+    notwav.write("not a wav file")
+    with pytest.raises(RuntimeError):
+        list(au._iter_pipe_blocks(cat + [str(notwav)], 3000, 200))
+
+    with pytest.raises(ValueError):
+        next(au.iter_audio_blocks(filepath, 3000, 3000))
+
+
+def test_iter_audio_blocks_from_pipe_with_long_stderr(tmpdir):
+    # pylint: disable=protected-access
+    filepath = test_1_wav.filepath
+    # more than a pipe buffer of errors, before and while writing the WAV stream
+    noisy = [sys.executable, "-c", "import sys, shutil; "
+             "sys.stderr.write('error\\n' * 20000); sys.stderr.flush(); "
+             "shutil.copyfileobj(open(sys.argv[1], 'rb'), sys.stdout.buffer); "
+             "sys.stderr.write('error\\n' * 20000); sys.exit(int(sys.argv[2]))"]
+    blocks = list(au._iter_pipe_blocks(noisy + [filepath, '0'], 3000, 200))
+    expected = list(au.iter_audio_blocks(filepath, 3000, 200, mono=False))
+    assert len(blocks) == len(expected)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        list(au._iter_pipe_blocks(noisy + [filepath, '1'], 3000, 200))
+    assert str(excinfo.value).count('error') > 20000
+
+
+# READ_SPH ################################################################## READ_SPH #
+def write_sph(filepath, samples, coding, byteformat, nbytes, samplerate=8000):
+    header = "\n".join([
+        "NIST_1A",
+        "   1024",
+        "sample_count -i {}".format(samples.shape[0]),
+        "channel_count -i {}".format(samples.shape[1]),
+        "sample_rate -i {}".format(samplerate),
+        "sample_n_bytes -i {}".format(nbytes),
+        "sample_coding -s{} {}".format(len(coding), coding),
+        "sample_byte_format -s{} {}".format(len(byteformat), byteformat),
+        "channels_interleaved -s4 TRUE",
+        "end_head",
+        "",
+    ]).encode('ascii')
+    with open(filepath, 'wb') as f:
+        f.write(header.ljust(1024, b' '))
+        f.write(samples.tobytes())
+
+
+def ulaw2lin(encoded):
+    """ G.711 mu-law codes to 16-bit linear PCM, one sample at a time, as a reference """
+    decoded = []
+    for code in encoded.ravel().tolist():
+        code = ~code & 0xFF
+        segment, step = (code >> 4) & 0x07, code & 0x0F
+        magnitude = ((2 * step + 33) << (segment + 2)) - 132
+        decoded.append(-magnitude if code & 0x80 else magnitude)
+
+    return np.array(decoded, dtype=np.int16).reshape(encoded.shape)
+
+
+def test_ulaw2lin_reference():
+    encoded = np.array([0x00, 0x80, 0xFF, 0x7F, 0x0F, 0x8F], dtype=np.uint8)
+    npt.assert_array_equal(ulaw2lin(encoded), [-32124, 32124, 0, 0, -16764, 16764])
+
+
+@pytest.fixture(
+    scope="module", params=[('pcm', '01', 1), ('pcm', '10', 2), ('ulaw', '1', 2)]
+)
+def sph_file(request, tmpdir_factory):
+    coding, byteformat, nchannels = request.param
+    rs = np.random.RandomState(32)
+    filepath = str(tmpdir_factory.mktemp("sph").join("fe_03_00001.sph"))
+    if coding == 'ulaw':
+        encoded = rs.randint(256, size=(12345, nchannels)).astype(np.uint8)
+        expected = ulaw2lin(encoded)
+        write_sph(filepath, encoded, coding, byteformat, 1)
+    else:
+        expected = rs.randint(-1 << 15, 1 << 15, size=(12345, nchannels)).astype(np.int16)
+        dtype = '<i2' if byteformat == '01' else '>i2'
+        write_sph(filepath, expected.astype(dtype), coding, byteformat, 2)
+
+    return filepath, expected
+
+
+def test_read_sph(sph_file):
+    filepath, expected = sph_file
+    data, samplerate = au.read_sph(filepath)
+    assert samplerate == 8000
+    assert data.dtype == np.int16
+    npt.assert_array_equal(expected, data)
+
+    meta = au.get_audio_metadata(filepath)
+    assert (meta.nsamples, meta.nchannels, meta.samplerate) == (12345, expected.shape[1], 8000)
+
+    blocks = list(au.iter_audio_blocks(filepath, 1000, 100, mono=False))
+    assert_blocks_same_as_whole(blocks, expected / 32768, 1000, 100)
+
+    npt.assert_array_equal(expected, pu.AudioIO.from_file(filepath).get_numpy_data())
+
+
+def test_read_sph_unsupported(tmpdir):
+    filepath = str(tmpdir.join("shortened.sph"))
+    write_sph(filepath, np.zeros((10, 1), dtype=np.int16), 'pcm,embedded-shorten-v2.00', '01', 2)
+    with pytest.raises(ValueError):
+        au.read_sph(filepath)
+
+
 # PYDUB_UTILS ############################################################ PYDUB_UTILS #
 @pytest.mark.skipif(not au.get_codec(), reason="No FFMPEG or AVCONV found")
 @pytest.mark.filterwarnings('ignore:Metadata')
@@ -270,3 +529,77 @@ def test_AudioIO_export_standard(valid_media_files):
         assert nm.samplerate == 16000
         assert nm.nchannels == 1
         assert_almost_equal(nm.seconds, um.seconds, decimal=3)
+
+
+@pytest.fixture
+def media_to_convert(tmpdir):
+    fromdir = tmpdir.mkdir("from")
+    filepaths = []
+    for name in ["a.wav", "b.wav", "c.wav"]:
+        fp = str(fromdir.join(name))
+        copyfile(test_1_wav.filepath, fp)
+        filepaths.append(fp)
+
+    fp = fromdir.join("broken.wav")
+    fp.write("not a wav file")
+    filepaths.insert(1, str(fp))
+
+    return filepaths, str(tmpdir.join("to"))
+
+
+@pytest.mark.filterwarnings('ignore:Metadata')
+def test_convert_to_standard_batch(media_to_convert):
+    filepaths, todir = media_to_convert
+    manifest = os.path.join(todir, "manifest.jsonl")
+
+    converted = pu.convert_to_standard_batch(
+        filepaths, todir, workers=2, manifest=manifest, samplerate=8000
+    )
+    assert [c.filepath for c in converted] == filepaths
+    assert [c.status for c in converted] == ['converted', 'failed', 'converted', 'converted']
+    assert 'broken.wav' in converted[1].error
+    for c in converted[::2]:
+        meta = au.get_audio_metadata(os.path.join(todir, c.tofilenames[0]))
+        assert (meta.samplerate, meta.nchannels) == (8000, 1)
+
+    with open(manifest) as f:
+        assert sorted(json.loads(l)['index'] for l in f) == list(range(len(filepaths)))
+
+    # only the out-of-date ones are converted again
+    os.utime(filepaths[2], None)
+    converted = pu.convert_to_standard_batch(filepaths, todir, samplerate=8000)
+    assert [c.status for c in converted] == ['skipped', 'failed', 'converted', 'skipped']
+
+    converted = pu.convert_to_standard_batch(filepaths, todir, samplerate=16000)
+    assert [c.status for c in converted] == ['converted', 'failed', 'converted', 'converted']
+
+    converted = pu.convert_to_standard_batch(filepaths[:1], todir, split=True)
+    assert converted[0].tofilenames == ["a.c0.wav", "a.c1.wav"]
+    converted = pu.convert_to_standard_batch(filepaths[:1], todir, split=True)
+    assert converted[0].status == 'skipped'
+
+    # the ones that would be converted to the same names in todir all fail
+    samename = os.path.join(os.path.dirname(todir), "samename")
+    os.makedirs(samename)
+    copyfile(filepaths[0], os.path.join(samename, "c.wav"))
+    for workers in (1, 2):
+        converted = pu.convert_to_standard_batch(
+            filepaths + [os.path.join(samename, "c.wav")], todir, workers=workers
+        )
+        assert [c.status for c in converted] == [
+            'skipped', 'failed', 'skipped', 'failed', 'failed'
+        ]
+        assert all("same names" in c.error for c in converted[3:])
+
+
+@pytest.mark.filterwarnings('ignore:Metadata')
+def test_convert_to_standard_batch_cli(media_to_convert, tmpdir):
+    filepaths, todir = media_to_convert
+    fromlist = tmpdir.join("fromlist.txt")
+    fromlist.write("\n".join(filepaths[2:]) + "\n")
+
+    argv = [filepaths[0], '--fromlist', str(fromlist), '--todir', todir, '--workers', '2']
+    assert pu.main(argv) == 0
+    assert sorted(os.listdir(todir)) == ["a.wav", "b.wav", "c.wav", "manifest.jsonl"]
+
+    assert pu.main([filepaths[1]] + argv) == 1
@@ -0,0 +1,574 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the HDF5 utilities for training
+
+@motjuste
+Created: 18-10-2026
+"""
+from __future__ import print_function, division
+import os
+import pytest
+import numpy as np
+import numpy.testing as npt
+import h5py as h
+
+from rennet.utils import h5_utils as hu
+from rennet.utils import np_utils as nu
+
+# pylint: disable=redefined-outer-name, invalid-name, missing-docstring
+
+NCHUNKS = 6
+CHUNKLEN = 40
+NFEATS = 4
+NCLASSES = 3
+
+
+class H5ChunkingsReader(hu.BaseH5ChunkingsReader):
+    """ Reads chunkings of all datasets in groups 'data' and 'labels' """
+
+    def __init__(self, filepath, **kwargs):
+        self._chunkings = None
+        super(H5ChunkingsReader, self).__init__(filepath, **kwargs)
+
+    @property
+    def chunkings(self):
+        if self._chunkings is None:
+            chunkings = []
+            with h.File(self.filepath, 'r') as f:
+                for name in sorted(f['data'].keys()):
+                    d = f['data'][name]
+                    for s in range(0, d.shape[0], d.chunks[0]):
+                        e = min(s + d.chunks[0], d.shape[0])
+                        chunkings.append(
+                            hu.Chunking(
+                                datapath=d.name,
+                                dataslice=np.s_[s:e, ...],
+                                labelpath=f['labels'][name].name,
+                                labelslice=np.s_[s:e, ...],
+                            )
+                        )
+            self._chunkings = chunkings
+
+        return self._chunkings
+
+    @property
+    def totlen(self):
+        return sum(c.dataslice[0].stop - c.dataslice[0].start for c in self.chunkings)
+
+
+class CategoricalPrepper(hu.AsIsChunkPrepper):
+    def prep_label(self, label, **kwargs):
+        return nu.to_categorical(label, nclasses=NCLASSES)
+
+
+class SteppedInputsProvider(  # pylint: disable=too-many-ancestors
+        H5ChunkingsReader, CategoricalPrepper, hu.BaseClassSubsamplingSteppedInputsProvider):
+    pass
+
+
+class WithContextInputsProvider(  # pylint: disable=too-many-ancestors
+        H5ChunkingsReader, CategoricalPrepper, hu.BaseWithContextSteppedInputsProvider):
+    pass
+
+
+class WithContextSubsamplingInputsProvider(  # pylint: disable=too-many-ancestors
+        H5ChunkingsReader, CategoricalPrepper, hu.BaseWCtxSubsplStpdInputsProvider):
+    pass
+
+
+@pytest.fixture(scope='module')
+def h5filepath(tmpdir_factory):
+    filepath = str(tmpdir_factory.mktemp('h5_utils').join('chunked.h5'))
+    rs = np.random.RandomState(32)
+    with h.File(filepath, 'w') as f:
+        for i in range(2):
+            n = (NCHUNKS // 2) * CHUNKLEN
+            data = np.arange(n * NFEATS, dtype=np.float32).reshape((n, NFEATS)) + i * 1e4
+            # labels in segments, so that there is something to subsample
+            label = np.repeat(rs.randint(NCLASSES, size=n // 4), 4)
+            f.create_dataset('data/{}'.format(i), data=data, chunks=(CHUNKLEN, NFEATS))
+            f.create_dataset('labels/{}'.format(i), data=label, chunks=(CHUNKLEN, ))
+
+    yield filepath
+    hu.H5_FILE_HANDLES.close()
+
+
+def collect(gen):
+    return [[np.array(i) for i in inputs] for inputs in gen]
+
+
+def assert_same_flows(expected, actual):
+    assert len(expected) == len(actual)
+    for e, a in zip(expected, actual):
+        assert len(e) == len(a)
+        for ei, ai in zip(e, a):
+            npt.assert_array_equal(ei, ai)
+
+
+def test_read_chunk_keeps_file_open(h5filepath):
+    hu.H5_FILE_HANDLES.close()
+    ip = SteppedInputsProvider(h5filepath)
+    assert h5filepath not in hu.H5_FILE_HANDLES
+
+    c = ip.chunkings[1]
+    data, label = ip.read_h5_data_label_chunk(c)
+    with h.File(h5filepath, 'r') as f:
+        npt.assert_array_equal(data, f[c.datapath][c.dataslice])
+        npt.assert_array_equal(label, f[c.labelpath][c.labelslice])
+
+    assert h5filepath in hu.H5_FILE_HANDLES
+    f = ip.h5file()
+    ip.read_h5_data_label_chunk(ip.chunkings[2])
+    assert ip.h5file() is f
+
+    ip.close_h5file()
+    assert h5filepath not in hu.H5_FILE_HANDLES
+    assert not f.id.valid
+
+    # reopens lazily after close
+    ip.read_h5_data_label_chunk(c)
+    assert h5filepath in hu.H5_FILE_HANDLES
+
+
+def test_h5file_with_chunk_cache(h5filepath):
+    hu.H5_FILE_HANDLES.close()
+    ip = SteppedInputsProvider(h5filepath, rdcc_nbytes=2**20, rdcc_nslots=521)
+    ipdef = SteppedInputsProvider(h5filepath)
+
+    assert ip.h5file() is not ipdef.h5file()
+    assert len(hu.H5_FILE_HANDLES) == 2
+    assert ip.h5file().id.get_access_plist().get_cache()[1:3] == (521, 2**20)
+
+    assert_same_flows(collect(ipdef.flow()), collect(ip.flow()))
+    hu.H5_FILE_HANDLES.close()
+    assert not hu.H5_FILE_HANDLES
+
+
+def test_pool_forgets_handles_after_fork(h5filepath, monkeypatch):
+    pool = hu.H5FileHandlesPool()
+    f = pool.get(h5filepath)
+    assert pool.get(h5filepath) is f
+
+    monkeypatch.setattr(hu.os, 'getpid', lambda: -1)
+    assert h5filepath not in pool
+    ff = pool.get(h5filepath)
+    assert ff is not f
+    assert f.id.valid  # the parent's handle is left alone
+
+    pool.close()
+    f.close()
+
+
+@pytest.fixture(
+    scope='module',
+    params=[
+        (SteppedInputsProvider, dict(steps_per_chunk=3, class_subsample_to_ratios=(0.5, 1.))),
+        (WithContextInputsProvider, dict(steps_per_chunk=2, data_context=2)),
+    ],
+    ids=['subsampling', 'withcontext'],
+)
+def inputs_provider_kwargs(request):
+    return request.param
+
+
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+@pytest.mark.parametrize('prefetch_with', ['threads', 'processes'])
+def test_prefetched_flow_is_same(
+        h5filepath, inputs_provider_kwargs, shuffle_seed, prefetch_with):
+    cls, kwargs = inputs_provider_kwargs
+    ip = cls(h5filepath, shuffle_seed=shuffle_seed, npasses=2, **kwargs)
+
+    expected = collect(ip.flow(starting_pass_at=0, starting_chunk_at=2))
+    assert len(expected) == (2 * ip.nchunks - 2) * ip.steps_per_chunk
+
+    prefetched = collect(
+        ip.flow(
+            starting_pass_at=0,
+            starting_chunk_at=2,
+            prefetch=3,
+            prefetch_with=prefetch_with,
+        )
+    )
+    assert_same_flows(expected, prefetched)
+
+    prefetched_pass = [
+        list(i) for i in ip.flow_for_pass(1, prefetch=2, prefetch_with=prefetch_with)
+    ]
+    expected_pass = [list(i) for i in ip.flow_for_pass(1)]
+    assert len(prefetched_pass) == len(expected_pass) == ip.nchunks
+    for e, p in zip(expected_pass, prefetched_pass):
+        assert_same_flows(collect(e), collect(p))
+
+
+def test_prefetched_flow_indefinitely_closes(h5filepath):
+    ip = SteppedInputsProvider(h5filepath, shuffle_seed=32, npasses=2)
+    expected = collect(ip.flow())
+
+    gen = ip.flow(indefinitely=True, prefetch=2)
+    prefetched = [next(gen) for _ in range(2 * len(expected))]
+    gen.close()
+
+    assert_same_flows(expected * 2, prefetched)
+
+    with pytest.raises(ValueError):
+        next(ip.flow(prefetch=2, prefetch_with='fibers'))
+
+
+def chunkwise(flow_for_pass):
+    return {chunkidx: collect(steps) for steps, (chunkidx, _) in flow_for_pass}
+
+
+@pytest.mark.parametrize('starting_chunk_at', [0, 3])
+def test_sharded_flows_partition_the_passes(
+        h5filepath, inputs_provider_kwargs, starting_chunk_at):
+    cls, kwargs = inputs_provider_kwargs
+    ip = cls(h5filepath, shuffle_seed=32, npasses=2, **kwargs)
+    nshards = 4
+
+    for at in range(ip.npasses):
+        expected = chunkwise(
+            ip.flow_for_pass(at, starting_chunk_at=starting_chunk_at, with_chunking=True)
+        )
+        order = list(ip._chunk_order_for_pass(at))  # pylint: disable=protected-access
+
+        sharded = {}
+        for k in range(nshards):
+            shard = chunkwise(
+                ip.flow_for_pass(
+                    at,
+                    starting_chunk_at=starting_chunk_at,
+                    with_chunking=True,
+                    shard=(k, nshards),
+                )
+            )
+            # positions of the chunks in the shuffled order of the pass
+            assert all(order.index(c) % nshards == k for c in shard)
+            assert not set(shard) & set(sharded)
+            sharded.update(shard)
+
+        assert sorted(sharded) == sorted(expected)
+        for c in expected:
+            assert_same_flows(expected[c], sharded[c])
+
+    with pytest.raises(AssertionError):
+        next(ip.flow(shard=(nshards, nshards)))
+
+
+def _flow_in_forked_worker(gen, queue):
+    queue.put([[np.array(i) for i in inputs] for inputs in gen])
+
+
+def test_forked_flows_claim_distinct_shards(h5filepath):
+    mp = pytest.importorskip('multiprocessing')
+    ip = SteppedInputsProvider(h5filepath, shuffle_seed=32, npasses=2, steps_per_chunk=2)
+    expected = collect(ip.flow())
+
+    nshards = 3
+    gen = ip.flow(shard=nshards)  # shared by the forked copies, e.g. by Keras
+
+    # the shards are released when the flows end, and can be claimed again by the
+    # copies started later, e.g. by the next enqueuer of Keras for every epoch
+    ctx = mp.get_context('fork')
+    for _ in range(2):
+        queue = ctx.Queue()
+        workers = [
+            ctx.Process(target=_flow_in_forked_worker, args=(gen, queue))
+            for _ in range(nshards)
+        ]
+        for w in workers:
+            w.start()
+
+        flown = [queue.get(timeout=60) for _ in workers]
+        for w in workers:
+            w.join()
+
+        assert sorted(len(f) for f in flown) == [len(expected) // nshards] * nshards
+        assert_same_flows(
+            sorted(expected, key=lambda i: i[0].sum()),
+            sorted(sum(flown, []), key=lambda i: i[0].sum()),
+        )
+
+
+def test_shared_shard_index_claims_and_releases():
+    index = hu.SharedShardIndex(3)
+    shards = [index.claim() for _ in range(3)]
+    assert shards == [(0, 3), (1, 3), (2, 3)]
+
+    # all shards have been claimed
+    with pytest.raises(RuntimeError):
+        index.claim()
+
+    # ... and not again till all of them are released
+    index.release(shards[1])
+    with pytest.raises(RuntimeError):
+        index.claim()
+
+    for shard in shards[::2]:
+        index.release(shard)
+    assert index.claim() == (0, 3)
+
+
+@pytest.mark.parametrize(
+    'cls, kwargs', [
+        (WithContextInputsProvider, dict()),
+        (WithContextSubsamplingInputsProvider, dict(class_subsample_to_ratios=(0.5, 1.))),
+    ],
+    ids=['withcontext', 'withcontext-subsampling']
+)
+def test_batch_buffers_are_same_and_reused(h5filepath, cls, kwargs):
+    steps_per_chunk, nbuffers = 3, 4
+    ip = cls(
+        h5filepath, data_context=3, steps_per_chunk=steps_per_chunk, shuffle_seed=32, **kwargs
+    )
+    ipbuf = cls(
+        h5filepath,
+        data_context=3,
+        steps_per_chunk=steps_per_chunk,
+        shuffle_seed=32,
+        batch_buffers=nbuffers,
+        **kwargs
+    )
+    assert ip.batch_buffers is None
+
+    expected = collect(ip.flow())
+    flown, gathered = [], []
+    for inputs in ipbuf.flow():
+        # valid till nbuffers more have been gathered
+        assert not any(
+            np.shares_memory(inputs[0], g[0]) for g in gathered[-nbuffers + 1:]
+        )
+
+        gathered.append(inputs)
+        flown.append([np.array(i) for i in inputs])  # copied before being reused
+
+    assert_same_flows(expected, flown)
+
+    # reallocated only when a larger batch than before comes for a buffer
+    assert len(set(id(g[0].base) for g in gathered)) < len(flown) // 2
+
+    with pytest.raises(AssertionError):
+        hu.BatchBuffersRing(0)
+
+    # the steps of the prefetched chunks would overwrite the ones not consumed yet
+    for prefetch_with in ('threads', 'processes'):
+        with pytest.raises(ValueError):
+            ipbuf.flow(prefetch=2, prefetch_with=prefetch_with)
+
+        with pytest.raises(ValueError):
+            ipbuf.flow_for_pass(0, prefetch=2, prefetch_with=prefetch_with)
+
+
+def segmentwise_keeping_decision(ip, labels, keep_seed=None):
+    """ The earlier keeping_decision, looping over each contiguous segment """
+    diff = np.concatenate([
+        np.ones((1, ) + labels.shape[1:], dtype=labels.dtype),
+        np.diff(labels, axis=0),
+    ])
+    starts = np.unique(np.where(diff)[0])
+    ends = np.concatenate([starts[1:], [len(labels)]])
+
+    if keep_seed is not None:
+        np.random.seed(keep_seed)
+        seeds = np.random.randint(41184535, size=len(starts))
+
+    keeps = []
+    for i, (s, e, l) in enumerate(zip(starts, ends, labels[starts])):
+        ratio = ip.ratios[ip.classkeyfn(l)]
+        idx = np.arange(s, e)
+        if ratio == 0.:
+            continue
+        elif ratio == 1.:
+            keeps.append(idx)
+        else:
+            k = max(1, int(len(idx) * ratio))
+            if keep_seed is not None:
+                np.random.seed(seeds[i])
+                idx = np.random.permutation(idx)
+
+            keeps.append(idx[:k])
+
+    return np.sort(np.concatenate(keeps))
+
+
+@pytest.fixture(scope='module')
+def segmented_labels():
+    rs = np.random.RandomState(32)
+    # many tiny segments, as for frame-wise labels
+    label = np.repeat(rs.randint(NCLASSES, size=5000), rs.randint(1, 12, size=5000))
+    return [np.zeros(len(label)), nu.to_categorical(label, nclasses=NCLASSES)]
+
+
+@pytest.mark.parametrize('ratios', [(0.5, 1.), (0, 0.2), 0.3, (1., 0., 0.7)])
+def test_keeping_decision_same_as_segmentwise(h5filepath, segmented_labels, ratios):
+    ip = SteppedInputsProvider(h5filepath, class_subsample_to_ratios=ratios)
+    labels = segmented_labels[1]
+
+    expected = segmentwise_keeping_decision(ip, labels)
+    npt.assert_array_equal(expected, ip.keeping_decision(segmented_labels))
+
+    # a random selection, but the same number from each segment
+    seeded = segmentwise_keeping_decision(ip, labels, keep_seed=32)
+    keeps = ip.keeping_decision(segmented_labels, keep_seed=32)
+    segids = np.cumsum(np.any(np.diff(labels, axis=0) != 0, axis=1))
+    segids = np.concatenate([[0], segids])
+    npt.assert_array_equal(np.bincount(segids[seeded]), np.bincount(segids[keeps]))
+    assert np.all(np.diff(keeps) > 0)
+    assert not np.array_equal(keeps, expected)
+    npt.assert_array_equal(keeps, ip.keeping_decision(segmented_labels, keep_seed=32))
+
+    npt.assert_array_equal(ip.keeping_decision([l[:0] for l in segmented_labels]), [])
+
+
+def test_keeping_decision_for_one_label(h5filepath):
+    ip = SteppedInputsProvider(h5filepath, class_subsample_to_ratios=(0.5, 1, 1))
+    labels = np.array([[1, 0, 0]])
+    npt.assert_array_equal(ip.keeping_decision([np.zeros(1), labels]), [0])
+    npt.assert_array_equal(ip.keeping_decision([np.zeros(1), labels], keep_seed=32), [0])
+
+
+@pytest.mark.benchmark
+@pytest.mark.skipif(
+    'RENNET_BENCHMARKS' not in os.environ, reason="opt-in with RENNET_BENCHMARKS=1"
+)
+def test_keeping_decision_benchmark(h5filepath, segmented_labels):
+    from timeit import timeit
+    ip = SteppedInputsProvider(h5filepath, class_subsample_to_ratios=(0.5, 0.2))
+    labels = segmented_labels[1]
+
+    t_segmentwise = timeit(
+        lambda: segmentwise_keeping_decision(ip, labels, keep_seed=32), number=3
+    )
+    t_vectorised = timeit(
+        lambda: ip.keeping_decision(segmented_labels, keep_seed=32), number=3
+    )
+    print(
+        "\nkeeping_decision on {} segments, segmentwise: {:.4f}s, vectorised: {:.4f}s".
+        format(
+            1 + np.any(np.diff(labels, axis=0), axis=1).sum(), t_segmentwise / 3,
+            t_vectorised / 3
+        )
+    )
+
+
+def test_shuffling_leaves_global_random_alone(h5filepath, inputs_provider_kwargs):
+    cls, kwargs = inputs_provider_kwargs
+    ip = cls(h5filepath, shuffle_seed=32, npasses=2, **kwargs)
+
+    np.random.seed(42)
+    state = np.random.get_state()
+    flown = collect(ip.flow())
+    after = np.random.get_state()
+    assert all(np.array_equal(s, a) for s, a in zip(state, after))
+
+    # ... and the same as reseeding the global one, as was done before
+    np.random.seed(32)
+    arr = np.arange(10)
+    np.random.shuffle(arr)
+    npt.assert_array_equal(arr, ip.maybe_shuffle_array(np.arange(10), 32))
+
+    np.random.seed(32)
+    pseeds = np.random.randint(41184535, size=ip.npasses * (1 + ip.nchunks))[:2]
+    np.random.seed(pseeds[1])
+    npt.assert_array_equal(np.random.permutation(ip.nchunks), ip._chunk_order_for_pass(1))  # pylint: disable=protected-access
+
+    # reproducible with many threads prepping the chunks at once
+    assert_same_flows(flown, collect(ip.flow(prefetch=4, prefetch_with='threads')))
+
+
+@pytest.mark.parametrize('memmapped', [False, True], ids=['inmemory', 'memmapped'])
+def test_prepped_cache_across_passes(h5filepath, inputs_provider_kwargs, memmapped, tmpdir):
+    cls, kwargs = inputs_provider_kwargs
+    memmap_dir = str(tmpdir.join('prepped')) if memmapped else None
+    cache = hu.PreppedChunksCache(2**30, memmap_dir=memmap_dir)
+
+    ip = cls(h5filepath, shuffle_seed=32, npasses=3, **kwargs)
+    ipcache = cls(h5filepath, shuffle_seed=32, npasses=3, prepped_cache=cache, **kwargs)
+
+    assert_same_flows(collect(ip.flow()), collect(ipcache.flow()))
+    assert (cache.misses, cache.hits) == (ip.nchunks, 2 * ip.nchunks)
+    assert len(cache) == ip.nchunks
+    assert cache.nbytes > 0
+
+    # as cached, before any more prepping, e.g. adding context
+    data, label = hu.BaseInputsProvider.get_prepped_data_label(ipcache, ip.chunkings[0])
+    assert not data.flags.writeable and not label.flags.writeable
+    assert isinstance(data, np.memmap) == memmapped
+
+    # a different config, or only labels, is a different entry
+    other = cls(h5filepath, npasses=1, prepped_cache=cache, **kwargs)
+    collect(other.flow(only_labels=True))
+    assert len(cache) == 2 * ip.nchunks
+
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+    if memmapped:
+        assert not tmpdir.join('prepped').listdir()
+
+
+def first_label_for_subcontext(labels_in_subcontext):
+    return labels_in_subcontext[:, 0, ...]
+
+
+def test_prepped_cache_keys_callables(h5filepath):
+    cache = hu.PreppedChunksCache(2**30)
+    kwargs = dict(data_context=1, label_subcontext=1, prepped_cache=cache)
+
+    dominant = WithContextInputsProvider(h5filepath, **kwargs)
+    first = WithContextInputsProvider(
+        h5filepath, label_from_subcontext_fn=first_label_for_subcontext, **kwargs
+    )
+    collect(dominant.flow())
+    assert_same_flows(
+        collect(
+            WithContextInputsProvider(
+                h5filepath,
+                data_context=1,
+                label_subcontext=1,
+                label_from_subcontext_fn=first_label_for_subcontext,
+            ).flow()
+        ),
+        collect(first.flow()),
+    )
+    assert (cache.misses, len(cache)) == (2 * dominant.nchunks, 2 * dominant.nchunks)
+
+    # a lambda can't be told apart from another one by its name, hence, not cached
+    unnamed = WithContextInputsProvider(
+        h5filepath, label_from_subcontext_fn=lambda l: l[:, -1, ...], **kwargs
+    )
+    collect(unnamed.flow())
+    assert (cache.misses, len(cache)) == (2 * dominant.nchunks, 2 * dominant.nchunks)
+
+
+def test_prepped_cache_evicts_least_recently_used():
+    arrays = [(np.arange(10, dtype=np.float64), np.arange(10)) for _ in range(4)]
+    nbytes = sum(a.nbytes for a in arrays[0])
+    cache = hu.PreppedChunksCache(3 * nbytes)
+
+    for i in range(3):
+        cache.put(i, arrays[i])
+
+    assert cache.get(0) is not None  # 1 is now the least recently used
+    cache.put(3, arrays[3])
+    assert 1 not in cache
+    assert all(k in cache for k in (0, 2, 3))
+    assert cache.nbytes == 3 * nbytes
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    assert cache.get(1) is None
+    assert cache.misses == 1
+
+    # too large to be cached, returned as is
+    large = (np.zeros(4 * nbytes, dtype=np.uint8), )
+    assert cache.put(4, large) is large
+    assert 4 not in cache and len(cache) == 3
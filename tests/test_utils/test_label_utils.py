@@ -17,6 +17,8 @@
 Created: 26-08-2016
 """
 from __future__ import print_function, division
+import json
+import os
 from six.moves import zip
 import pytest
 import numpy as np
@@ -201,6 +203,80 @@ def test_SequenceLabels_initializes(init_small_seqdata):
     print(s)
 
 
+
+@pytest.mark.parametrize('mmap_mode', ['r', None])
+def test_SequenceLabels_save_load(init_small_seqdata, tmpdir, mmap_mode):
+    se = init_small_seqdata['starts_ends']
+    sr = init_small_seqdata['samplerate']
+    l = init_small_seqdata['labels']
+
+    eafl = [lu.EAFAnnotationInfo(str(x), annotator='a{}'.format(i)) for i, x in enumerate(l)]
+    tuplel = np.empty(len(l), dtype=np.object)
+    tuplel[:] = [(x, i) for i, x in enumerate(l)]
+    for labels in (l, eafl, tuplel):
+        s = lu.SequenceLabels(se, labels, samplerate=sr)
+        fp = str(tmpdir.join('labels.rsl'))
+        s.save(fp)
+
+        r = lu.SequenceLabels.load(fp, mmap_mode=mmap_mode)
+        assert type(r) is lu.SequenceLabels  # pylint: disable=unidiomatic-typecheck
+        assert isinstance(r.starts_ends, np.memmap) == (mmap_mode is not None)
+        npt.assert_equal(s.starts_ends, r.starts_ends)
+        assert r.samplerate == s.samplerate
+        assert [repr(x) for x in s.labels] == [repr(x) for x in r.labels]
+
+        with s.samplerate_as(100), r.samplerate_as(100):
+            assert [[str(x) for x in xs] for xs in s.labels_at(se[:, 0])] == [
+                [str(x) for x in xs] for xs in r.labels_at(se[:, 0])
+            ]
+
+    if init_small_seqdata['isconti']:
+        s = lu.ContiguousSequenceLabels(se, np.eye(len(l), dtype=np.int), samplerate=sr)
+        s.save(fp)
+        r = lu.SequenceLabels.load(fp, mmap_mode=mmap_mode)
+        assert type(r) is lu.ContiguousSequenceLabels  # pylint: disable=unidiomatic-typecheck
+        npt.assert_equal(s.labels, r.labels)
+    else:
+        with pytest.raises(TypeError):
+            lu.ContiguousSequenceLabels.load(fp)
+
+def resave_with_header(fp, update):
+    """ Re-write the file saved by `SequenceLabels.save` at `fp` after `update(header)` """
+    # pylint: disable=protected-access
+    magic, align = lu.SequenceLabels._SAVE_MAGIC, lu.SequenceLabels._SAVE_ALIGN
+    with open(fp, 'rb') as f:
+        f.seek(len(magic))
+        headerlen = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(headerlen).decode('utf-8'))
+        f.seek(-(-(len(magic) + 8 + headerlen) // align) * align)
+        data = f.read()
+
+    update(header)
+    header = json.dumps(header).encode('utf-8')
+    with open(fp, 'wb') as f:
+        f.write(magic + np.array(len(header), dtype='<u8').tobytes() + header)
+        f.seek(-(-(len(magic) + 8 + len(header)) // align) * align)
+        f.write(data)
+
+
+def test_SequenceLabels_load_checks_classes(tmpdir):
+    se = np.array([[0, 1], [1, 2]])
+    labels = [lu.EAFAnnotationInfo('a', annotator='x'), lu.EAFAnnotationInfo('b')]
+    fp = str(tmpdir.join('labels.rsl'))
+
+    for update in [
+            lambda h: h.update({'class': 'os.system'}),
+            lambda h: h.update({'class': 'rennet.utils.label_utils.EAFAnnotationInfo'}),
+            lambda h: h['labels'].update({'class': 'collections.OrderedDict'}),
+            lambda h: h['labels'].update({'class': 'rennet.utils.label_utils.SequenceLabels'}),
+    ]:
+        lu.SequenceLabels(se, labels).save(fp)
+        lu.SequenceLabels.load(fp)  # fine as saved
+        resave_with_header(fp, update)
+        with pytest.raises(TypeError):
+            lu.SequenceLabels.load(fp)
+
+
 def test_ContiguousSequenceLabels_init_conti_fail_nonconti(init_small_seqdata):
     """ Test ContiguousSequenceLabels class initializes
         - w/o errors if labels are contiguous
@@ -540,6 +616,102 @@ def test_SequenceLabels_labels_at_general(SequenceLabels_small_seqdata_labels_at
     assert s.labels_at(la_ends[0], lasr, None)[-1] == labels[0]
 
 
+def test_SequenceLabels_labels_idx_at_general(SequenceLabels_small_seqdata_labels_at_general):
+    s, la_ends, lasr = [
+        SequenceLabels_small_seqdata_labels_at_general[k]
+        for k in ['seqlabelinst', 'ends', 'at_sr']
+    ]
+
+    labels = s.labels_at(la_ends, lasr, None)
+    offsets, label_ids = s.labels_idx_at(la_ends, lasr)
+
+    assert len(offsets) == len(la_ends) + 1
+    for i, l in enumerate(labels):
+        ids = label_ids[offsets[i]:offsets[i + 1]]
+        if l is None:
+            assert len(ids) == 0
+        else:
+            assert tuple(s.labels[ids]) == l
+
+    # the flattened index is computed only once
+    assert s._flattened_index() is s._flattened_index()  # pylint: disable=protected-access
+
+
+def test_SequenceLabels_labels_idx_at_overlapping():
+    rs = np.random.RandomState(32)
+    starts = rs.randint(0, 10000, size=500)
+    ends = starts + rs.randint(1, 200, size=500)
+    s = lu.SequenceLabels(np.stack([starts, ends], axis=1), np.arange(500), samplerate=100)
+
+    at = np.arange(-10, 10300)
+    offsets, label_ids = s.labels_idx_at(at / 100., samplerate=1)
+
+    se = s.starts_ends
+    for i, t in enumerate(at):
+        expected = np.flatnonzero((se[:, 0] <= t) & (t < se[:, 1]))
+        npt.assert_array_equal(expected, label_ids[offsets[i]:offsets[i + 1]])
+
+
+def test_SequenceLabels_labels_at_with_dropped_segments():
+    # the segment between 2**60 and 2**60 + 1 is empty at samplerate 1, as float
+    b = 2**60
+    s = lu.SequenceLabels(
+        np.array([[0, b], [b, b + 1], [b + 1, 2 * b]]), np.array(['a', 'b', 'c']),
+        samplerate=2
+    )
+
+    at = [1, b // 2 + 2**10]
+    with s.samplerate_as(1):
+        offsets, label_ids = s.labels_idx_at(at)
+        labels = s.labels_at(at)
+
+    npt.assert_array_equal(offsets, [0, 1, 2])
+    npt.assert_array_equal(label_ids, [0, 2])
+    assert [tuple(l) for l in labels] == [('a', ), ('c', )]
+
+
+@pytest.mark.parametrize('n', [1, 2, 7, 500])
+def test_SequenceLabels_flattened_csr_same_as_loop(n):
+    rs = np.random.RandomState(n)
+    starts = rs.randint(0, 20 * n, size=n) / 10.
+    ends = starts + rs.randint(1, 100, size=n) / 10.
+    s = lu.SequenceLabels(np.stack([starts, ends], axis=1), np.arange(n), samplerate=10)
+
+    with s.samplerate_as(100):
+        bins, offsets, label_ids = s._flattened_csr()  # pylint: disable=protected-access
+        se = s.starts_ends
+
+    # the old double loop over segments and their spans in the flattened bins
+    exp_bins, sorting_indices = np.unique(se, return_inverse=True)
+    exp_labels_indices = [tuple()] * (len(exp_bins) - 1)
+    for j, (b, e) in enumerate(sorting_indices.reshape(-1, 2)):
+        for i in range(b, e):
+            exp_labels_indices[i] += (j, )
+
+    npt.assert_array_equal(exp_bins, bins)
+    assert len(offsets) == len(bins)
+    assert exp_labels_indices == [
+        tuple(label_ids[b:e]) for b, e in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def test_SequenceLabels_flattened_sums():
+    rs = np.random.RandomState(32)
+    starts = rs.randint(0, 1000, size=200)
+    ends = starts + rs.randint(1, 50, size=200)
+    spks = rs.randint(3, size=200)
+    s = lu.SequenceLabels(np.stack([starts, ends], axis=1), spks)
+
+    # pylint: disable=protected-access
+    se, sums = s._flattened_sums(np.eye(3, dtype=np.int)[s.labels])
+    exp_se, labels_idx = s._flattened_indices()
+    # pylint: enable=protected-access
+
+    npt.assert_array_equal(exp_se, se)
+    for lix, r in zip(labels_idx, sums):
+        npt.assert_array_equal(np.bincount(s.labels[list(lix)], minlength=3), r)
+
+
 @pytest.fixture(
     scope='module',
     params=[1., 3., 3, 101, 1000, 8000, 16000],  # samplerate for labels_at
@@ -1224,3 +1396,193 @@ def test_viterbi_priors_from_contiseqlabels(  # pylint: disable=too-many-locals
 # TODO: Test for multi-dimensional labels
 # TODO: Test ContiguousSequenceLabels for differet dtype labels
 # TODO: Test for non-numerical labels
+
+
+@pytest.fixture(scope='module')
+def viterbi_long_data():
+    rs = np.random.RandomState(32)
+    nstates = 3
+    states = np.repeat(rs.randint(nstates, size=400), rs.randint(1, 30, size=400))
+    obs = rs.rand(len(states), nstates) + 2 * np.eye(nstates)[states]
+    obs /= obs.sum(axis=1)[:, None]
+
+    init = np.ones(nstates) / nstates
+    tran = np.eye(nstates) * 0.9 + 0.05
+
+    return obs, init, tran
+
+
+def online_viterbi_decode(obs, init, tran, blocklens, lag=None):
+    decoder = lu.OnlineViterbi(init, tran, lag=lag)
+    tokens, maxpending = [], 0
+    at = 0
+    for i in range(len(obs)):
+        if at >= len(obs):
+            break
+
+        blocklen = blocklens[i % len(blocklens)]
+        tokens.append(decoder.decode(obs[at:at + blocklen]))
+        maxpending = max(maxpending, decoder.npending)
+        at += blocklen
+
+    tokens.append(decoder.finish())
+    assert decoder.npending == 0
+    return np.concatenate(tokens), maxpending
+
+
+@pytest.mark.viterbi
+@pytest.mark.parametrize('blocklens', [[1], [7], [100, 3, 1000], [100000]])
+def test_online_viterbi_same_as_batch_with_infinite_lag(viterbi_long_data, blocklens):
+    obs, init, tran = viterbi_long_data
+    expected = lu.viterbi_smoothing(obs, init, tran)
+
+    tokens, maxpending = online_viterbi_decode(obs, init, tran, blocklens)
+    npt.assert_array_equal(expected, tokens)
+
+    if blocklens[0] < len(obs):
+        # tokens are emitted as they converge, not held till the end
+        assert maxpending < len(obs) // 2
+
+
+@pytest.mark.viterbi
+def test_online_viterbi_wiki_data(viterbi_wiki_data):
+    w = viterbi_wiki_data
+    tokens, _ = online_viterbi_decode(w['obs'], w['init'], w['tran'].T, [1])
+    npt.assert_array_equal(w['preds'], tokens)
+
+
+@pytest.mark.viterbi
+@pytest.mark.parametrize('lag', [0, 5, 50])
+def test_online_viterbi_with_lag(viterbi_long_data, lag):
+    obs, init, tran = viterbi_long_data
+    expected = lu.viterbi_smoothing(obs, init, tran)
+
+    tokens, maxpending = online_viterbi_decode(obs, init, tran, [7], lag=lag)
+    assert len(tokens) == len(expected)
+    assert maxpending <= lag
+
+    # mostly the same, and more so with more lag
+    assert (tokens == expected).mean() > 0.8
+    if lag == 50:
+        npt.assert_array_equal(expected, tokens)
+
+    with pytest.raises(AssertionError):
+        lu.OnlineViterbi(init, tran, lag=-1)
+
+
+@pytest.mark.viterbi
+def test_viterbi_batch_same_as_each(viterbi_long_data, viterbi_wiki_data):
+    obs, init, tran = viterbi_long_data
+    rs = np.random.RandomState(32)
+    ends = np.sort(rs.randint(len(obs), size=50))
+    obs_seqs = [obs[s:e] for s, e in zip(ends[:-1], ends[1:])] + [obs[:1], obs]
+    obs_seqs.append(obs[:0])
+
+    tokens = lu.viterbi_smoothing_batch(obs_seqs, init, tran)
+    assert len(tokens) == len(obs_seqs)
+    for o, t in zip(obs_seqs[:-1], tokens[:-1]):
+        npt.assert_array_equal(lu.viterbi_smoothing(o, init, tran), t)
+    assert len(tokens[-1]) == 0
+
+    w = viterbi_wiki_data
+    tokens = lu.viterbi_smoothing_batch([w['obs']] * 3, w['init'], w['tran'].T)
+    for t in tokens:
+        npt.assert_array_equal(w['preds'], t)
+
+
+@pytest.fixture(scope='module')
+def viterbi_many_seqs(viterbi_long_data):
+    obs, init, tran = viterbi_long_data
+    rs = np.random.RandomState(32)
+    obs_seqs = [obs[s:s + n] for s, n in zip(rs.randint(len(obs) // 2, size=200),
+                                           rs.randint(100, 1000, size=200))]
+    return obs_seqs, init, tran
+
+
+@pytest.mark.viterbi
+def test_viterbi_batch_same_as_serial_for_many(viterbi_many_seqs):
+    obs_seqs, init, tran = viterbi_many_seqs
+    tokens = lu.viterbi_smoothing_batch(obs_seqs, init, tran)
+    for o, t in zip(obs_seqs, tokens):
+        npt.assert_array_equal(lu.viterbi_smoothing(o, init, tran), t)
+
+
+@pytest.mark.viterbi
+@pytest.mark.benchmark
+@pytest.mark.skipif(
+    'RENNET_BENCHMARKS' not in os.environ, reason="opt-in with RENNET_BENCHMARKS=1"
+)
+def test_viterbi_batch_benchmark(viterbi_many_seqs):
+    from timeit import default_timer as timer
+    obs_seqs, init, tran = viterbi_many_seqs
+
+    s = timer()
+    for o in obs_seqs:
+        lu.viterbi_smoothing(o, init, tran)
+    serial = timer() - s
+
+    s = timer()
+    lu.viterbi_smoothing_batch(obs_seqs, init, tran)
+    batched = timer() - s
+
+    print("\nviterbi serial: {:.4f}s, batched: {:.4f}s".format(serial, batched))
+
+
+def test_parse_cache_for_eaf(tmpdir, monkeypatch):
+    from pympi import Eaf
+    eaf = Eaf()
+    for tier, start, end in [('a', 0, 100), ('b', 100, 300), ('a', 200, 400)]:
+        if tier not in eaf.tiers:
+            eaf.add_tier(tier)
+        eaf.add_annotation(tier, start, end, value=tier)
+    eafpath = str(tmpdir.join('labels.eaf'))
+    eaf.to_file(eafpath)
+
+    parsed = []
+    parse_eaf = lu.SequenceLabels._parse_eaf  # pylint: disable=protected-access
+
+    def counting_parse_eaf(filepath, tiers):
+        parsed.append(filepath)
+        return parse_eaf(filepath, tiers)
+
+    monkeypatch.setattr(lu.SequenceLabels, '_parse_eaf', staticmethod(counting_parse_eaf))
+    cache = lu.ParseCache()
+    monkeypatch.setattr(lu, 'PARSE_CACHE', cache)
+
+    # disabled by default
+    expected = lu.SequenceLabels.from_eaf(eafpath)
+    lu.SequenceLabels.from_eaf(eafpath)
+    assert len(parsed) == 2
+
+    cache.enable(str(tmpdir.join('cache')))
+    for _ in range(3):
+        r = lu.SequenceLabels.from_eaf(eafpath)
+        npt.assert_equal(expected.starts_ends, r.starts_ends)
+        assert r.samplerate == expected.samplerate
+        assert [repr(l) for l in expected.labels] == [repr(l) for l in r.labels]
+    assert len(parsed) == 3
+
+    # different options, and a modified file are parsed again
+    lu.SequenceLabels.from_eaf(eafpath, tiers=['a'])
+    assert len(parsed) == 4
+    os.utime(eafpath, (0, 0))
+    lu.SequenceLabels.from_eaf(eafpath)
+    assert len(parsed) == 5
+    assert len(os.listdir(cache.cache_dir)) == 3
+
+    # the least recently used ones are evicted when over max_nbytes
+    lu.SequenceLabels.from_eaf(eafpath, tiers=['a'])
+    assert len(parsed) == 6
+    entries = cache._entries()  # pylint: disable=protected-access
+    assert len(entries) == 4
+    cache.max_nbytes = sum(nbytes for _, nbytes, _ in entries[-2:])
+    cache.evict()
+    assert len(os.listdir(cache.cache_dir)) == 2
+    lu.SequenceLabels.from_eaf(eafpath, tiers=['a'])
+    lu.SequenceLabels.from_eaf(eafpath)
+    assert len(parsed) == 6
+
+    cache.disable()
+    lu.SequenceLabels.from_eaf(eafpath, tiers=['a'])
+    assert len(parsed) == 7
+    cache.clear()
@@ -0,0 +1,188 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the utilities for working with MPEG7 files
+
+@motjuste
+Created: 18-10-2026
+"""
+from __future__ import print_function, division
+import warnings
+from fractions import Fraction
+import pytest
+import numpy as np
+
+from rennet.utils import mpeg7_utils as mu
+
+# pylint: disable=redefined-outer-name, invalid-name, missing-docstring
+
+PREFIXES = {
+    'ns': ('ns2', 'ns', "SpokenContentType"),
+    'mpeg7': ('mpeg7', 'ifinder', "ifinder:SpokenContentType"),
+}
+
+
+def synthetic_mpeg7(nsegments, seed, use_tags='ns'):
+    rs = np.random.RandomState(seed)
+    m, i, spoken = PREFIXES[use_tags]
+
+    segments = []
+    for n in range(nsegments):
+        persec = rs.choice([25, 100, 1000])
+        start = rs.randint(0, 3600 * persec)
+        hours, rest = divmod(start, 3600 * persec)
+        minutes, rest = divmod(rest, 60 * persec)
+        sec, val = divmod(rest, persec)
+        timepoint = "T{:02}:{:02}:{:02}:{}F{}".format(hours, minutes, sec, val, persec)
+
+        dpersec = rs.choice([10, 100])
+        duration = "PT{}S{}N{}F".format(rs.randint(0, 10), rs.randint(0, dpersec), dpersec)
+        if n % 17 == 3:
+            duration = "PT0S0N{}F".format(dpersec)  # (end - start) == 0
+
+        descriptor = ""
+        if n % 11 != 7:  # no descriptor, no speech
+            descriptor = (
+                '<{m}:AudioDescriptor xsi:type="{spoken}">'
+                '<{i}:Speaker gender="{g}"><{m}:GivenName>name{s}</{m}:GivenName>'
+                '</{i}:Speaker><{i}:Identifier>spk{s}</{i}:Identifier>'
+                '<{i}:SpokenUnitVector>word{n} word</{i}:SpokenUnitVector>'
+                '<{i}:ConfidenceVector>0.{c}</{i}:ConfidenceVector>'
+                '</{m}:AudioDescriptor>'
+            ).format(
+                m=m, i=i, spoken=spoken, n=n, g=rs.choice(['m', 'f']),
+                s=rs.randint(5), c=rs.randint(100)
+            )
+
+        segments.append(
+            '<{m}:AudioSegment><{m}:MediaTime>'
+            '<{m}:MediaTimePoint>{tp}</{m}:MediaTimePoint>'
+            '<{m}:MediaDuration>{d}</{m}:MediaDuration>'
+            '</{m}:MediaTime>{desc}</{m}:AudioSegment>'.format(
+                m=m, tp=timepoint, d=duration, desc=descriptor
+            )
+        )
+
+    # some AudioSegments inside another one
+    segments[5] = segments[5].replace(
+        '</{}:AudioSegment>'.format(m), "".join(segments[6:9]), 1
+    ) + '</{}:AudioSegment>'.format(m)
+    del segments[6:9]
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<{m}:Mpeg7 xmlns:{m}="{mns}" xmlns:{i}="{ins}" xmlns:xsi="{xsi}">'
+        '<{m}:Description><{m}:MultimediaContent><{m}:Audio>'
+        '<{m}:TemporalDecomposition>{segs}</{m}:TemporalDecomposition>'
+        '</{m}:Audio></{m}:MultimediaContent></{m}:Description></{m}:Mpeg7>'.format(
+            m=m, i=i, segs="\n".join(segments),
+            mns=mu.MPEG7_NAMESPACES[m], ins=mu.MPEG7_NAMESPACES[i],
+            xsi=mu.MPEG7_NAMESPACES['xsi']
+        )
+    )
+
+
+@pytest.fixture(scope='module', params=['ns', 'mpeg7'])
+def mpeg7_file(request, tmpdir_factory):
+    fp = tmpdir_factory.mktemp('mpeg7').join('{}.xml'.format(request.param))
+    fp.write(synthetic_mpeg7(3000, seed=32, use_tags=request.param))
+    return str(fp), request.param
+
+
+def test_iterparse_same_as_parse(mpeg7_file):
+    filepath, use_tags = mpeg7_file
+    with warnings.catch_warnings(record=True) as expected_warnings:
+        warnings.simplefilter('always')
+        expected = mu.parse_mpeg7(filepath, use_tags=use_tags)
+
+    with warnings.catch_warnings(record=True) as streamed_warnings:
+        warnings.simplefilter('always')
+        streamed = mu.iterparse_mpeg7(filepath, use_tags=use_tags)
+
+    assert expected == streamed
+    assert all(isinstance(se, tuple) for se in expected[0])
+    assert len(expected[0]) > 2000
+    assert [str(w.message) for w in expected_warnings
+            ] == [str(w.message) for w in streamed_warnings]
+    assert expected_warnings
+
+
+def test_iterparse_raises(tmpdir):
+    fp = tmpdir.join('empty.xml')
+    fp.write(synthetic_mpeg7(10, seed=32).replace('AudioSegment', 'VideoSegment'))
+    with pytest.raises(ValueError):
+        mu.iterparse_mpeg7(str(fp))
+
+    with pytest.raises(ValueError):
+        mu.iterparse_mpeg7(str(fp), use_tags='ns2')
+
+
+def test_iterparse_clears_read_segments(mpeg7_file):
+    filepath, use_tags = mpeg7_file
+    tags = mu._tags_for(use_tags)  # pylint: disable=protected-access
+    segments = mu._iter_segments(filepath, tags)  # pylint: disable=protected-access
+
+    # an outermost segment is cleared before the next one is read
+    outers = [next(segments)]
+    for segment in segments:
+        if any(segment is s for s in outers[-1].iter()):
+            continue  # inside the current outermost segment
+
+        assert len(outers[-1]) == 0 and not outers[-1].attrib
+        outers.append(segment)
+
+    assert len(outers) > 2000
+    assert all(len(o) == 0 for o in outers)
+
+
+def test_parse_timestrings_same_as_each():
+    rs = np.random.RandomState(32)
+    timepoints, durations, expected = [], [], []
+    for _ in range(1000):
+        persec, dpersec = rs.choice([25, 100, 1000, 44100]), rs.choice([10, 16000])
+        h, m, s, n = rs.randint(100), rs.randint(60), rs.randint(60), rs.randint(persec)
+        timepoints.append(
+            "{}T{:02}:{:02}:{:02}:{}F{}".format(
+                rs.choice(['', '2017-11-21']), h, m, s, n, persec
+            )
+        )
+        start = Fraction(h * 3600 + m * 60 + s) + Fraction(n, persec)
+
+        values = [rs.randint(100) if rs.randint(2) else None for _ in 'HMSN']
+        parts = [
+            "{}{}".format(v, k) for v, k in zip(values, 'HMSN') if v is not None
+        ] + ["{}F".format(dpersec)]
+        durations.append("P{}T{}".format(rs.choice(['', '1D']), "".join(parts)))
+        dh, dm, ds, dn = (v or 0 for v in values)
+        expected.append((start, start + dh * 3600 + dm * 60 + ds + Fraction(dn, dpersec)))
+
+    starts_ends, persec = mu.parse_timestrings(timepoints, durations)
+    assert starts_ends.dtype == np.int64
+    assert persec == 44100 * 16000 // 100
+    for (s, e), (es, ee) in zip(starts_ends, expected):
+        assert (Fraction(int(s), persec), Fraction(int(e), persec)) == (es, ee)
+
+    starts_ends, persec = mu.parse_timestrings([], [])
+    assert starts_ends.shape == (0, 2)
+
+    for tp, d in [
+            ("T00:00:01:5F10", "PT1S"),
+            ("T00:00:01F10", "PT1S0N10F"),
+            ("T00:00::5F10", "PT1S0N10F"),
+            ("T00:00:01:5F10", "PT10F1S"),
+            ("T00:00:01:5F10", "P1S10F"),
+            ("T00:00:01:5F10", "PT1S\n10F"),
+    ]:
+        with pytest.raises(ValueError):
+            mu.parse_timestrings(["T00:00:00:0F10", tp], ["PT1S0N10F", d])
+
@@ -16,6 +16,9 @@
 @motjuste
 Created: 10-10-2016
 """
+from threading import Thread
+import pytest
+
 from rennet.utils import py_utils as pu
 
 
@@ -27,3 +30,29 @@ def test_cvsecs():
     assert pu.cvsecs('01:01:33.5') == 3693.5  #(hr,min,sec)
     assert pu.cvsecs('01:01:33.045') == 3693.045
     assert pu.cvsecs('01:01:33,5') == 3693.5  #coma works too
+
+
+def _indexed_square(index_item):
+    # module-level to be picklable for a pool of processes
+    index, item = index_item
+    return index, item * item
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_imap_indexed(workers):
+    indexed = list(enumerate(range(50, 0, -1)))
+    results = list(pu.imap_indexed(_indexed_square, indexed, workers=workers))
+    assert sorted(results) == [(i, x * x) for i, x in indexed]
+    if workers == 1:
+        assert [i for i, _ in results] == list(range(50))
+
+
+def test_imap_indexed_stops_early():
+    results = pu.imap_indexed(_indexed_square, list(enumerate(range(1000))), workers=3)
+    next(results)
+
+    closing = Thread(target=results.close)
+    closing.daemon = True
+    closing.start()
+    closing.join(timeout=60)
+    assert not closing.is_alive(), "Stopping early did not finish in time"